@@ -0,0 +1,56 @@
+from lib.constants import BUSY_RETRY_AFTER, MAX_CONNECTIONS, MAX_SESSIONS_PER_CLIENT
+from lib.connection_registry import ConnectionRegistry
+from collections import Counter
+from random import random
+
+
+class AdmissionController(ConnectionRegistry):
+    """
+    Control de admision de sesiones: hasta max_sessions a la vez en el
+    servidor y hasta max_sessions_per_client por IP de cliente. Una solicitud
+    que no entra no se encola: se rechaza con un BUSY que le indica al
+    cliente cuantos milisegundos esperar antes de reintentar.
+    """
+
+    def __init__(
+        self,
+        max_sessions=MAX_CONNECTIONS,
+        max_sessions_per_client=MAX_SESSIONS_PER_CLIENT,
+    ):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.max_sessions_per_client = max_sessions_per_client
+        self.sessions_per_client = Counter()
+        self.rejected = 0
+
+    def admit(self, client_address) -> bool:
+        with self.lock:
+            if (
+                len(self.active_connections) >= self.max_sessions
+                or self.sessions_per_client[client_address[0]]
+                >= self.max_sessions_per_client
+            ):
+                self.rejected += 1
+                return False
+            self.total_connections += 1
+            self.active_connections[client_address] = self.total_connections
+            self.sessions_per_client[client_address[0]] += 1
+            return True
+
+    def close(self, client_address):
+        with self.lock:
+            self.active_connections.pop(client_address)
+            self.sessions_per_client[client_address[0]] -= 1
+            if self.sessions_per_client[client_address[0]] <= 0:
+                del self.sessions_per_client[client_address[0]]
+
+    def retry_after(self) -> int:
+        # Entre 1 y 2 veces BUSY_RETRY_AFTER, para que los clientes rechazados
+        # a la vez no vuelvan todos juntos
+        return int(BUSY_RETRY_AFTER * 1000 * (1 + random()))
+
+    def __str__(self):
+        return (
+            f"{len(self.active_connections)}/{self.max_sessions} sessions, "
+            f"{self.rejected} rejected"
+        )
@@ -0,0 +1,170 @@
+from lib.constants import ASSEMBLY_STATE_SUFFIX
+from lib.file_hashing import hash_blocks, merkle_root, split_leaves
+from lib.preallocated_file import allocate
+from lib.resume_state import ResumeState, partial_path
+from contextlib import contextmanager
+from pathlib import Path
+import logging
+import fcntl
+import json
+import os
+
+"""
+Transferencias en partes
+Un archivo grande se puede transferir en varias sesiones en paralelo, cada
+una con su socket, su ventana y su control de congestion, para llenar un
+enlace que una sola sesion no alcanza a usar. Cada parte es un rango de
+bloques consecutivos (ver split_blocks) que se escribe en su offset del
+mismo archivo parcial, y cada sesion verifica solo los bloques de su
+rango. Con la ultima parte se hace una unica verificacion final: las hojas
+de todas las partes tienen que formar el arbol de la raiz que envio el
+emisor. Las partes no se reanudan: si una sesion falla o su parte no se
+verifica, se descartan el archivo parcial y el estado del armado y se
+vuelve a transferir el archivo entero.
+"""
+
+
+def split_blocks(blocks, count) -> list[tuple[int, int]]:
+    """
+    Rangos de bloques (primero y siguiente al ultimo) de hasta count partes
+    de tamaños parecidos, sin partes vacias salvo en un archivo vacio.
+    """
+    count = max(1, min(count, blocks))
+    return [(blocks * i // count, blocks * (i + 1) // count) for i in range(count)]
+
+
+class Assembly:
+    """
+    Armado de un archivo transferido en partes. El estado (el tamaño, la
+    raiz y las hojas de las partes ya verificadas) se guarda junto al
+    archivo parcial, con el numero de armado en el nombre, y se accede
+    bloqueandolo con flock: en el servidor las sesiones de una misma
+    subida pueden caer en distintos workers (ver workers).
+    """
+
+    def __init__(self, path, assembly_id, size, algorithm, chunk_size):
+        self.path = Path(path)
+        self.assembly_id = assembly_id
+        self.size = size
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.blocks = hash_blocks(size, chunk_size)
+        self.leaves = None
+
+    def state_path(self) -> Path:
+        return Path(
+            f"{partial_path(self.path)}.{self.assembly_id:x}{ASSEMBLY_STATE_SUFFIX}"
+        )
+
+    @contextmanager
+    def lock(self):
+        fd = os.open(self.state_path(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            # Cerrar el descriptor libera el lock
+            os.close(fd)
+
+    @staticmethod
+    def read_state(fd) -> dict | None:
+        data = os.pread(fd, os.fstat(fd).st_size, 0)
+        try:
+            return json.loads(data) if data else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def write_state(fd, state):
+        os.ftruncate(fd, 0)
+        if state is not None:
+            os.pwrite(fd, json.dumps(state).encode(), 0)
+
+    def header(self) -> dict:
+        return {
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "algorithm": self.algorithm,
+        }
+
+    def prepare(self):
+        """
+        La primera parte en llegar reserva el archivo parcial, descartando
+        el de cualquier transferencia anterior. Las demas solo verifican que
+        sean del mismo archivo.
+        """
+        with self.lock() as fd:
+            state = self.read_state(fd)
+            if state is None:
+                ResumeState.discard(self.path)
+                self.discard_stale()
+                fd_partial = os.open(
+                    partial_path(self.path), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644
+                )
+                try:
+                    allocate(fd_partial, self.size)
+                finally:
+                    os.close(fd_partial)
+                self.write_state(fd, {**self.header(), "root": None, "parts": {}})
+            elif {key: state.get(key) for key in self.header()} != self.header():
+                raise ConnectionAbortedError
+
+    def discard_stale(self):
+        # Estados de armados anteriores del mismo archivo que no terminaron
+        partial = partial_path(self.path)
+        for path in partial.parent.glob(f"{partial.name}.*{ASSEMBLY_STATE_SUFFIX}"):
+            if path != self.state_path():
+                path.unlink(missing_ok=True)
+
+    def discard(self):
+        ResumeState.discard(self.path)
+        self.state_path().unlink(missing_ok=True)
+
+    def assemble(self, parts: dict) -> list[bytes] | None:
+        """
+        Hojas de todo el archivo, o None si todavia faltan partes.
+        """
+        leaves = []
+        for first, (_, part_leaves) in sorted(
+            (int(first), part) for first, part in parts.items()
+        ):
+            if first != len(leaves):
+                return None
+            leaves += split_leaves(self.algorithm, bytes.fromhex(part_leaves))
+        return leaves if len(leaves) == self.blocks else None
+
+    def add(self, block_range, leaves, root) -> bool:
+        """
+        Agrega las hojas de una parte ya verificada contra root. Si es la
+        ultima, hace la verificacion final y mueve el archivo a su ruta de
+        destino o lo descarta. Devuelve False si la parte no corresponde al
+        armado o si la verificacion final falla.
+        """
+        first, end = block_range
+        with self.lock() as fd:
+            state = self.read_state(fd)
+            if state is None:
+                # El armado ya termino
+                self.state_path().unlink(missing_ok=True)
+                return False
+            if state["root"] not in (None, root.hex()):
+                logging.warn(f"Part {first}-{end} of {self.path} does not match")
+                return False
+            state["root"] = root.hex()
+            state["parts"][str(first)] = [end, b"".join(leaves).hex()]
+            assembled = self.assemble(state["parts"])
+            if assembled is None:
+                self.write_state(fd, state)
+                return True
+
+            valid = merkle_root(self.algorithm, assembled) == root
+            if valid:
+                os.replace(partial_path(self.path), self.path)
+                self.leaves = assembled
+            else:
+                logging.error(f"❌ Assembled {self.path} does not match its root")
+                ResumeState.discard(self.path)
+            # Vacio por si otra sesion ya espera el lock sobre este estado
+            self.write_state(fd, None)
+            self.state_path().unlink(missing_ok=True)
+            return valid
@@ -0,0 +1,161 @@
+from lib.constants import ENGINE_SOCKET_BUFFER_SIZE
+from socket import SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+from lib.message import Message
+from functools import partial
+import asyncio
+import logging
+
+
+class LoopTimers:
+    """
+    Timers de retransmision sobre el event loop, con la misma interfaz que
+    TimerWheel. Los callbacks corren en el loop, junto con las sesiones.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handles = {}
+
+    def arm(self, key, delay, callback):
+        self.cancel(key)
+        self.handles[key] = self.loop.call_later(delay, self.fire, key, callback)
+
+    def fire(self, key, callback):
+        self.handles.pop(key, None)
+        callback()
+
+    def cancel(self, key):
+        handle = self.handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    def __len__(self):
+        return len(self.handles)
+
+
+class SessionTransport:
+    """
+    Transporte de una sesion del motor asyncio. Todas las sesiones envian
+    por el socket del servidor, y el motor les reparte los mensajes que
+    llegan segun la direccion del cliente. receive espera en la cola de la
+    sesion con el timeout configurado, y offload ejecuta las operaciones
+    de disco que pueden bloquear en un thread del executor del loop.
+    """
+
+    def __init__(self, engine, address):
+        self.engine = engine
+        self.address = address
+        self.queue = asyncio.Queue()
+        self.timeout = None
+
+    def send(self, message: Message, address):
+        self.engine.udp.sendto(b"".join((message.header(), message.payload)), address)
+
+    def send_batch(self, messages: list[Message], address):
+        for message in messages:
+            self.send(message, address)
+
+    async def receive(self) -> tuple[Message, tuple]:
+        async with asyncio.timeout(self.timeout):
+            return await self.queue.get()
+
+    async def offload(self, function, *args, **kwargs):
+        return await self.engine.loop.run_in_executor(
+            None, partial(function, *args, **kwargs)
+        )
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+    def timers(self):
+        return self.engine.timers
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+
+class AsyncEngine(asyncio.DatagramProtocol):
+    """
+    Motor del servidor basado en asyncio: un solo socket atiende todas las
+    sesiones, Stop & Wait o Selective Repeat, cada una como una tarea del
+    event loop en lugar de un thread con su propio socket. Las respuestas
+    al handshake salen del puerto del servidor, por lo que el cliente sigue
+    la transferencia con ese mismo puerto. Las solicitudes repetidas de un
+    cliente con una sesion abierta se ignoran, y las que superan los limites
+    de sesiones se rechazan con un BUSY, como en el motor con threads.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.handlers = server.handlers()
+        self.sessions: dict[tuple, SessionTransport] = {}
+        self.tasks = set()
+        self.loop = None
+        self.udp = None
+        self.timers = None
+
+    def run(self):
+        logging.warn(f"🚀 Server is listening on port {self.server.port} (asyncio)")
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logging.warn("🛑 Shutting down server")
+        finally:
+            self.server.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.timers = LoopTimers(self.loop)
+        if self.server.gso:
+            logging.warn("UDP GSO/GRO is not used by the asyncio engine")
+        # Un solo socket recibe las rafagas de todas las sesiones
+        for option in (SO_RCVBUF, SO_SNDBUF):
+            self.server.socket.setsockopt(SOL_SOCKET, option, ENGINE_SOCKET_BUFFER_SIZE)
+        self.udp, _ = await self.loop.create_datagram_endpoint(
+            lambda: self, sock=self.server.socket
+        )
+        try:
+            await self.loop.create_future()
+        finally:
+            self.udp.close()
+
+    def datagram_received(self, data, address):
+        try:
+            message = Message.decode(data)
+        except Exception:
+            return
+
+        session = self.sessions.get(address)
+        if session is not None:
+            if message.type not in self.handlers:
+                session.queue.put_nowait((message, address))
+            return
+
+        handler = self.handlers.get(message.type)
+        if handler is None:
+            return
+        if not self.server.admission.admit(address):
+            self.udp.sendto(self.server.reject(address).encode(), address)
+            return
+        session = SessionTransport(self, address)
+        self.sessions[address] = session
+        task = self.loop.create_task(self.run_session(handler, session, message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_session(self, handler, session: SessionTransport, handshake_req):
+        try:
+            await handler(session, session.address, handshake_req)
+        except Exception as e:
+            logging.error(
+                f"❌ {session.address[0]}:{session.address[1]} session failed: {e}"
+            )
+        finally:
+            self.sessions.pop(session.address, None)
+            self.server.admission.close(session.address)
+
+    def error_received(self, exc):
+        logging.error(f"Socket error: {exc}")
@@ -0,0 +1,204 @@
+from lib.constants import (
+    BLOCK_CACHE_BLOCK_SIZE,
+    BLOCK_CACHE_READAHEAD,
+    BLOCK_CACHE_THREADS,
+    BLOCK_CACHE_WARM_BLOCKS,
+)
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
+from math import ceil
+import logging
+import os
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}
+
+"""
+Cache de bloques
+Las descargas leen los archivos a traves de una cache de bloques de
+BLOCK_CACHE_BLOCK_SIZE bytes compartida por todas las sesiones del
+proceso, acotada en tamaño, de la que se descartan los bloques usados hace
+mas tiempo. Al pasar a un bloque nuevo, una sesion encola en un pool de
+threads la lectura de los BLOCK_CACHE_READAHEAD siguientes, por lo que los
+paquetes se arman con datos que ya estan en memoria y el envio no espera
+al disco (con el motor asyncio, una lectura lenta frena a todas las
+sesiones). Los bloques se identifican por el dispositivo, el inodo, el
+tamaño y el mtime_ns del archivo abierto, por lo que una nueva version de
+un archivo no usa los bloques de la anterior.
+
+Un cliente puede avisar en la solicitud de descarga (opcion PREFETCH) que
+archivos va a pedir despues, y el servidor carga mientras tanto sus
+primeros BLOCK_CACHE_WARM_BLOCKS bloques; en un lote se cargan los del
+archivo siguiente mientras se envia cada uno.
+"""
+
+
+def parse_size(value: str) -> int:
+    """
+    Tamaño en bytes, con sufijo K, M o G opcional (256M = 256 MiB).
+    """
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+    size = float(value[: len(value) - len(unit)]) * SIZE_UNITS[unit]
+    if size < 0:
+        raise ValueError(f"Invalid size: {value}")
+    return int(size)
+
+
+class BlockCache:
+    """
+    Se puede compartir entre threads. Los bloques que se estan leyendo
+    tienen un Future en loading, para que otra sesion que los pida espere
+    esa lectura en lugar de repetirla.
+    """
+
+    def __init__(self, capacity, block_size=BLOCK_CACHE_BLOCK_SIZE):
+        self.capacity = capacity
+        self.block_size = block_size
+        self.blocks: OrderedDict[tuple, bytes] = OrderedDict()
+        self.loading: dict[tuple, Future] = {}
+        self.size = 0
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(
+            max_workers=BLOCK_CACHE_THREADS, thread_name_prefix="block-cache"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+
+    @staticmethod
+    def key(source) -> tuple:
+        stat = os.fstat(source.file.fileno())
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def claim(self, key, index) -> Future | None:
+        """
+        Future para leer un bloque que no esta en la cache ni se esta
+        leyendo, o None. Se llama con el lock tomado.
+        """
+        if (key, index) in self.blocks or (key, index) in self.loading:
+            return None
+        future = self.loading[(key, index)] = Future()
+        return future
+
+    def fill(self, key, source, index, future):
+        offset = index * self.block_size
+        try:
+            data = bytes(source.view[offset : offset + self.block_size])
+        except (ValueError, OSError, BufferError) as e:
+            # El archivo de la sesion que pidio el bloque ya se cerro
+            with self.lock:
+                self.loading.pop((key, index), None)
+            future.set_exception(e)
+            return
+        with self.lock:
+            self.loading.pop((key, index), None)
+            self.blocks[(key, index)] = data
+            self.size += len(data)
+            while self.size > self.capacity and self.blocks:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        future.set_result(data)
+
+    def get(self, key, source, index) -> bytes:
+        with self.lock:
+            data = self.blocks.get((key, index))
+            if data is not None:
+                self.blocks.move_to_end((key, index))
+                self.hits += 1
+                return data
+            self.misses += 1
+            future = self.claim(key, index)
+            owner = future is not None
+            if not owner:
+                future = self.loading[(key, index)]
+        if owner:
+            self.fill(key, source, index, future)
+        try:
+            return future.result()
+        except (ValueError, OSError, BufferError):
+            if owner:
+                raise
+            # Fallo la lectura de otra sesion: se lee con el archivo de esta
+            return self.get(key, source, index)
+
+    def prefetch(self, key, source, first, count=BLOCK_CACHE_READAHEAD):
+        last = min(first + count, ceil(source.size / self.block_size))
+        with self.lock:
+            claimed = [
+                (index, future)
+                for index in range(first, last)
+                if (future := self.claim(key, index)) is not None
+            ]
+            self.prefetched += len(claimed)
+        for index, future in claimed:
+            self.pool.submit(self.fill, key, source, index, future)
+
+    def warm(self, open_source, path):
+        """
+        Carga en segundo plano los primeros bloques de un archivo que un
+        cliente va a pedir. open_source abre el archivo (ver Server).
+        """
+        self.pool.submit(self.load_file, open_source, path)
+
+    def load_file(self, open_source, path):
+        try:
+            with open_source(path) as source:
+                key = self.key(source)
+                blocks = min(
+                    BLOCK_CACHE_WARM_BLOCKS, ceil(source.size / self.block_size)
+                )
+                for index in range(blocks):
+                    with self.lock:
+                        future = self.claim(key, index)
+                        if future is not None:
+                            self.prefetched += 1
+                    if future is not None:
+                        self.fill(key, source, index, future)
+        except OSError as e:
+            logging.info(f"Could not prefetch {path}: {e}")
+
+    def __str__(self):
+        return (
+            f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+            f"{self.prefetched} blocks read ahead, {self.size}/{self.capacity} bytes"
+        )
+
+
+class CachedFile:
+    """
+    MappedFile cuyos paquetes se arman sobre los bloques de la cache. Los
+    paquetes que cruzan el limite entre dos bloques se copian.
+    """
+
+    def __init__(self, file, cache: BlockCache):
+        self.file = file
+        self.cache = cache
+        self.key = cache.key(file)
+        self.chunk_size = file.chunk_size
+        self.size = file.size
+        self.packets = file.packets
+        self.current = None
+
+    def block(self, index) -> bytes:
+        if index != self.current:
+            self.current = index
+            self.cache.prefetch(self.key, self.file, index + 1)
+        return self.cache.get(self.key, self.file, index)
+
+    def packet(self, index) -> memoryview:
+        block_size = self.cache.block_size
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, self.size)
+        first, offset = divmod(start, block_size)
+        data = self.block(first)
+        if end <= (first + 1) * block_size:
+            return memoryview(data)[offset : offset + end - start]
+        return memoryview(
+            data[offset:] + self.block(first + 1)[: end - (first + 1) * block_size]
+        )
+
+    def packet_length(self, index):
+        return self.file.packet_length(index)
@@ -0,0 +1,367 @@
+from lib.constants import (
+    CHUNK_GC_GRACE,
+    CHUNK_HASH_ALGORITHM,
+    CHUNK_ID_SIZE,
+    CHUNK_INDEX_SUFFIX,
+    CHUNK_OPEN_MAPS,
+    CHUNK_REFS_FILENAME,
+    CHUNK_SIZE,
+    CHUNK_STORE_DIRNAME,
+    DEFAULT_PAYLOAD_SIZE,
+    MAX_OFFERED_CHUNKS,
+    READ_BINARY_MODE,
+)
+from lib.delta import copy_range
+from lib.file_hashing import hash_block_size, hash_blocks, new_hash
+from lib.mapped_file import MappedFile
+from lib.preallocated_file import allocate
+from lib.resume_state import ResumeState, partial_path
+from collections import OrderedDict
+from contextlib import contextmanager
+from mmap import mmap, ACCESS_READ
+from threading import Lock, get_ident
+from pathlib import Path
+from math import ceil
+from time import time
+import logging
+import fcntl
+import json
+import os
+
+"""
+Almacen de chunks
+Con el almacen de chunks, el servidor guarda cada archivo subido partido en
+chunks de CHUNK_SIZE bytes, con el hash de su contenido como nombre, por
+lo que un chunk que aparece en varios archivos (o en varias versiones de un
+mismo archivo) se guarda una sola vez. En lugar del archivo queda su
+indice (<archivo>.chunks), con su tamaño y la lista de sus chunks, y las
+descargas lo leen de los chunks sin volver a armarlo (ver ChunkedFile). Los
+archivos que todavia no pasaron al almacen, como los que ya estaban antes
+de activarlo, se siguen leyendo tal cual.
+
+Cada chunk lleva la cuenta de los indices que lo usan. Los que dejan de
+usarse se borran recien despues de CHUNK_GC_GRACE segundos, para no romper
+las descargas en curso de la version anterior de un archivo, y vuelven a
+usarse si aparecen en otro archivo antes de eso. Las cuentas se guardan en
+el almacen y se actualizan bloqueandolas con flock, porque los workers
+comparten el almacen (ver workers).
+
+En la subida, el cliente ofrece los ids de los primeros MAX_OFFERED_CHUNKS
+chunks de su archivo (los primeros CHUNK_ID_SIZE bytes de su hash) y el
+servidor copia al archivo parcial los que ya tiene. Los bloques del arbol
+de hashes que quedan cubiertos se responden como bloques ya recibidos,
+igual que al reanudar, y el cliente no los envia. Como sus hojas se
+comparan con las del cliente, un id que coincide con el de otro chunk solo
+hace que el bloque se vuelva a pedir.
+"""
+
+
+def index_path(path) -> Path:
+    return Path(str(path) + CHUNK_INDEX_SUFFIX)
+
+
+def chunk_digest(data) -> str:
+    digest = new_hash(CHUNK_HASH_ALGORITHM)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def offered_chunk_ids(data) -> list[bytes]:
+    """
+    Ids de los primeros chunks de los datos de un archivo a subir.
+    """
+    end = min(len(data), MAX_OFFERED_CHUNKS * CHUNK_SIZE)
+    return [
+        bytes.fromhex(chunk_digest(data[offset : offset + CHUNK_SIZE]))[:CHUNK_ID_SIZE]
+        for offset in range(0, end, CHUNK_SIZE)
+    ]
+
+
+def encode_chunk_ids(chunk_ids) -> bytes:
+    return b"".join(chunk_ids)
+
+
+def decode_chunk_ids(value) -> list[bytes]:
+    return [
+        bytes(value[offset : offset + CHUNK_ID_SIZE])
+        for offset in range(0, len(value) - CHUNK_ID_SIZE + 1, CHUNK_ID_SIZE)
+    ][:MAX_OFFERED_CHUNKS]
+
+
+def covered_blocks(ranges, size, chunk_size) -> list[int]:
+    """
+    Bloques del arbol de hashes de un archivo de ese tamaño que quedan
+    enteros dentro de los rangos de bytes, ordenados y sin superponerse.
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    block_size = hash_block_size(chunk_size)
+    blocks = []
+    for start, end in merged:
+        first = ceil(start / block_size)
+        for block in range(first, hash_blocks(size, chunk_size)):
+            if min((block + 1) * block_size, size) > end:
+                break
+            blocks.append(block)
+    return blocks
+
+
+class ChunkStore:
+    def __init__(self, storage_path):
+        self.root = Path(storage_path) / CHUNK_STORE_DIRNAME
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.refs_path = self.root / CHUNK_REFS_FILENAME
+
+    def chunk_path(self, digest) -> Path:
+        return self.root / digest[:2] / digest
+
+    def find(self, chunk_id) -> Path | None:
+        prefix = chunk_id.hex()
+        return next((self.root / prefix[:2]).glob(prefix + "*"), None)
+
+    def temporary_path(self, path) -> Path:
+        # Unico por proceso y thread, por si se escribe lo mismo a la vez
+        return path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.tmp")
+
+    def write(self, path, data):
+        temporary_path = self.temporary_path(path)
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+    def store(self, data) -> str:
+        digest = chunk_digest(data)
+        path = self.chunk_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            self.write(path, data)
+        return digest
+
+    @contextmanager
+    def refs(self):
+        """
+        Cuentas de referencias de los chunks y chunks sin usar desde cuando,
+        bloqueadas mientras dura el contexto y guardadas al salir.
+        """
+        fd = os.open(self.root / (CHUNK_REFS_FILENAME + ".lock"), os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                with open(self.refs_path) as file:
+                    refs = json.load(file)
+            except FileNotFoundError:
+                refs = {"refs": {}, "unused": {}}
+            yield refs
+            self.write(self.refs_path, json.dumps(refs).encode())
+        finally:
+            # Cerrar el descriptor libera el lock
+            os.close(fd)
+
+    @staticmethod
+    def load_index(path) -> dict | None:
+        try:
+            with open(index_path(path)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def ingest(self, path) -> bool:
+        """
+        Pasa al almacen el archivo recien subido a path: guarda los chunks
+        que falten, reemplaza el indice anterior y borra el archivo. Devuelve
+        False si mientras tanto se subio otra version, que lo reemplaza.
+        """
+        with open(path, READ_BINARY_MODE) as file:
+            stat = os.fstat(file.fileno())
+            digests = []
+            while data := file.read(CHUNK_SIZE):
+                digests.append(self.store(data))
+            with self.refs() as refs:
+                if not self.is_current(path, stat):
+                    for digest in digests:
+                        if digest not in refs["refs"]:
+                            refs["unused"][digest] = time()
+                    return False
+                for index, digest in enumerate(digests):
+                    # Un chunk sin usar que se borro mientras tanto se vuelve
+                    # a guardar
+                    if not self.chunk_path(digest).exists():
+                        self.store(
+                            os.pread(file.fileno(), CHUNK_SIZE, index * CHUNK_SIZE)
+                        )
+                    refs["unused"].pop(digest, None)
+                    refs["refs"][digest] = refs["refs"].get(digest, 0) + 1
+                previous = self.load_index(path)
+                self.write(
+                    index_path(path),
+                    json.dumps(
+                        {
+                            "size": stat.st_size,
+                            "chunk_size": CHUNK_SIZE,
+                            "chunks": digests,
+                        }
+                    ).encode(),
+                )
+                os.unlink(path)
+                self.release(refs, previous["chunks"] if previous else [])
+        logging.info(f"🧱 {path} stored as {len(digests)} chunks")
+        return True
+
+    @staticmethod
+    def is_current(path, stat) -> bool:
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return (current.st_ino, current.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+
+    def release(self, refs, digests):
+        """
+        Descuenta las referencias de un indice reemplazado y borra los chunks
+        que llevan mas de CHUNK_GC_GRACE segundos sin usarse.
+        """
+        now = time()
+        for digest in digests:
+            count = refs["refs"].get(digest, 0) - 1
+            if count > 0:
+                refs["refs"][digest] = count
+            else:
+                refs["refs"].pop(digest, None)
+                refs["unused"][digest] = now
+        for digest, since in list(refs["unused"].items()):
+            if now - since >= CHUNK_GC_GRACE:
+                self.chunk_path(digest).unlink(missing_ok=True)
+                del refs["unused"][digest]
+
+    def prefill(self, path, size, chunk_ids, chunk_size) -> list[int]:
+        """
+        Copia al archivo parcial de una subida a path los chunks ofrecidos
+        que ya estan en el almacen. Devuelve los bloques del arbol de hashes
+        (con paquetes de chunk_size) que quedan completos.
+        """
+        found = []
+        for index, chunk_id in enumerate(chunk_ids):
+            offset = index * CHUNK_SIZE
+            if offset >= size:
+                break
+            chunk = self.find(chunk_id)
+            if chunk is not None:
+                found.append((offset, min(offset + CHUNK_SIZE, size), chunk))
+        if not found:
+            return []
+
+        ResumeState.discard(path)
+        copied = []
+        fd = os.open(partial_path(path), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            allocate(fd, size)
+            for start, end, chunk in found:
+                try:
+                    with open(chunk, READ_BINARY_MODE) as source:
+                        if os.fstat(source.fileno()).st_size != end - start:
+                            continue
+                        if copy_range(source.fileno(), 0, fd, start, end - start) == (
+                            end - start
+                        ):
+                            copied.append((start, end))
+                except FileNotFoundError:
+                    # Se borro por no usarse
+                    continue
+        finally:
+            os.close(fd)
+        return covered_blocks(copied, size, chunk_size)
+
+    def open(self, path, chunk_size=DEFAULT_PAYLOAD_SIZE) -> "ChunkedFile":
+        return ChunkedFile(self, path, chunk_size)
+
+
+class ChunkedView:
+    """
+    Vista de solo lectura sobre el contenido de un ChunkedFile, que solo
+    admite largo y rebanadas.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def __len__(self):
+        return self.file.size
+
+    def __getitem__(self, key: slice) -> memoryview:
+        start, stop, _ = key.indices(self.file.size)
+        return self.file.read(start, stop)
+
+    def release(self):
+        pass
+
+
+class ChunkedFile(MappedFile):
+    """
+    Archivo del almacen a enviar, con la interfaz de MappedFile. Los
+    paquetes se arman con vistas sobre el mapeo de su chunk, o se copian si
+    cruzan el limite entre dos chunks. Se mantienen mapeados los ultimos
+    CHUNK_OPEN_MAPS chunks usados. file es el indice, que identifica la
+    version del archivo (ver digest_cache).
+    """
+
+    def __init__(self, store, path, chunk_size=DEFAULT_PAYLOAD_SIZE):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.file = open(index_path(path), READ_BINARY_MODE)
+        try:
+            index = json.load(self.file)
+            self.size = index["size"]
+            self.chunk_length = index["chunk_size"]
+            self.chunks = index["chunks"]
+        except (ValueError, KeyError, TypeError):
+            self.file.close()
+            raise OSError(f"Invalid chunk index for {path}")
+        self.packets = ceil(self.size / chunk_size)
+        self.maps: OrderedDict[int, tuple] = OrderedDict()
+        self.lock = Lock()
+        self.view = ChunkedView(self)
+
+    def chunk(self, index) -> memoryview:
+        with self.lock:
+            if index in self.maps:
+                self.maps.move_to_end(index)
+                return self.maps[index][1]
+            with open(
+                self.store.chunk_path(self.chunks[index]), READ_BINARY_MODE
+            ) as file:
+                chunk_map = mmap(file.fileno(), 0, access=ACCESS_READ)
+            self.maps[index] = (chunk_map, memoryview(chunk_map))
+            while len(self.maps) > CHUNK_OPEN_MAPS:
+                self.unmap(*self.maps.popitem(last=False)[1])
+            return self.maps[index][1]
+
+    @staticmethod
+    def unmap(chunk_map, view):
+        view.release()
+        try:
+            chunk_map.close()
+        except BufferError:
+            # Todavia hay paquetes armados sobre el mapeo: se libera al
+            # recolectarlos
+            pass
+
+    def read(self, start, stop) -> memoryview:
+        parts = []
+        while start < stop:
+            index, offset = divmod(start, self.chunk_length)
+            end = min(stop, (index + 1) * self.chunk_length)
+            parts.append(self.chunk(index)[offset : offset + end - start])
+            start = end
+        if len(parts) == 1:
+            return parts[0]
+        return memoryview(b"".join(parts))
+
+    def close(self):
+        with self.lock:
+            while self.maps:
+                self.unmap(*self.maps.popitem()[1])
+        self.file.close()
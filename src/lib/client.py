@@ -1,19 +1,72 @@
 from lib.constants import (
+    DEFAULT_HASH_ALGORITHM,
+    DEFAULT_PAYLOAD_SIZE,
     FILE_NOT_FOUND_ERROR,
+    HASH_ALGORITHMS,
+    MAX_BUSY_RETRIES,
     MAX_CONSECUTIVE_LOSTS,
+    MAX_PAYLOAD_SIZE,
     SOCKET_TIME_OUT,
-    RECV_BUFFER_SIZE,
 )
 from socket import socket, AF_INET, SOCK_DGRAM
+import errno
 from lib.message import Message, MessageType
+from lib.handshake import (
+    HandshakeOption,
+    TransferOptions,
+    decode_int,
+    encode_bitmap,
+    encode_filenames,
+    encode_int,
+    encode_names,
+    encode_prefetch,
+    encode_request,
+    encode_sizes,
+    encode_stream,
+    split_batch,
+)
+from lib.assembly import Assembly, split_blocks
+from lib.delta import Signature, encode_delta_base, write_delta
+from lib.chunk_store import encode_chunk_ids, offered_chunk_ids
+from lib.fec import encode_fec
+from lib.path_mtu import MtuProbe
+from lib.rtt_estimator import RttEstimator
+from lib.resume_state import ResumeState
+from lib.transport import create_transport, run_blocking
+from lib.file_transfer import (
+    TransferSource,
+    is_invalid_checksum,
+    receive_file,
+    send_file,
+)
+from lib.preallocated_file import PreallocatedFile
+from lib.file_hashing import hash_blocks, hash_in_background
+from lib.mapped_file import MappedFile
+from concurrent.futures import ThreadPoolExecutor
 from shutil import disk_usage
-from random import randint
+from tempfile import TemporaryDirectory
+from random import getrandbits, randint
+from copy import copy
 from pathlib import Path
+from time import monotonic, sleep
 from tqdm import tqdm
 from abc import ABC
 import logging
 
 
+def read_manifest(path) -> list[str]:
+    """
+    Nombres de archivo de un manifiesto: uno por linea, ignorando las lineas
+    vacias y las que empiezan con #.
+    """
+    with open(path) as file:
+        return [
+            line.strip()
+            for line in file
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+
 class NullProgressBar:
     def refresh(*args, **_):
         return
@@ -26,58 +79,215 @@ class NullProgressBar:
 
 
 class Client(ABC):
-    def __init__(self, server_address, server_port, print_progress_bar):
+    """
+    payload_size es el mayor tamaño de payload que se ofrece al servidor.
+    Con probe_mtu se busca ademas el mayor que pase por el camino (ver
+    path_mtu), empezando por payload_size o, si no se indica, por
+    MAX_PAYLOAD_SIZE.
+
+    Con dedup, las subidas ofrecen los ids de los chunks del archivo para
+    que el servidor no pida los que ya tiene (ver chunk_store).
+    """
+
+    def __init__(
+        self,
+        server_address,
+        server_port,
+        print_progress_bar,
+        gso=False,
+        hash_algorithm=DEFAULT_HASH_ALGORITHM,
+        payload_size=None,
+        probe_mtu=False,
+        compression=None,
+        dedup=False,
+    ):
         self.server_address = server_address
         self.server_port = server_port
+        self.gso = gso
+        self.open_socket()
+        self.print_progress_bar = print_progress_bar
+        self.rtt = RttEstimator()
+        self.hash_algorithm = hash_algorithm
+        self.busy_retries = 0
+        self.fec = None
+        self.probe_mtu = probe_mtu
+        self.compression = compression
+        self.dedup = dedup
+        self.payload_size = payload_size or (
+            MAX_PAYLOAD_SIZE if probe_mtu else DEFAULT_PAYLOAD_SIZE
+        )
+
+    def open_socket(self):
+        # Cada sesion usa un socket nuevo (ver download_batch)
         self.socket = socket(AF_INET, SOCK_DGRAM)
         self.socket.settimeout(SOCKET_TIME_OUT)
-        self.print_progress_bar = print_progress_bar
+        self.transport = create_transport(self.socket, self.gso)
 
     def full_server_address(self):
         return (self.server_address, self.server_port)
 
-    def establish_download_connection(self, filename):
-        packet_number = 0
+    def offered_hash_algorithms(self):
+        # El elegido primero y despues el resto, por si el servidor no lo acepta
+        return [self.hash_algorithm] + [
+            algorithm
+            for algorithm in HASH_ALGORITHMS
+            if algorithm != self.hash_algorithm
+        ]
+
+    def offered_options(self) -> dict:
+        options = {
+            HandshakeOption.HASH_ALGORITHMS: encode_names(
+                self.offered_hash_algorithms()
+            )
+        }
+        if self.fec:
+            options[HandshakeOption.FEC] = encode_fec(self.fec)
+        if self.compression:
+            options[HandshakeOption.COMPRESSIONS] = encode_names([self.compression])
+        return options
+
+    def check_options(self, options: TransferOptions):
+        logging.info(f"📏 {options.payload_size} byte packets")
+        if self.fec and not options.fec:
+            logging.warn("FEC is not supported by the server, transferring without it")
+        elif options.fec:
+            logging.info(f"🧩 FEC {options.fec[0]}+{options.fec[1]}")
+        if self.compression and not options.compression:
+            logging.warn(
+                f"{self.compression} compression is not supported by the server, transferring without it"
+            )
+        elif options.compression:
+            logging.info(f"🗜️ {options.compression} compression")
+
+    def wait_if_busy(self, message: Message) -> bool:
+        """
+        Si el servidor rechazo la solicitud por estar ocupado (BUSY), espera
+        los milisegundos que indica antes de reintentarla. Los rechazos no
+        cuentan como perdidas, pero despues de MAX_BUSY_RETRIES se desiste.
+        """
+        if message.type != MessageType.BUSY:
+            return False
+        self.busy_retries += 1
+        if self.busy_retries > MAX_BUSY_RETRIES:
+            self.socket.close()
+            raise ConnectionRefusedError("Server is busy")
+        logging.warn(f"⏳ Server is busy, retrying in {message.pos} ms")
+        sleep(message.pos / 1000)
+        return True
+
+    def send_request(
+        self, message_type, packet_number, filename, options: dict, probe_mtu=True
+    ) -> tuple[Message, tuple]:
+        """
+        Envia la solicitud hasta recibir la respuesta del servidor, ofreciendo
+        el tamaño de payload; al probar el MTU, el ofrecido baja con cada
+        candidato que no pasa.
+        """
+        probe = MtuProbe(self.socket, self.payload_size) if probe_mtu else None
         consecutive_losts = 0
+        try:
+            while True:
+                payload_size = probe.payload_size if probe else self.payload_size
+                options[HandshakeOption.PAYLOAD_SIZE] = encode_int(payload_size)
+                handshake_req = Message(
+                    message_type,
+                    pos=packet_number,
+                    payload=encode_request(
+                        filename, options, payload_size if probe else 0
+                    ),
+                )
+                # Los candidatos que no pasan no hacen crecer la espera del siguiente
+                self.socket.settimeout(
+                    self.rtt.timeout(probe.attempts if probe else consecutive_losts)
+                )
+                sent_at = monotonic()
+                try:
+                    self.transport.send(handshake_req, self.full_server_address())
+                except OSError as e:
+                    if e.errno != errno.EMSGSIZE or not probe or not probe.step_down():
+                        raise
+                    continue
+                try:
+                    message, address = self.transport.recv()
+                except TimeoutError:
+                    consecutive_losts += 1
+                    if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
+                        raise ConnectionAbortedError
+                    if probe:
+                        probe.on_timeout()
+                else:
+                    if consecutive_losts == 0:
+                        self.rtt.sample(monotonic() - sent_at)
+                    if self.wait_if_busy(message):
+                        consecutive_losts = 0
+                        continue
+                    return message, address
+        finally:
+            if probe:
+                probe.close()
+
+    def establish_download_connection(
+        self,
+        filename,
+        resume_state=None,
+        filenames=None,
+        stream=None,
+        signature=False,
+        hints=(),
+    ):
+        packet_number = 0
 
-        handshake_req = Message(
+        options = self.offered_options()
+        if hints:
+            # Archivos que se van a pedir despues (ver block_cache)
+            options[HandshakeOption.PREFETCH] = encode_prefetch(hints)
+        if signature:
+            options[HandshakeOption.SIGNATURE] = b""
+        if filenames:
+            options[HandshakeOption.FILENAMES] = encode_filenames(filenames)
+        if stream:
+            options[HandshakeOption.STREAM] = encode_stream(stream)
+        if resume_state:
+            # El servidor solo acepta los bloques si el archivo no cambio de
+            # tamaño y se vuelve a usar el mismo tamaño de paquete
+            self.payload_size = resume_state.chunk_size
+            options[HandshakeOption.FILE_SIZE] = encode_int(resume_state.size)
+            options[HandshakeOption.RESUME_BLOCKS] = encode_bitmap(
+                resume_state.resumable_blocks(
+                    resume_state.size, resume_state.chunk_size
+                )
+            )
+        print("Enviando solicitud")
+        handshake_res, real_server_address = self.send_request(
             MessageType.DOWNLOAD,
-            pos=packet_number,
-            payload=filename.encode(),
+            packet_number,
+            filename,
+            options,
+            self.probe_mtu and not resume_state,
         )
 
-        while True:
-            self.socket.sendto(handshake_req.encode(), self.full_server_address())
-            print("Enviando solicitud")
-            try:
-                recv_bytes, real_server_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-            except TimeoutError:
-                consecutive_losts += 1
-                if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
-                    raise ConnectionAbortedError
-            else:
-                break
-
-        handshake_res = Message.decode(recv_bytes)
-        payload = int.from_bytes(handshake_res.payload, byteorder="big")
-
-        if handshake_res.type == MessageType.ERROR and payload == FILE_NOT_FOUND_ERROR:
+        if (
+            handshake_res.type == MessageType.ERROR
+            and decode_int(handshake_res.payload) == FILE_NOT_FOUND_ERROR
+        ):
             self.socket.close()
             raise FileNotFoundError
 
         if handshake_res.type != MessageType.OK:
             error = Message(MessageType.ERROR, pos=0)
-            self.socket.sendto(error.encode(), real_server_address)
+            self.transport.send(error, real_server_address)
             self.socket.close()
             raise ConnectionAbortedError
 
         packet_number = handshake_res.pos
         handshake_end = Message(MessageType.ACK, pos=packet_number)
-        self.socket.sendto(handshake_end.encode(), real_server_address)
+        self.transport.send(handshake_end, real_server_address)
 
         logging.info("✅ Connected successfuly to the server")
 
-        return packet_number, real_server_address, payload
+        options = TransferOptions.decode(handshake_res.payload)
+        self.check_options(options)
+        return packet_number, real_server_address, options
 
     def start_progress_bar(self, filename, file_size):
         if self.print_progress_bar:
@@ -96,41 +306,48 @@ class Client(ABC):
     solicitar el reintento.
 
     El archivo descargado lo guarda en la ruta de destino
-    especificada
+    especificada. Si se interrumpe, queda el archivo parcial con el estado
+    para reanudar la descarga la proxima vez.
     """
 
-    def download(self, filename: str, destination_path: str):
+    def download(self, filename: str, destination_path: str, hints=()):
         Path(destination_path).mkdir(parents=True, exist_ok=True)
         full_path_to_file = destination_path + "/" + filename
 
         (
             packet_number,
             real_server_address,
-            file_size,
-        ) = self.establish_download_connection(filename)
+            options,
+        ) = self.establish_download_connection(
+            filename, ResumeState.load(full_path_to_file), hints=hints
+        )
+        file_size = options.file_size
+        if options.resume_blocks:
+            logging.warn(
+                f"⏯️ Resuming download, {len(options.resume_blocks)} blocks already downloaded"
+            )
 
         total, used, free = disk_usage(destination_path)
         if free < file_size:
             error = Message(MessageType.ERROR, pos=0)
-            self.socket.sendto(error.encode(), real_server_address)
+            self.transport.send(error, real_server_address)
             self.socket.close()
             raise SystemError
 
         progress_bar = self.start_progress_bar(filename, file_size)
 
         try:
-            self.download_loop(packet_number, full_path_to_file, progress_bar)
+            self.download_loop(packet_number, full_path_to_file, options, progress_bar)
         except EOFError:
             logging.error(f"❌ Downloaded {filename} file has invalid checksum")
-            Path.unlink(Path(full_path_to_file), missing_ok=True)
         except (TimeoutError, KeyboardInterrupt):
-            Path.unlink(Path(full_path_to_file), missing_ok=True)
             error = Message(MessageType.ERROR, pos=0)
-            self.socket.sendto(error.encode(), real_server_address)
+            self.transport.send(error, real_server_address)
             logging.error(f"❌ Download of file \033[1m{filename}\033[0;0m cancelled")
         else:
             logging.warn(f"✅ File \033[1m{filename}\033[0;0m successfuly downloaded")
         finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
             progress_bar.close()
             self.socket.close()
 
@@ -140,49 +357,90 @@ class Client(ABC):
     solicitar el reintento.
     """
 
-    def upload(self, filename: str, source_path: str):
-        upload_file_path = Path(source_path + "/" + filename)
-        if not upload_file_path.is_file():
-            self.socket.close()
-            raise FileNotFoundError
-
+    def establish_upload_connection(
+        self,
+        filename,
+        file_size,
+        stream=None,
+        assembly_id=None,
+        delta_base=None,
+        chunk_ids=None,
+    ):
         packet_number = randint(0, 10000)
-        handshake_req = Message(
-            MessageType.UPLOAD,
-            pos=packet_number,
-            payload=filename.encode(),
+        options = {
+            HandshakeOption.FILE_SIZE: encode_int(file_size),
+            **self.offered_options(),
+        }
+        if stream:
+            options[HandshakeOption.STREAM] = encode_stream(stream)
+            options[HandshakeOption.ASSEMBLY] = encode_int(assembly_id)
+        if delta_base:
+            options[HandshakeOption.DELTA] = encode_delta_base(delta_base)
+        if chunk_ids:
+            options[HandshakeOption.CHUNKS] = encode_chunk_ids(chunk_ids)
+        handshake_end, real_server_address = self.send_request(
+            MessageType.UPLOAD, packet_number, filename, options, self.probe_mtu
         )
 
-        consecutive_losts = 0
-
-        while True:
-            self.socket.sendto(handshake_req.encode(), self.full_server_address())
-            try:
-                recv_bytes, real_server_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-            except TimeoutError:
-                consecutive_losts += 1
-                if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
-                    raise ConnectionAbortedError
-            else:
-                break
-
-        handshake_end = Message.decode(recv_bytes)
-
         if handshake_end.type != MessageType.ACK or handshake_end.pos != packet_number:
             error = Message(MessageType.ERROR, pos=0)
-            self.socket.sendto(error.encode(), real_server_address)
+            self.transport.send(error, real_server_address)
             self.socket.close()
             raise ConnectionAbortedError
 
+        options = TransferOptions.decode(handshake_end.payload)
+        options.file_size = file_size
+        self.check_options(options)
+        return packet_number, real_server_address, options
+
+    def upload(self, filename: str, source_path: str):
+        upload_file_path = Path(source_path + "/" + filename)
+        if not upload_file_path.is_file():
+            self.socket.close()
+            raise FileNotFoundError
+        self.send_upload(filename, upload_file_path)
+
+    def send_upload(self, filename, upload_file_path, delta_base=None):
+        """
+        Sube upload_file_path con el nombre filename. Con delta_base, es un
+        delta contra esa copia del servidor (ver upload_delta), y si el
+        servidor no lo puede aplicar se lanza EOFError.
+        """
         file_size = upload_file_path.stat().st_size
+        chunk_ids = None
+        if self.dedup and delta_base is None:
+            # El servidor no va a pedir los bloques de los chunks que ya tiene
+            with MappedFile(upload_file_path) as file:
+                chunk_ids = offered_chunk_ids(file.view)
+        (
+            packet_number,
+            real_server_address,
+            options,
+        ) = self.establish_upload_connection(
+            filename, file_size, delta_base=delta_base, chunk_ids=chunk_ids
+        )
+        if options.resume_blocks and chunk_ids:
+            logging.warn(
+                f"♻️ {len(options.resume_blocks)} blocks already on the server"
+            )
+        elif options.resume_blocks:
+            logging.warn(
+                f"⏯️ Resuming upload, {len(options.resume_blocks)} blocks already uploaded"
+            )
         progress_bar = self.start_progress_bar(filename, file_size)
         logging.info("✅ Connected successfuly to the server")
 
         try:
             self.upload_loop(
-                upload_file_path, packet_number, real_server_address, progress_bar
+                upload_file_path,
+                packet_number,
+                real_server_address,
+                options,
+                progress_bar,
             )
         except EOFError:
+            if delta_base is not None:
+                raise
             logging.error(f"❌ Uploaded {upload_file_path} file has invalid checksum")
         except ConnectionAbortedError:
             logging.error(
@@ -190,10 +448,424 @@ class Client(ABC):
             )
         except KeyboardInterrupt:
             error = Message(MessageType.ERROR, pos=0)
-            self.socket.sendto(error.encode(), real_server_address)
+            self.transport.send(error, real_server_address)
             logging.error(f"❌ Upload of file \033[1m{filename}\033[0;0m cancelled")
         else:
             logging.warn(f"✅ File \033[1m{filename}\033[0;0m successfuly uploaded")
         finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
+            progress_bar.close()
+            self.socket.close()
+
+    """
+    Delta
+    Para volver a subir un archivo que el servidor ya tiene, se descarga la
+    firma de su copia y se sube solo el delta contra ella (ver delta). Si
+    el servidor no tiene el archivo, o rechaza el delta porque su copia
+    cambio, se sube el archivo entero.
+    """
+
+    def download_signature(self, filename) -> Signature:
+        try:
+            (
+                packet_number,
+                real_server_address,
+                options,
+            ) = self.establish_download_connection(filename, signature=True)
+            with TemporaryDirectory() as directory:
+                signature_path = directory + "/signature"
+                self.download_loop(
+                    packet_number, signature_path, options, NullProgressBar()
+                )
+                with open(signature_path, "rb") as file:
+                    return Signature.decode(file.read())
+        except (EOFError, TimeoutError):
+            raise ConnectionAbortedError
+        finally:
+            self.socket.close()
+
+    def upload_delta(self, filename: str, source_path: str):
+        upload_file_path = Path(source_path + "/" + filename)
+        if not upload_file_path.is_file():
+            self.socket.close()
+            raise FileNotFoundError
+        try:
+            signature = self.download_signature(filename)
+        except FileNotFoundError:
+            logging.info("🧬 The server does not have the file, uploading it whole")
+            self.open_socket()
+            self.send_upload(filename, upload_file_path)
+            return
+
+        self.open_socket()
+        with TemporaryDirectory() as directory:
+            delta_file_path = Path(directory + "/delta")
+            with MappedFile(upload_file_path, self.payload_size) as source, open(
+                delta_file_path, "wb"
+            ) as delta_file:
+                writer = write_delta(source, signature, self.hash_algorithm, delta_file)
+            logging.info(f"🧬 Delta: {writer}")
+            try:
+                self.send_upload(filename, delta_file_path, signature.base)
+                return
+            except (EOFError, ConnectionAbortedError):
+                # La copia del servidor cambio desde la firma
+                pass
+        logging.warn("🧬 The server rejected the delta, uploading the whole file")
+        self.open_socket()
+        self.send_upload(filename, upload_file_path)
+
+    """
+    Lotes
+    Los archivos de un lote se transfieren uno detras de otro en la misma
+    sesion (ver file_transfer), sin un handshake ni una espera final por
+    archivo. Los lotes grandes se reparten en varias sesiones para que la
+    solicitud entre en un paquete (ver split_batch). En un lote no se
+    reanudan transferencias interrumpidas. La solicitud de cada sesion
+    anuncia en PREFETCH los archivos de la siguiente.
+    """
+
+    def download_batch(self, filenames: list[str], destination_path: str):
+        Path(destination_path).mkdir(parents=True, exist_ok=True)
+        groups = split_batch(filenames)
+        for i, group in enumerate(groups):
+            if i:
+                self.open_socket()
+            hints = groups[i + 1] if i + 1 < len(groups) else ()
+            self.download_group(group, destination_path, hints)
+
+    def download_group(self, filenames, destination_path, hints=()):
+        (
+            packet_number,
+            real_server_address,
+            options,
+        ) = self.establish_download_connection("", filenames=filenames, hints=hints)
+        files = []
+        for filename, file_size in zip(filenames, options.file_sizes or []):
+            if file_size is None:
+                logging.error(
+                    f"❌ There is no \033[1m{filename}\033[0;0m file to download."
+                )
+            else:
+                files.append((filename, file_size))
+        total_size = sum(file_size for _, file_size in files)
+
+        total, used, free = disk_usage(destination_path)
+        if free < total_size:
+            error = Message(MessageType.ERROR, pos=0)
+            self.transport.send(error, real_server_address)
+            self.socket.close()
+            raise SystemError
+
+        progress_bar = self.start_progress_bar(f"{len(files)} files", total_size)
+        receiver = self.create_receiver(packet_number, progress_bar, options)
+        reply = None
+        try:
+            for i, (filename, file_size) in enumerate(files):
+                with PreallocatedFile(
+                    destination_path + "/" + filename,
+                    file_size,
+                    options.hash_algorithm,
+                    chunk_size=options.payload_size,
+                    compression=options.compression,
+                ) as file:
+                    reply = run_blocking(
+                        receive_file(
+                            receiver,
+                            file,
+                            self.rtt,
+                            previous_reply=reply,
+                            linger=i == len(files) - 1,
+                        )
+                    )
+                receiver.restart(reply.pos)
+                if reply.type == MessageType.ACK:
+                    logging.info(f"✅ File \033[1m{filename}\033[0;0m downloaded")
+                else:
+                    logging.error(f"❌ Downloaded {filename} file has invalid checksum")
+        except (TimeoutError, KeyboardInterrupt):
+            error = Message(MessageType.ERROR, pos=0)
+            self.transport.send(error, real_server_address)
+            logging.error(f"❌ Download of {len(files)} files cancelled")
+        else:
+            logging.warn(f"✅ {len(files)} files downloaded")
+        finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
             progress_bar.close()
             self.socket.close()
+
+    def upload_batch(self, filenames: list[str], source_path: str):
+        files = []
+        for filename in filenames:
+            upload_file_path = Path(source_path + "/" + filename)
+            if upload_file_path.is_file():
+                files.append(filename)
+            else:
+                logging.error(
+                    f"❌ There is no \033[1m{filename}\033[0;0m file to upload."
+                )
+        for i, group in enumerate(split_batch(files)):
+            if i:
+                self.open_socket()
+            self.upload_group(group, source_path)
+
+    def upload_group(self, filenames, source_path):
+        paths = [Path(source_path + "/" + filename) for filename in filenames]
+        file_sizes = [path.stat().st_size for path in paths]
+        packet_number = randint(0, 10000)
+        handshake_end, real_server_address = self.send_request(
+            MessageType.UPLOAD,
+            packet_number,
+            "",
+            {
+                HandshakeOption.FILENAMES: encode_filenames(filenames),
+                HandshakeOption.FILE_SIZES: encode_sizes(file_sizes),
+                **self.offered_options(),
+            },
+            self.probe_mtu,
+        )
+
+        if handshake_end.type != MessageType.ACK or handshake_end.pos != packet_number:
+            error = Message(MessageType.ERROR, pos=0)
+            self.transport.send(error, real_server_address)
+            self.socket.close()
+            raise ConnectionAbortedError
+
+        options = TransferOptions.decode(handshake_end.payload)
+        self.check_options(options)
+        progress_bar = self.start_progress_bar(f"{len(paths)} files", sum(file_sizes))
+        logging.info("✅ Connected successfuly to the server")
+
+        sender = self.create_sender(real_server_address, progress_bar, options)
+        try:
+            for path in paths:
+                with MappedFile(path, options.payload_size) as file:
+                    file_hash = hash_in_background(
+                        file.view, options.hash_algorithm, file.chunk_size
+                    )
+                    source = TransferSource(
+                        file, file_hash, compression=options.compression
+                    )
+                    reply = run_blocking(send_file(sender, source, packet_number))
+                packet_number = reply.pos
+                if is_invalid_checksum(reply):
+                    logging.error(f"❌ Uploaded {path} file has invalid checksum")
+                elif reply.type == MessageType.ACK:
+                    logging.info(f"✅ File \033[1m{path.name}\033[0;0m uploaded")
+                else:
+                    raise ConnectionAbortedError
+        except ConnectionAbortedError:
+            logging.error(f"🚧 Connection aborted during upload of {len(paths)} files")
+        except KeyboardInterrupt:
+            error = Message(MessageType.ERROR, pos=0)
+            self.transport.send(error, real_server_address)
+            logging.error(f"❌ Upload of {len(paths)} files cancelled")
+        else:
+            logging.warn(f"✅ {len(paths)} files uploaded")
+        finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
+            progress_bar.close()
+            self.socket.close()
+
+    """
+    Partes
+    Con varias sesiones en paralelo, cada una con su socket y su thread, un
+    archivo se transfiere en partes (ver assembly). La primera sesion
+    negocia el tamaño de los paquetes, probando el MTU si se pidio, y las
+    demas ofrecen ese mismo para que los rangos de bloques coincidan.
+    """
+
+    def open_stream(self) -> "Client":
+        # Otra sesion con el mismo servidor y las mismas opciones
+        stream = copy(self)
+        stream.open_socket()
+        stream.rtt = RttEstimator()
+        stream.busy_retries = 0
+        stream.probe_mtu = False
+        return stream
+
+    def check_part(self, options: TransferOptions, chunk_size, algorithm):
+        if (
+            options.block_range is None
+            or options.payload_size != chunk_size
+            or options.hash_algorithm != algorithm
+        ):
+            self.socket.close()
+            raise ConnectionAbortedError
+
+    def run_streams(self, first_part, other_part, count) -> list[Message]:
+        """
+        Ejecuta la primera parte, ya conectada, y las demas en sesiones
+        nuevas, y devuelve la respuesta final de cada una.
+        """
+        sessions = [self] + [self.open_stream() for _ in range(1, count)]
+        with ThreadPoolExecutor(max_workers=count, thread_name_prefix="stream") as pool:
+            results = [pool.submit(first_part)] + [
+                pool.submit(other_part, session, index)
+                for index, session in enumerate(sessions[1:], 1)
+            ]
+            try:
+                return [result.result() for result in results]
+            finally:
+                # Destraba las sesiones que siguen si alguna fallo
+                for session in sessions:
+                    session.socket.close()
+
+    def download_streams(self, filename: str, destination_path: str, streams):
+        Path(destination_path).mkdir(parents=True, exist_ok=True)
+        full_path_to_file = destination_path + "/" + filename
+        if ResumeState.load(full_path_to_file):
+            logging.warn("⏯️ Resuming the interrupted download in a single session")
+            return self.download(filename, destination_path)
+
+        connection = self.establish_download_connection(filename, stream=(0, streams))
+        options = connection[2]
+        total, used, free = disk_usage(destination_path)
+        if free < options.file_size:
+            error = Message(MessageType.ERROR, pos=0)
+            self.transport.send(error, connection[1])
+            self.socket.close()
+            raise SystemError
+
+        self.payload_size = options.payload_size
+        assembly = Assembly(
+            full_path_to_file,
+            getrandbits(63),
+            options.file_size,
+            options.hash_algorithm,
+            options.payload_size,
+        )
+        assembly.prepare()
+        count = len(
+            split_blocks(hash_blocks(options.file_size, self.payload_size), streams)
+        )
+        logging.info(f"🔀 Downloading in {count} parts")
+        progress_bar = self.start_progress_bar(filename, options.file_size)
+
+        try:
+            replies = self.run_streams(
+                lambda: self.download_part(
+                    filename, assembly, progress_bar, (0, streams), connection
+                ),
+                lambda session, index: session.download_part(
+                    filename, assembly, progress_bar, (index, streams)
+                ),
+                count,
+            )
+        except (TimeoutError, ConnectionAbortedError, OSError, KeyboardInterrupt):
+            logging.error(f"❌ Download of file \033[1m{filename}\033[0;0m cancelled")
+            assembly.discard()
+        else:
+            if all(reply.type == MessageType.ACK for reply in replies):
+                logging.warn(
+                    f"✅ File \033[1m{filename}\033[0;0m successfuly downloaded"
+                )
+            else:
+                logging.error(f"❌ Downloaded {filename} file has invalid checksum")
+        finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
+            progress_bar.close()
+
+    def download_part(
+        self, filename, assembly: Assembly, progress_bar, stream, connection=None
+    ) -> Message:
+        if connection is None:
+            connection = self.establish_download_connection(filename, stream=stream)
+        packet_number, real_server_address, options = connection
+        self.check_part(options, assembly.chunk_size, assembly.algorithm)
+        receiver = self.create_receiver(packet_number, progress_bar, options)
+        with PreallocatedFile(
+            assembly.path,
+            assembly.size,
+            assembly.algorithm,
+            chunk_size=assembly.chunk_size,
+            compression=options.compression,
+            assembly=assembly,
+            block_range=options.block_range,
+        ) as file:
+            return run_blocking(receive_file(receiver, file, self.rtt))
+
+    def upload_streams(self, filename: str, source_path: str, streams):
+        upload_file_path = Path(source_path + "/" + filename)
+        if not upload_file_path.is_file():
+            self.socket.close()
+            raise FileNotFoundError
+
+        file_size = upload_file_path.stat().st_size
+        assembly_id = getrandbits(63)
+        connection = self.establish_upload_connection(
+            filename, file_size, (0, streams), assembly_id
+        )
+        options = connection[2]
+        self.payload_size = options.payload_size
+        count = len(split_blocks(hash_blocks(file_size, self.payload_size), streams))
+        logging.info(f"🔀 Uploading in {count} parts")
+        progress_bar = self.start_progress_bar(filename, file_size)
+
+        try:
+            with MappedFile(upload_file_path, self.payload_size) as file:
+                # Todas las partes envian las hojas del mismo hash
+                file_hash = hash_in_background(
+                    file.view, options.hash_algorithm, file.chunk_size
+                )
+                replies = self.run_streams(
+                    lambda: self.upload_part(
+                        filename,
+                        file,
+                        file_hash,
+                        progress_bar,
+                        (0, streams),
+                        assembly_id,
+                        connection,
+                    ),
+                    lambda session, index: session.upload_part(
+                        filename,
+                        file,
+                        file_hash,
+                        progress_bar,
+                        (index, streams),
+                        assembly_id,
+                    ),
+                    count,
+                )
+        except (TimeoutError, ConnectionAbortedError, OSError, KeyboardInterrupt):
+            logging.error(f"❌ Upload of file \033[1m{filename}\033[0;0m cancelled")
+        else:
+            if any(is_invalid_checksum(reply) for reply in replies):
+                logging.error(
+                    f"❌ Uploaded {upload_file_path} file has invalid checksum"
+                )
+            elif all(reply.type == MessageType.ACK for reply in replies):
+                logging.warn(f"✅ File \033[1m{filename}\033[0;0m successfuly uploaded")
+            else:
+                logging.error(
+                    f"🚧 Connection aborted during upload of file \033[1m{filename}\033[0;0m"
+                )
+        finally:
+            logging.info(f"📶 RTT to server: {self.rtt}")
+            progress_bar.close()
+
+    def upload_part(
+        self,
+        filename,
+        file: MappedFile,
+        file_hash,
+        progress_bar,
+        stream,
+        assembly_id,
+        connection=None,
+    ) -> Message:
+        if connection is None:
+            connection = self.establish_upload_connection(
+                filename, file.size, stream, assembly_id
+            )
+        packet_number, real_server_address, options = connection
+        self.check_part(options, file.chunk_size, file_hash.algorithm)
+        sender = self.create_sender(real_server_address, progress_bar, options)
+        source = TransferSource(
+            file,
+            file_hash,
+            compression=options.compression,
+            block_range=options.block_range,
+        )
+        return run_blocking(send_file(sender, source, packet_number))
@@ -0,0 +1,189 @@
+from lib.constants import (
+    COMPRESSION_CACHE_PACKETS,
+    COMPRESSION_MIN_RATIO,
+    COMPRESSION_READAHEAD,
+    COMPRESSION_SAMPLE_SIZE,
+    COMPRESSION_THREADS,
+)
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
+import logging
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, ValueError) + (
+    (zstandard.ZstdError,) if zstandard else ()
+)
+
+"""
+Compresion
+Con compresion negociada en el handshake, el emisor comprime cada paquete
+de datos por separado, por lo que cualquier paquete se puede retransmitir o
+recibir fuera de orden sin depender de los demas. Un paquete solo se envia
+comprimido si queda mas corto que el original, y el receptor lo reconoce
+por eso: conoce el largo de cada paquete del archivo, y si el payload es
+mas corto lo descomprime. Las hojas del arbol de hashes no se comprimen.
+"""
+
+
+class ZlibCompression:
+    name = "zlib"
+
+    def compress(self, data) -> bytes:
+        # Deflate sin header ni checksum, que ya cubre el arbol de hashes
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, length) -> bytes:
+        return zlib.decompress(data, -15, length)
+
+
+class LzmaCompression:
+    name = "lzma"
+    filters = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+    def compress(self, data) -> bytes:
+        return lzma.compress(data, lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data, length) -> bytes:
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=self.filters).decompress(
+            data, length
+        )
+
+
+class ZstdCompression:
+    name = "zstd"
+
+    def compress(self, data) -> bytes:
+        return zstandard.ZstdCompressor(level=3, write_content_size=False).compress(
+            data
+        )
+
+    def decompress(self, data, length) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=length)
+
+
+COMPRESSIONS = {
+    compression.name: compression
+    for compression in (ZlibCompression, LzmaCompression, ZstdCompression)
+    if compression is not ZstdCompression or zstandard is not None
+}
+
+
+def create_compression(name):
+    return COMPRESSIONS[name]() if name in COMPRESSIONS else None
+
+
+def choose_compression(offered) -> str:
+    for name in offered:
+        if name in COMPRESSIONS:
+            return name
+    return None
+
+
+def is_compressible(data) -> bool:
+    """
+    Prueba rapida con zlib sobre una muestra del paquete, para no gastar
+    tiempo comprimiendo datos que ya estan comprimidos.
+    """
+    sample = data[:COMPRESSION_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_MIN_RATIO
+
+
+compression_pool_lock = Lock()
+compression_pool = None
+
+
+def shared_compression_pool() -> ThreadPoolExecutor:
+    global compression_pool
+    with compression_pool_lock:
+        if compression_pool is None:
+            compression_pool = ThreadPoolExecutor(
+                max_workers=COMPRESSION_THREADS, thread_name_prefix="compression"
+            )
+        return compression_pool
+
+
+class CompressedFile:
+    """
+    MappedFile cuyos paquetes se envian comprimidos. Al pedir un paquete se
+    encolan en el pool compartido los COMPRESSION_READAHEAD siguientes, para
+    que zlib, lzma y zstd (que liberan el GIL) trabajen en paralelo con el
+    envio; los ultimos COMPRESSION_CACHE_PACKETS resultados se guardan para
+    las retransmisiones. Los paquetes que no se comprimen se siguen armando
+    como vistas sobre el mapeo.
+    """
+
+    def __init__(self, file, compression, pool=None):
+        self.file = file
+        self.compression = compression
+        self.pool = pool or shared_compression_pool()
+        self.chunk_size = file.chunk_size
+        self.size = file.size
+        self.packets = file.packets
+        self.results: OrderedDict[int, object] = OrderedDict()
+        self.compressed_packets = 0
+        self.compressed_length = 0
+        self.original_length = 0
+
+    def compress(self, index) -> bytes | None:
+        data = self.file.packet(index)
+        try:
+            if not is_compressible(data):
+                return None
+            compressed = self.compression.compress(data)
+        finally:
+            data.release()
+        return compressed if len(compressed) < self.file.packet_length(index) else None
+
+    def prefetch(self, index):
+        for next_index in range(
+            index, min(index + COMPRESSION_READAHEAD, self.packets)
+        ):
+            if next_index not in self.results:
+                self.results[next_index] = self.pool.submit(self.compress, next_index)
+        while len(self.results) > COMPRESSION_CACHE_PACKETS:
+            self.results.popitem(last=False)[1].cancel()
+
+    def packet(self, index):
+        self.prefetch(index)
+        payload = self.results[index].result()
+        if payload is None:
+            payload = self.file.packet(index)
+        else:
+            self.compressed_packets += 1
+        self.original_length += self.file.packet_length(index)
+        self.compressed_length += len(payload)
+        return payload
+
+    def packet_length(self, index):
+        return self.file.packet_length(index)
+
+    def __str__(self):
+        ratio = self.compressed_length / max(self.original_length, 1) * 100
+        return (
+            f"{self.compression.name}: {self.compressed_packets} packets compressed, "
+            f"{self.original_length} bytes sent as {self.compressed_length} ({ratio:.1f}%)"
+        )
+
+
+def decompress_packet(compression, payload, length) -> bytes:
+    """
+    Payload original de un paquete comprimido de largo length. Si no se
+    puede descomprimir se devuelven ceros: el bloque no va a coincidir con
+    la hoja del emisor y se vuelve a pedir.
+    """
+    try:
+        data = compression.decompress(payload, length)
+    except DECOMPRESSION_ERRORS as e:
+        logging.warn(f"Could not decompress packet: {e}")
+        return bytes(length)
+    if len(data) != length:
+        return bytes(length)
+    return data
@@ -0,0 +1,140 @@
+from lib.constants import (
+    CUBIC_BETA,
+    CUBIC_C,
+    INITIAL_CWND,
+    MIN_CWND,
+    WINDOW_SIZE,
+)
+from abc import ABC, abstractmethod
+from time import monotonic
+
+
+class CongestionController(ABC):
+    """
+    Ventana de congestion del emisor de Selective Repeat, medida en paquetes.
+    Arranca en slow start (la ventana crece un paquete por cada paquete
+    confirmado) hasta ssthresh o hasta la primera perdida. Nunca supera
+    WINDOW_SIZE, que sigue siendo el limite impuesto por el receptor.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = WINDOW_SIZE
+        self.max_cwnd = self.cwnd
+        self.losses = 0
+        self.timeouts = 0
+
+    def window(self) -> int:
+        return max(MIN_CWND, min(int(self.cwnd), WINDOW_SIZE))
+
+    def on_ack(self, acked: int):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.congestion_avoidance(acked)
+        self.cwnd = min(self.cwnd, WINDOW_SIZE)
+        self.max_cwnd = max(self.max_cwnd, self.cwnd)
+
+    def on_loss(self):
+        self.losses += 1
+        self.reduce()
+        self.cwnd = max(self.cwnd, MIN_CWND)
+        self.ssthresh = self.cwnd
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.reduce()
+        self.ssthresh = max(self.cwnd, MIN_CWND)
+        self.cwnd = MIN_CWND
+
+    @abstractmethod
+    def congestion_avoidance(self, acked: int):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def reduce(self):
+        raise NotImplementedError()
+
+    def __str__(self):
+        return (
+            f"{self.name} cwnd={self.cwnd:.1f} ssthresh={self.ssthresh:.1f} "
+            f"max_cwnd={self.max_cwnd:.1f} losses={self.losses} "
+            f"timeouts={self.timeouts}"
+        )
+
+
+class Reno(CongestionController):
+    """
+    AIMD: un paquete mas por cada ventana confirmada, y la mitad de la
+    ventana ante una perdida.
+    """
+
+    name = "reno"
+
+    def congestion_avoidance(self, acked: int):
+        self.cwnd += acked / self.cwnd
+
+    def reduce(self):
+        self.cwnd = self.cwnd / 2
+
+
+class Cubic(CongestionController):
+    """
+    CUBIC (RFC 8312): la ventana crece segun una funcion cubica del tiempo
+    desde la ultima perdida, centrada en la ventana que habia en ese momento,
+    y nunca por debajo de lo que creceria una ventana AIMD equivalente.
+    """
+
+    name = "cubic"
+
+    def __init__(self):
+        super().__init__()
+        self.w_max = 0
+        self.k = 0
+        self.origin = 0
+        self.w_est = 0
+        self.epoch_start = None
+
+    def congestion_avoidance(self, acked: int):
+        now = monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_est = self.cwnd
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / CUBIC_C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0
+                self.origin = self.cwnd
+
+        t = now - self.epoch_start
+        target = self.origin + CUBIC_C * (t - self.k) ** 3
+        if target > self.cwnd:
+            self.cwnd += acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += acked * 0.01 / self.cwnd
+
+        self.w_est += acked * 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) / self.cwnd
+        self.cwnd = max(self.cwnd, self.w_est)
+
+    def reduce(self):
+        # Fast convergence: si la perdida llega antes de recuperar la ventana
+        # anterior, se libera ancho de banda para otros flujos
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.cwnd = self.cwnd * CUBIC_BETA
+        self.epoch_start = None
+
+
+CONGESTION_CONTROLLERS = {
+    Reno.name: Reno,
+    Cubic.name: Cubic,
+}
+
+
+def create_congestion_controller(name) -> CongestionController:
+    return CONGESTION_CONTROLLERS[name]()
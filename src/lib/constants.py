@@ -1,20 +1,107 @@
-PAYLOAD_SIZE = 2000
+DEFAULT_PAYLOAD_SIZE = 1466
 MAX_CONSECUTIVE_LOSTS = 30
 SOCKET_TIME_OUT = 0.5
 WRITE_BINARY_MODE = "wb"
 READ_BINARY_MODE = "rb"
 HEADER_SIZE = 6
-MAX_PAYLOAD_SIZE = 8192
-RECV_BUFFER_SIZE = HEADER_SIZE + PAYLOAD_SIZE
 MAX_CONNECTIONS = 10
 MIN_ACK = 0
 MAX_ACK = 4294967295
 MAX_LENGTH = 8191
+RECV_BUFFER_SIZE = HEADER_SIZE + MAX_LENGTH
+FEC_HEADER_SIZE = 4
+# Un paquete de paridad (ver fec) lleva el payload mas su encabezado y
+# tiene que entrar en los 13 bits de LENGTH
+MAX_PAYLOAD_SIZE = MAX_LENGTH - FEC_HEADER_SIZE
+MIN_PAYLOAD_SIZE = 512
 TYPE_ENC_SHIFT = 13
-TYPE_DEC_SHIFT = 5
 PAYLOAD_START = 6
 LENGTH_FILTER = MAX_LENGTH
-BLOCK_SIZE = 524288000
+BLOCK_SIZE = 1048576
+DIGEST_CACHE_SIZE = 1024
+DIGEST_CACHE_FILENAME = ".digests.json"
+DIGEST_CACHE_FLUSH_DELAY = 5.0
 WINDOW_SIZE = 500
 INVALID_FILE_HASHING = 1
 FILE_NOT_FOUND_ERROR = 2
+MAX_SACK_BITMAP_SIZE = 1024
+DUP_ACK_THRESHOLD = 3
+ACK_FREQUENCY = 2
+DELAYED_ACK_TIME_OUT = 0.02
+MIN_RTO = 0.1
+MAX_RTO = 2.0
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_VAR_FACTOR = 4
+FIN_LINGER_FACTOR = 7
+TIMER_WHEEL_TICK = 0.005
+TIMER_WHEEL_SLOTS = 512
+INITIAL_CWND = 10
+MIN_CWND = 1
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+DEFAULT_CONGESTION_CONTROL = "cubic"
+RECV_BUFFER_SLOTS = 16
+UDP_SEGMENT = 103
+UDP_GRO = 104
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_SIZE = 65507
+GRO_BUFFER_SIZE = 65535
+GRO_BUFFER_SLOTS = 4
+SEND_BATCH_SIZE = 32
+HASH_ALGORITHMS = ("blake2b", "sha256", "md5")
+DEFAULT_HASH_ALGORITHM = "blake2b"
+HASH_BLOCK_PACKETS = 512
+INVALID_FILE_BLOCKS = 3
+MAX_REPAIR_ROUNDS = 3
+PARTIAL_FILE_SUFFIX = ".part"
+RESUME_STATE_SUFFIX = ".resume"
+MAX_RESUME_BLOCKS = 32768
+ENGINE_SOCKET_BUFFER_SIZE = 4194304
+WORKER_SHUTDOWN_TIME_OUT = 30
+MAX_ASYNC_SESSIONS = 1000
+MAX_SESSIONS_PER_CLIENT = 8
+BUSY_RETRY_AFTER = 1.0
+MAX_BUSY_RETRIES = 30
+EGRESS_WEIGHTS = ((1048576, 4), (16777216, 2))
+PACING_AUTO = "auto"
+PACING_GAIN = 1.25
+PACING_SLOW_START_GAIN = 2.0
+PACING_BURST_PACKETS = 16
+PACING_MIN_SLEEP = 0.0001
+MAX_RATE_BURST = 131072
+MAX_FEC_PACKETS = 64
+IP_UDP_HEADER_SIZE = 28
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_WANT = 1
+IP_PMTUDISC_PROBE = 3
+MTU_PROBE_SIZES = (9000, 4352, 1500, 1280)
+MTU_PROBE_ATTEMPTS = 2
+HASH_THREADS = 4
+COMPRESSION_THREADS = 2
+COMPRESSION_READAHEAD = 32
+COMPRESSION_CACHE_PACKETS = 4096
+COMPRESSION_SAMPLE_SIZE = 256
+COMPRESSION_MIN_RATIO = 0.9
+BATCH_MAX_FILES = 64
+BATCH_NAMES_SIZE = 640
+MAX_STREAMS = 8
+ASSEMBLY_STATE_SUFFIX = ".assembly"
+DELTA_BLOCK_SIZE = 65536
+DELTA_SCAN_SIZE = 1048576
+DELTA_SUFFIX = ".delta"
+CHUNK_SIZE = 4194304
+CHUNK_HASH_ALGORITHM = "sha256"
+CHUNK_ID_SIZE = 8
+MAX_OFFERED_CHUNKS = 80
+CHUNK_STORE_DIRNAME = ".chunks"
+CHUNK_REFS_FILENAME = "refs.json"
+CHUNK_INDEX_SUFFIX = ".chunks"
+CHUNK_GC_GRACE = 3600
+CHUNK_OPEN_MAPS = 16
+BLOCK_CACHE_SIZE = 134217728
+BLOCK_CACHE_BLOCK_SIZE = 1048576
+BLOCK_CACHE_READAHEAD = 4
+BLOCK_CACHE_THREADS = 4
+BLOCK_CACHE_WARM_BLOCKS = 8
+PREFETCH_NAMES_SIZE = 256
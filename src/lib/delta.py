@@ -0,0 +1,420 @@
+from lib.constants import (
+    DELTA_BLOCK_SIZE,
+    DELTA_SCAN_SIZE,
+    DELTA_SUFFIX,
+)
+from lib.file_hashing import (
+    StreamingHash,
+    digest_size,
+    hash_in_background,
+    new_hash,
+)
+from lib.preallocated_file import allocate
+from lib.resume_state import partial_path, state_path
+from pathlib import Path
+import logging
+import struct
+import zlib
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Subida delta
+Para volver a subir un archivo que el servidor ya tiene con pocos cambios,
+el cliente primero descarga la firma de la copia del servidor: el checksum
+debil (adler32) y el hash fuerte de cada bloque de DELTA_BLOCK_SIZE bytes.
+Despues recorre su archivo buscando bloques de la firma en cualquier
+offset, con el checksum debil que se actualiza en O(1) al avanzar un byte,
+y sube en lugar del archivo un delta: referencias a rangos de la copia del
+servidor y los datos que no estan en ella. El delta se transfiere como
+cualquier archivo, y el servidor arma con el el archivo nuevo al lado de
+su copia y lo reemplaza solo si coincide con la raiz del arbol de hashes
+que el cliente calculo sobre el archivo original.
+
+Despues de un bloque encontrado se salta al siguiente, por lo que en las
+partes que no cambiaron solo se calcula un checksum por bloque; el
+checksum se desliza byte a byte solo en las partes que cambiaron, de a
+DELTA_SCAN_SIZE posiciones. Con NumPy, los checksums de todas esas
+posiciones se calculan juntos con sumas acumuladas.
+
+La firma empieza con el tamaño y el mtime_ns de la copia, que el cliente
+repite en la opcion DELTA de la subida para que el servidor rechace el
+delta si la copia cambio mientras tanto.
+"""
+
+SIGNATURE_HEADER_FORMAT = struct.Struct("!QQIB")
+WEAK_CHECKSUM_FORMAT = struct.Struct("!I")
+DELTA_HEADER_FORMAT = struct.Struct("!QHB")
+DELTA_OP_FORMAT = struct.Struct("!BQQ")
+DELTA_BASE_FORMAT = struct.Struct("!QQ")
+ADLER_MODULUS = 65521
+COPY = 0
+LITERAL = 1
+
+
+def delta_path(path) -> Path:
+    return Path(str(path) + DELTA_SUFFIX)
+
+
+def encode_delta_base(base) -> bytes:
+    return DELTA_BASE_FORMAT.pack(*base)
+
+
+def decode_delta_base(value) -> tuple[int, int] | None:
+    if len(value) != DELTA_BASE_FORMAT.size:
+        return None
+    return DELTA_BASE_FORMAT.unpack(value)
+
+
+def weak_checksum(data) -> int:
+    return zlib.adler32(data)
+
+
+class Signature:
+    """
+    Firma de la copia de un archivo: base es su tamaño y mtime_ns, y
+    blocks el checksum debil y el hash fuerte de cada bloque completo.
+    """
+
+    def __init__(self, base, block_size, algorithm, blocks: list[tuple[int, bytes]]):
+        self.base = base
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.blocks = blocks
+        self.weaks: dict[int, list[int]] = {}
+        for index, (weak, _) in enumerate(blocks):
+            self.weaks.setdefault(weak, []).append(index)
+
+    def find(self, weak, data) -> int | None:
+        """
+        Bloque de la copia con los mismos datos, o None.
+        """
+        indexes = self.weaks.get(weak)
+        if not indexes:
+            return None
+        strong = new_hash(self.algorithm)
+        strong.update(data)
+        strong = strong.digest()
+        for index in indexes:
+            if self.blocks[index][1] == strong:
+                return index
+        return None
+
+    def encode(self) -> bytes:
+        algorithm = self.algorithm.encode()
+        return (
+            SIGNATURE_HEADER_FORMAT.pack(*self.base, self.block_size, len(algorithm))
+            + algorithm
+            + b"".join(
+                WEAK_CHECKSUM_FORMAT.pack(weak) + strong for weak, strong in self.blocks
+            )
+        )
+
+    @classmethod
+    def decode(cls, data) -> "Signature":
+        size, mtime_ns, block_size, length = SIGNATURE_HEADER_FORMAT.unpack_from(data)
+        offset = SIGNATURE_HEADER_FORMAT.size
+        algorithm = bytes(data[offset : offset + length]).decode()
+        offset += length
+        entry_size = WEAK_CHECKSUM_FORMAT.size + digest_size(algorithm)
+        blocks = [
+            (
+                WEAK_CHECKSUM_FORMAT.unpack_from(data, start)[0],
+                bytes(data[start + WEAK_CHECKSUM_FORMAT.size : start + entry_size]),
+            )
+            for start in range(offset, len(data) - entry_size + 1, entry_size)
+        ]
+        return cls((size, mtime_ns), block_size, algorithm, blocks)
+
+
+def compute_signature(source, algorithm, block_size=DELTA_BLOCK_SIZE) -> bytes:
+    """
+    Firma del MappedFile source. Su base es el tamaño y el mtime_ns del
+    archivo abierto, que en el almacen de chunks es el indice (ver
+    chunk_store).
+    """
+    blocks = []
+    stat = os.fstat(source.file.fileno())
+    for offset in range(0, len(source.view) - block_size + 1, block_size):
+        data = source.view[offset : offset + block_size]
+        strong = new_hash(algorithm)
+        strong.update(data)
+        blocks.append((weak_checksum(data), strong.digest()))
+        data.release()
+    return Signature(
+        (stat.st_size, stat.st_mtime_ns), block_size, algorithm, blocks
+    ).encode()
+
+
+def rolling_candidates(data, start, end, block_size, weaks):
+    """
+    Posiciones entre start y end cuyo bloque tiene el checksum debil de
+    algun bloque de la firma, con ese checksum.
+    """
+    if start >= end:
+        return
+    weak = weak_checksum(data[start : start + block_size])
+    a, b = weak & 0xFFFF, weak >> 16
+    for position in range(start, end):
+        if position > start:
+            removed = data[position - 1]
+            a = (a - removed + data[position + block_size - 1]) % ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+        weak = b << 16 | a
+        if weak in weaks:
+            yield position, weak
+
+
+def numpy_candidates(data, start, end, block_size, weaks):
+    """
+    Como rolling_candidates, con los checksums de todas las posiciones
+    calculados con NumPy: a partir de las sumas acumuladas de los bytes (S)
+    y de los bytes por su posicion (T), la suma de un bloque es una resta de
+    S y la suma ponderada de adler32 sale de S y T.
+    """
+    if start >= end:
+        return
+    count = end - start
+    window = numpy.frombuffer(
+        data[start : end - 1 + block_size], dtype=numpy.uint8
+    ).astype(numpy.uint64)
+    zero = numpy.zeros(1, dtype=numpy.uint64)
+    sums = numpy.concatenate((zero, numpy.cumsum(window)))
+    weighted = numpy.concatenate(
+        (zero, numpy.cumsum(window * numpy.arange(len(window), dtype=numpy.uint64)))
+    )
+    positions = numpy.arange(count, dtype=numpy.uint64)
+    a = sums[block_size : block_size + count] - sums[:count]
+    b = (positions + block_size) * a - (
+        weighted[block_size : block_size + count] - weighted[:count]
+    )
+    checksums = (b + block_size) % ADLER_MODULUS << 16 | (a + 1) % ADLER_MODULUS
+    known = numpy.fromiter(weaks, dtype=numpy.uint64, count=len(weaks))
+    for index in numpy.nonzero(numpy.isin(checksums, known))[0]:
+        yield start + int(index), int(checksums[index])
+
+
+class DeltaWriter:
+    """
+    Escribe las operaciones de un delta, juntando las copias de bloques
+    consecutivos de la copia del servidor en una sola.
+    """
+
+    def __init__(self, file, offset):
+        self.file = file
+        self.offset = offset
+        self.copy = None
+        self.copied = 0
+        self.literal = 0
+
+    def add_copy(self, base_offset, length):
+        if self.copy and self.copy[0] + self.copy[1] == base_offset:
+            self.copy[1] += length
+        else:
+            self.flush()
+            self.copy = [base_offset, length]
+        self.copied += length
+
+    def add_literal(self, data):
+        if not len(data):
+            return
+        self.flush()
+        self.write(DELTA_OP_FORMAT.pack(LITERAL, 0, len(data)))
+        self.write(data)
+        self.literal += len(data)
+
+    def flush(self):
+        if self.copy:
+            self.write(DELTA_OP_FORMAT.pack(COPY, *self.copy))
+            self.copy = None
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            written = os.pwrite(self.file.fileno(), data, self.offset)
+            self.offset += written
+            data = data[written:]
+
+    def __str__(self):
+        return (
+            f"{self.copied} bytes found in the server copy, "
+            f"{self.literal} bytes sent ({self.offset} bytes of delta)"
+        )
+
+
+def write_delta(source, signature: Signature, algorithm, delta_file) -> DeltaWriter:
+    """
+    Escribe en delta_file el delta del MappedFile source respecto de la
+    copia de la firma. El encabezado lleva el tamaño del archivo y la raiz
+    de su arbol de hashes con el algoritmo y el tamaño de paquete de source,
+    que se calcula en otro thread durante la busqueda.
+    """
+    file_hash = hash_in_background(source.view, algorithm, source.chunk_size)
+    algorithm_name = algorithm.encode()
+    writer = DeltaWriter(
+        delta_file,
+        DELTA_HEADER_FORMAT.size + len(algorithm_name) + digest_size(algorithm),
+    )
+    data = source.view
+    block_size = signature.block_size
+    candidates = numpy_candidates if numpy is not None else rolling_candidates
+    # Ultima posicion en la que entra un bloque entero, mas uno
+    end = len(data) - block_size + 1 if signature.blocks else 0
+    position = literal_start = 0
+    while position < end:
+        block = data[position : position + block_size]
+        index = signature.find(weak_checksum(block), block)
+        if index is None:
+            scan_end = min(position + DELTA_SCAN_SIZE, end)
+            for candidate, weak in candidates(
+                data, position + 1, scan_end, block_size, signature.weaks
+            ):
+                index = signature.find(weak, data[candidate : candidate + block_size])
+                if index is not None:
+                    position = candidate
+                    break
+            else:
+                position = scan_end
+                continue
+        writer.add_literal(data[literal_start:position])
+        writer.add_copy(index * block_size, block_size)
+        position += block_size
+        literal_start = position
+    writer.add_literal(data[literal_start:])
+    writer.flush()
+    header = (
+        DELTA_HEADER_FORMAT.pack(len(data), source.chunk_size, len(algorithm_name))
+        + algorithm_name
+        + file_hash.digest()
+    )
+    os.pwrite(delta_file.fileno(), header, 0)
+    return writer
+
+
+def copy_range(source_fd, source_offset, fd, offset, length) -> int:
+    """
+    Copia length bytes entre dos archivos sin pasar por Python cuando el
+    sistema tiene copy_file_range. Devuelve cuantos copio.
+    """
+    copied = 0
+    while copied < length:
+        try:
+            count = os.copy_file_range(
+                source_fd, fd, length - copied, source_offset + copied, offset + copied
+            )
+        except (AttributeError, OSError):
+            data = os.pread(
+                source_fd, min(length - copied, 1 << 20), source_offset + copied
+            )
+            count = os.pwrite(fd, data, offset + copied) if data else 0
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+class DeltaHeader:
+    def __init__(self, file_size, chunk_size, algorithm, root):
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.root = root
+
+    @classmethod
+    def read(cls, fd) -> "DeltaHeader":
+        data = os.pread(fd, DELTA_HEADER_FORMAT.size, 0)
+        file_size, chunk_size, length = DELTA_HEADER_FORMAT.unpack(data)
+        algorithm = os.pread(fd, length, DELTA_HEADER_FORMAT.size).decode()
+        offset = DELTA_HEADER_FORMAT.size + length
+        root = os.pread(fd, digest_size(algorithm), offset)
+        return cls(file_size, chunk_size, algorithm, root)
+
+    @property
+    def size(self):
+        return DELTA_HEADER_FORMAT.size + len(self.algorithm.encode()) + len(self.root)
+
+
+def apply_delta(path, base) -> tuple[DeltaHeader, list[bytes]] | None:
+    """
+    Arma el archivo nuevo con el delta recibido junto a path y la copia
+    abierta en el MappedFile base, y lo mueve a path si coincide con la
+    raiz del encabezado. Devuelve el encabezado y las hojas del archivo
+    nuevo, o None si el delta no es valido. El delta se borra en cualquier
+    caso.
+    """
+    try:
+        with open(delta_path(path), "rb") as delta:
+            return build(delta.fileno(), base, path)
+    except (OSError, ValueError, LookupError, struct.error) as e:
+        logging.warn(f"Invalid delta for {path}: {e}")
+        partial_path(path).unlink(missing_ok=True)
+        return None
+    finally:
+        delta_path(path).unlink(missing_ok=True)
+
+
+def copy_view(view, base_offset, fd, offset, length) -> int:
+    """
+    Copia length bytes de la vista de un MappedFile a un archivo, de a
+    DELTA_SCAN_SIZE bytes para no armar copias grandes en memoria.
+    """
+    copied = 0
+    while copied < length:
+        start = base_offset + copied
+        data = view[start : start + min(length - copied, DELTA_SCAN_SIZE)]
+        try:
+            if not len(data):
+                break
+            count = os.pwrite(fd, data, offset + copied)
+        finally:
+            data.release()
+        copied += count
+    return copied
+
+
+def build(delta_fd, base, path) -> tuple[DeltaHeader, list[bytes]] | None:
+    header = DeltaHeader.read(delta_fd)
+    base_size = base.size
+    delta_size = os.fstat(delta_fd).st_size
+    fd = os.open(partial_path(path), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    # El hash avanza sobre lo ya escrito mientras se arma el resto
+    file_hash = StreamingHash(header.algorithm, header.chunk_size)
+    try:
+        allocate(fd, header.file_size)
+        delta_offset = header.size
+        offset = 0
+        while delta_offset < delta_size:
+            kind, base_offset, length = DELTA_OP_FORMAT.unpack(
+                os.pread(delta_fd, DELTA_OP_FORMAT.size, delta_offset)
+            )
+            delta_offset += DELTA_OP_FORMAT.size
+            if offset + length > header.file_size:
+                raise ValueError("delta longer than the file")
+            if kind == COPY and base_offset + length <= base_size:
+                copied = copy_view(base.view, base_offset, fd, offset, length)
+            elif kind == LITERAL:
+                copied = copy_range(delta_fd, delta_offset, fd, offset, length)
+                delta_offset += length
+            else:
+                raise ValueError(f"invalid operation {kind}")
+            if copied != length:
+                raise ValueError("truncated delta")
+            file_hash.update_from(fd, offset, length)
+            offset += length
+        valid = offset == header.file_size and file_hash.digest() == header.root
+    finally:
+        file_hash.digest()
+        os.close(fd)
+    if not valid:
+        logging.error(
+            f"❌ File rebuilt from the delta for {path} does not match its root"
+        )
+        partial_path(path).unlink(missing_ok=True)
+        return None
+    os.replace(partial_path(path), path)
+    state_path(path).unlink(missing_ok=True)
+    return header, file_hash.leaves
@@ -0,0 +1,195 @@
+from lib.constants import (
+    DIGEST_CACHE_FILENAME,
+    DIGEST_CACHE_FLUSH_DELAY,
+    DIGEST_CACHE_SIZE,
+    HASH_ALGORITHMS,
+)
+from lib.file_hashing import KnownDigest, StreamingHash, split_leaves
+from lib.mapped_file import MappedFile
+from collections import OrderedDict
+from threading import Lock, Timer
+from pathlib import Path
+import logging
+import fcntl
+import json
+import os
+
+
+class DigestCache:
+    """
+    Cache de las hojas del arbol de hashes de los archivos del servidor,
+    guardada en el directorio de almacenamiento para sobrevivir a reinicios.
+    Se guardan las hojas de un solo algoritmo y tamaño de paquete (del que
+    depende el tamaño de los bloques) por archivo. Cada entrada vale
+    mientras el archivo conserve su inodo, tamaño y mtime_ns; se
+    descartan las menos usadas cuando hay mas de capacity. La comparten
+    todos los threads del servidor.
+
+    Los cambios se guardan en segundo plano, juntos, DIGEST_CACHE_FLUSH_DELAY
+    segundos despues del primero, y al cerrar el servidor. Para guardarlos
+    se bloquea el archivo con flock y se combinan con lo que ya tiene, ya
+    que con varios workers (ver workers) cada proceso tiene su cache.
+    """
+
+    def __init__(self, storage_path, capacity=DIGEST_CACHE_SIZE):
+        self.path = Path(storage_path) / DIGEST_CACHE_FILENAME
+        self.capacity = capacity
+        self.lock = Lock()
+        self.entries: OrderedDict[str, tuple] = OrderedDict()
+        # Entradas a guardar desde la ultima vez
+        self.changes: dict[str, tuple] = {}
+        self.flush_lock = Lock()
+        self.flush_timer = None
+        # Hashes en curso, que comparten las descargas de un mismo archivo
+        self.hashing: dict[tuple, StreamingHash] = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def key(stat):
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, path, stat, algorithm, chunk_size) -> list[bytes] | None:
+        path = str(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[:3] != (self.key(stat), algorithm, chunk_size):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, path, stat, algorithm, chunk_size, leaves):
+        path = str(path)
+        with self.lock:
+            entry = (self.key(stat), algorithm, chunk_size, list(leaves))
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            self.changes[path] = entry
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        # Se llama con el lock tomado
+        if self.flush_timer is None:
+            self.flush_timer = Timer(DIGEST_CACHE_FLUSH_DELAY, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                changes, self.changes = self.changes, {}
+                self.flush_timer = None
+            if changes:
+                self.save(changes)
+
+    def close(self):
+        with self.lock:
+            timer = self.flush_timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+    def hash_file(self, path, source: MappedFile, algorithm):
+        """
+        Arbol del archivo a enviar: el de la cache si el archivo no cambio, o
+        uno que se calcula en segundo plano durante el envio y se guarda al
+        terminar. Las descargas simultaneas de la misma version del archivo
+        comparten el mismo calculo.
+        """
+        stat = os.fstat(source.file.fileno())
+        chunk_size = source.chunk_size
+        leaves = self.get(path, stat, algorithm, chunk_size)
+        if leaves is not None:
+            return KnownDigest(algorithm, leaves)
+        key = (str(path), self.key(stat), algorithm, chunk_size)
+        with self.lock:
+            file_hash = self.hashing.get(key)
+            if file_hash is not None:
+                return file_hash
+            file_hash = self.hashing[key] = StreamingHash(
+                algorithm,
+                chunk_size,
+                on_digest=lambda leaves: self.hashed(key, stat, leaves),
+            )
+        file_hash.update_all(source.view)
+        return file_hash
+
+    def hashed(self, key, stat, leaves):
+        path, _, algorithm, chunk_size = key
+        if leaves is not None:
+            self.put(path, stat, algorithm, chunk_size, leaves)
+        with self.lock:
+            self.hashing.pop(key, None)
+
+    def read(self) -> list:
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.warn(f"Ignoring digest cache {self.path}: {e}")
+            return []
+        return entries if isinstance(entries, list) else []
+
+    def load(self):
+        for entry in self.read()[-self.capacity :]:
+            # Las entradas de versiones anteriores no guardaban el tamaño de
+            # paquete
+            if len(entry) != 7 or entry[4] not in HASH_ALGORITHMS:
+                continue
+            path, inode, size, mtime_ns, algorithm, chunk_size, leaves = entry
+            self.entries[path] = (
+                (inode, size, mtime_ns),
+                algorithm,
+                chunk_size,
+                split_leaves(algorithm, bytes.fromhex(leaves)),
+            )
+
+    def save(self, changes):
+        """
+        Agrega los cambios a las entradas guardadas, que pueden incluir
+        las de otros workers, y conserva las capacity mas recientes.
+        """
+        # Unico por proceso, por si hay varios workers (ver workers)
+        temporary_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            fd = os.open(
+                self.path.with_name(self.path.name + ".lock"), os.O_CREAT, 0o644
+            )
+        except OSError as e:
+            logging.warn(f"Could not save digest cache {self.path}: {e}")
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            entries = {
+                entry[0]: entry
+                for entry in self.read()
+                if isinstance(entry, list) and len(entry) == 7
+            }
+            for path, (key, algorithm, chunk_size, leaves) in changes.items():
+                # Al final, como las mas recientes
+                entries.pop(path, None)
+                entries[path] = [
+                    path,
+                    *key,
+                    algorithm,
+                    chunk_size,
+                    b"".join(leaves).hex(),
+                ]
+            with open(temporary_path, "w") as file:
+                json.dump(list(entries.values())[-self.capacity :], file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warn(f"Could not save digest cache {self.path}: {e}")
+        finally:
+            # Cerrar el descriptor libera el lock
+            os.close(fd)
+
+    def __str__(self):
+        return f"{len(self.entries)} digests cached, {self.hits} hits, {self.misses} misses"
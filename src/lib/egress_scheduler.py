@@ -0,0 +1,98 @@
+from lib.constants import EGRESS_WEIGHTS
+from threading import Lock
+from time import monotonic
+
+RATE_UNITS = {"": 1, "K": 10**3, "M": 10**6, "G": 10**9}
+
+
+def parse_rate(value: str) -> int:
+    """
+    Tasa en bytes por segundo, con sufijo K, M o G opcional (10M = 10 MB/s).
+    """
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in RATE_UNITS else ""
+    rate = float(value[: len(value) - len(unit)]) * RATE_UNITS[unit]
+    if rate <= 0:
+        raise ValueError(f"Invalid rate: {value}")
+    return int(rate)
+
+
+def egress_weight(remaining) -> int:
+    for size, weight in EGRESS_WEIGHTS:
+        if remaining <= size:
+            return weight
+    return 1
+
+
+class EgressSession:
+    """
+    Descarga en curso registrada en el scheduler. reserve devuelve cuantos
+    segundos esperar antes de enviar size bytes.
+    """
+
+    def __init__(self, scheduler, remaining):
+        self.scheduler = scheduler
+        self.remaining = remaining
+        self.weight = egress_weight(remaining)
+        self.next_send = 0.0
+
+    def reserve(self, size) -> float:
+        return self.scheduler.reserve(self, size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.scheduler.close(self)
+
+
+class EgressScheduler:
+    """
+    Reparte la tasa de salida del servidor (rate, en bytes por segundo) entre
+    las descargas en curso, en proporcion a su peso. El peso depende de lo
+    que le falta enviar a cada una (ver EGRESS_WEIGHTS), para que las
+    transferencias cortas, o las largas que estan por terminar, no queden
+    detras de las largas. Cada sesion envia espaciada segun su parte de la
+    tasa, que se recalcula cuando una sesion empieza, termina o cambia de peso.
+
+    La parte de una sesion que envia menos (porque la limita su ventana o
+    el RTT) no se reparte entre las demas. Sin rate no se espacia el envio.
+    Con varios workers, cada proceso tiene su propio scheduler.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = Lock()
+        self.sessions = 0
+        self.total_weight = 0
+
+    def session(self, remaining) -> EgressSession:
+        session = EgressSession(self, remaining)
+        with self.lock:
+            self.sessions += 1
+            self.total_weight += session.weight
+        return session
+
+    def reserve(self, session: EgressSession, size) -> float:
+        with self.lock:
+            session.remaining -= size
+            weight = egress_weight(session.remaining)
+            self.total_weight += weight - session.weight
+            session.weight = weight
+            if self.rate is None:
+                return 0
+            now = monotonic()
+            start = max(now, session.next_send)
+            session.next_send = start + size * self.total_weight / (
+                self.rate * session.weight
+            )
+            return start - now
+
+    def close(self, session: EgressSession):
+        with self.lock:
+            self.sessions -= 1
+            self.total_weight -= session.weight
+
+    def __str__(self):
+        rate = f"{self.rate} B/s" if self.rate else "unlimited"
+        return f"{self.sessions} downloads sharing {rate}"
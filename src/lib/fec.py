@@ -0,0 +1,209 @@
+from lib.constants import FEC_HEADER_SIZE, MAX_FEC_PACKETS
+from lib.message import Message, MessageType
+import struct
+
+"""
+FEC
+Con FEC negociado en el handshake, el emisor de Selective Repeat agrupa los
+paquetes de cada envio en bloques de K y despues del ultimo de cada bloque
+envia M paquetes de paridad (mensajes PARITY). El paquete i del bloque
+pertenece al grupo i % M, y la paridad de un grupo es el XOR de sus
+paquetes, calculado de una vez sobre cada paquete entero como un entero
+little-endian (los paquetes mas cortos quedan completados con ceros). Al
+intercalar los grupos, una rafaga de hasta M perdidas seguidas dentro de un
+bloque se puede reconstruir.
+
+El pos de un PARITY es el numero del primer paquete del bloque mas el
+grupo, y el payload lleva la cantidad de paquetes del bloque (el ultimo
+puede tener menos de K) y el XOR de los largos de los paquetes del grupo,
+seguidos del XOR de los datos. El receptor reconstruye el paquete que falta
+de un grupo sin pedirlo al emisor, que lo ve confirmado con el siguiente
+ACK. Los paquetes de paridad no se confirman ni se retransmiten.
+"""
+
+FEC_HEADER_FORMAT = struct.Struct("!HH")
+# MAX_PAYLOAD_SIZE se deriva de su tamaño
+assert FEC_HEADER_FORMAT.size == FEC_HEADER_SIZE
+
+
+def encode_fec(fec) -> bytes:
+    return bytes(fec)
+
+
+def decode_fec(value) -> tuple[int, int] | None:
+    if len(value) != 2:
+        return None
+    data_packets, parity_packets = value
+    if not 1 <= parity_packets <= data_packets <= MAX_FEC_PACKETS:
+        return None
+    return data_packets, parity_packets
+
+
+def parse_fec(value: str) -> tuple[int, int]:
+    """
+    K,M: paquetes de datos y de paridad por bloque (por ejemplo 16,2).
+    """
+    data_packets, _, parity_packets = value.partition(",")
+    fec = (int(data_packets), int(parity_packets))
+    if not 1 <= fec[1] <= fec[0] <= MAX_FEC_PACKETS:
+        raise ValueError(f"Invalid FEC: {value}")
+    return fec
+
+
+def xor_packets(packets) -> tuple[int, int]:
+    value = 0
+    lengths = 0
+    for packet in packets:
+        value ^= int.from_bytes(packet, "little")
+        lengths ^= len(packet)
+    return value, lengths
+
+
+class FecEncoder:
+    def __init__(self, data_packets, parity_packets):
+        self.k = data_packets
+        self.m = parity_packets
+        self.data_packets = 0
+        self.parity_packets = 0
+
+    def is_block_end(self, index, packets) -> bool:
+        return (index + 1) % self.k == 0 or index + 1 == packets
+
+    def parity(self, source, index, first_seq) -> list[Message]:
+        """
+        Paquetes de paridad del bloque que termina en el paquete index de la
+        fuente, cuyo paquete 0 tiene el numero first_seq.
+        """
+        start = index - index % self.k
+        size = index + 1 - start
+        messages = []
+        for group in range(min(self.m, size)):
+            value, lengths = xor_packets(
+                source.packet(i) for i in range(start + group, index + 1, self.m)
+            )
+            payload = FEC_HEADER_FORMAT.pack(size, lengths) + value.to_bytes(
+                (value.bit_length() + 7) // 8, "little"
+            )
+            messages.append(
+                Message(MessageType.PARITY, first_seq + start + group, payload)
+            )
+        self.data_packets += size
+        self.parity_packets += len(messages)
+        return messages
+
+    def __str__(self):
+        overhead = self.parity_packets / max(self.data_packets, 1) * 100
+        return (
+            f"FEC {self.k}+{self.m}: {self.parity_packets} parity packets for "
+            f"{self.data_packets} data packets ({overhead:.1f}% overhead)"
+        )
+
+
+class FecGroup:
+    def __init__(self):
+        self.value = 0
+        self.lengths = 0
+        self.received = set()
+        self.size = None
+        self.parity = None
+        self.parity_lengths = 0
+
+
+class FecDecoder:
+    """
+    Acumula el XOR de los paquetes recibidos de cada grupo, por lo que no
+    guarda sus payloads, y reconstruye el que falta cuando llega la paridad.
+    """
+
+    def __init__(self, data_packets, parity_packets, first_seq):
+        self.k = data_packets
+        self.m = parity_packets
+        self.first_seq = first_seq
+        self.groups: dict[tuple[int, int], FecGroup] = {}
+        self.parity_packets = 0
+        self.recovered = 0
+
+    def restart(self, first_seq):
+        self.first_seq = first_seq
+        self.groups = {}
+
+    def locate(self, seq) -> tuple[int, int]:
+        # (primer paquete del bloque, grupo) de un numero de paquete
+        index = seq - self.first_seq
+        start = index - index % self.k
+        return start, (index - start) % self.m
+
+    def on_data(self, seq, payload) -> list[tuple[int, bytes]]:
+        key = self.locate(seq)
+        group = self.groups.setdefault(key, FecGroup())
+        group.value ^= int.from_bytes(payload, "little")
+        group.lengths ^= len(payload)
+        group.received.add(seq)
+        return self.recover(key, group)
+
+    def on_parity(self, message: Message, window_seq) -> list[tuple[int, bytes]]:
+        self.parity_packets += 1
+        self.prune(window_seq)
+        size, lengths = FEC_HEADER_FORMAT.unpack_from(message.payload)
+        key = self.locate(message.pos)
+        if self.first_seq + key[0] + size - 1 <= window_seq:
+            # Ya llego todo el bloque
+            self.groups.pop(key, None)
+            return []
+        group = self.groups.setdefault(key, FecGroup())
+        group.size = size
+        group.parity = int.from_bytes(
+            message.payload[FEC_HEADER_FORMAT.size :], "little"
+        )
+        group.parity_lengths = lengths
+        return self.recover(key, group)
+
+    def recover(self, key, group: FecGroup) -> list[tuple[int, bytes]]:
+        if group.parity is None:
+            return []
+        start, index = key
+        missing = [
+            seq
+            for seq in range(
+                self.first_seq + start + index,
+                self.first_seq + start + group.size,
+                self.m,
+            )
+            if seq not in group.received
+        ]
+        if len(missing) > 1:
+            return []
+        del self.groups[key]
+        if not missing:
+            return []
+        try:
+            payload = (group.value ^ group.parity).to_bytes(
+                group.lengths ^ group.parity_lengths, "little"
+            )
+        except OverflowError:
+            return []
+        self.recovered += 1
+        return [(missing[0], payload)]
+
+    def prune(self, window_seq):
+        # Grupos de bloques que ya llegaron enteros, cuya paridad se perdio
+        for key in [
+            key
+            for key in self.groups
+            if self.first_seq + key[0] + self.k - 1 <= window_seq
+        ]:
+            del self.groups[key]
+
+    def awaits_parity(self, seq) -> bool:
+        """
+        Si el paquete seq todavia se puede reconstruir cuando llegue la
+        paridad de su grupo.
+        """
+        group = self.groups.get(self.locate(seq))
+        return group is None or group.parity is None
+
+    def __str__(self):
+        return (
+            f"FEC {self.k}+{self.m}: recovered {self.recovered} packets "
+            f"with {self.parity_packets} parity packets"
+        )
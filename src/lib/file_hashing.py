@@ -1,12 +1,255 @@
-from lib.constants import BLOCK_SIZE
+from lib.constants import (
+    BLOCK_SIZE,
+    DEFAULT_HASH_ALGORITHM,
+    HASH_ALGORITHMS,
+    HASH_BLOCK_PACKETS,
+    HASH_THREADS,
+    DEFAULT_PAYLOAD_SIZE,
+)
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Event, Lock
+from math import ceil
+import logging
 import hashlib
+import os
 
+"""
+Hashing
+Cada archivo se divide en bloques de HASH_BLOCK_PACKETS paquetes y se
+calcula el digest de cada bloque (las hojas) con el algoritmo negociado en
+el handshake. El hash del archivo es la raiz del arbol de Merkle armado
+sobre las hojas: cada nodo es el hash de la concatenacion de sus dos hijos
+y un nodo sin hermano sube tal cual. Un archivo vacio no tiene hojas y su
+hash es el de la cadena vacia.
+"""
 
-def hashing(file_path):
-    file_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-        fb = f.read(BLOCK_SIZE)
-        while len(fb) > 0:
-            file_hash.update(fb)
-            fb = f.read(BLOCK_SIZE)
-    return file_hash.digest()
+
+def new_hash(algorithm=DEFAULT_HASH_ALGORITHM):
+    return hashlib.new(algorithm)
+
+
+def digest_size(algorithm):
+    return new_hash(algorithm).digest_size
+
+
+def hash_block_size(chunk_size=DEFAULT_PAYLOAD_SIZE):
+    return HASH_BLOCK_PACKETS * chunk_size
+
+
+def hash_blocks(file_size, chunk_size=DEFAULT_PAYLOAD_SIZE):
+    return ceil(file_size / hash_block_size(chunk_size))
+
+
+def choose_hash_algorithm(offered) -> str:
+    for algorithm in offered:
+        if algorithm in HASH_ALGORITHMS:
+            return algorithm
+    return None
+
+
+def merkle_root(algorithm, leaves: list[bytes]) -> bytes:
+    if not leaves:
+        return new_hash(algorithm).digest()
+    level = leaves
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            parent = new_hash(algorithm)
+            parent.update(level[i])
+            parent.update(level[i + 1])
+            parents.append(parent.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def split_leaves(algorithm, data) -> list[bytes]:
+    size = digest_size(algorithm)
+    return [bytes(data[i : i + size]) for i in range(0, len(data), size)]
+
+
+def hash_range(fd, offset, length, algorithm) -> bytes:
+    block_hash = new_hash(algorithm)
+    end = offset + length
+    while offset < end:
+        data = os.pread(fd, min(BLOCK_SIZE, end - offset), offset)
+        if not data:
+            break
+        block_hash.update(data)
+        offset += len(data)
+    return block_hash.digest()
+
+
+hashing_pool_lock = Lock()
+hashing_pool = None
+
+
+def shared_hashing_pool() -> ThreadPoolExecutor:
+    global hashing_pool
+    with hashing_pool_lock:
+        if hashing_pool is None:
+            hashing_pool = ThreadPoolExecutor(
+                max_workers=HASH_THREADS, thread_name_prefix="hashing"
+            )
+        return hashing_pool
+
+
+class StreamingHash:
+    """
+    Hojas del arbol de un archivo calculadas en segundo plano a medida que
+    se conocen los datos, en orden, mientras la transferencia sigue por la
+    red. Los datos pueden ser buffers (que no deben modificarse hasta pedir
+    el digest), rangos de un archivo abierto que se leen con pread, ya
+    escritos y por lo tanto en el page cache, u hojas ya conocidas de
+    bloques enteros.
+
+    Los datos se procesan en un pool de HASH_THREADS threads compartido por
+    todas las transferencias: mientras hay datos encolados un trabajo del
+    pool los consume, y termina al vaciar la cola, por lo que un hash que
+    espera datos no ocupa un thread. Despues de finish() no hay mas datos y
+    el pool cierra el arbol y llama a on_digest con las hojas (o con None
+    si no se pudieron leer los datos). digest() termina, espera el arbol y
+    devuelve la raiz. Se puede pedir desde varios threads, como las sesiones
+    de una subida en partes o las descargas de un mismo archivo.
+    """
+
+    def __init__(
+        self,
+        algorithm=DEFAULT_HASH_ALGORITHM,
+        chunk_size=DEFAULT_PAYLOAD_SIZE,
+        on_digest=None,
+    ):
+        self.algorithm = algorithm
+        self.block_size = hash_block_size(chunk_size)
+        self.block_hash = new_hash(algorithm)
+        self.block_filled = 0
+        self.leaves: list[bytes] = []
+        self.blocks = deque()
+        self.result = None
+        self.on_digest = on_digest
+        self.lock = Lock()
+        self.draining = False
+        self.finished = False
+        self.failed = False
+        self.done = Event()
+
+    def enqueue(self, item):
+        with self.lock:
+            self.blocks.append(item)
+            if self.draining:
+                return
+            self.draining = True
+        shared_hashing_pool().submit(self.run)
+
+    def update(self, data):
+        self.enqueue(data)
+
+    def update_from(self, fd, offset, length):
+        self.enqueue((fd, offset, length))
+
+    def add_leaf(self, leaf):
+        # Hoja ya conocida de un bloque completo, en lugar de sus datos
+        self.enqueue((leaf,))
+
+    def update_all(self, data):
+        """
+        Encola todo el contenido de un archivo y termina.
+        """
+        for offset in range(0, len(data), self.block_size):
+            self.update(data[offset : offset + self.block_size])
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.enqueue(None)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.blocks:
+                    self.draining = False
+                    return
+                data = self.blocks.popleft()
+            if data is None:
+                self.close()
+                continue
+            if self.failed:
+                continue
+            try:
+                if isinstance(data, tuple) and len(data) == 1:
+                    self.leaves.append(data[0])
+                elif isinstance(data, tuple):
+                    self.read(*data)
+                else:
+                    self.feed(memoryview(data))
+            except (OSError, ValueError) as e:
+                # Por ejemplo si el archivo ya se cerro: la raiz no va a
+                # coincidir con la del otro extremo
+                logging.error(f"❌ Could not hash {self.algorithm} data: {e}")
+                self.failed = True
+
+    def read(self, fd, offset, length):
+        end = offset + length
+        while offset < end:
+            data = os.pread(fd, min(BLOCK_SIZE, end - offset), offset)
+            if not data:
+                break
+            self.feed(memoryview(data))
+            offset += len(data)
+
+    def feed(self, data: memoryview):
+        while len(data) > 0:
+            length = min(len(data), self.block_size - self.block_filled)
+            self.block_hash.update(data[:length])
+            self.block_filled += length
+            data = data[length:]
+            if self.block_filled == self.block_size:
+                self.end_block()
+
+    def end_block(self):
+        self.leaves.append(self.block_hash.digest())
+        self.block_hash = new_hash(self.algorithm)
+        self.block_filled = 0
+
+    def close(self):
+        if self.block_filled:
+            self.end_block()
+        self.result = merkle_root(self.algorithm, self.leaves)
+        self.done.set()
+        if self.on_digest:
+            self.on_digest(None if self.failed else self.leaves)
+
+    def digest(self) -> bytes:
+        self.finish()
+        self.done.wait()
+        return self.result
+
+
+class KnownDigest:
+    """
+    Arbol ya calculado, con la misma interfaz que StreamingHash.
+    """
+
+    def __init__(self, algorithm, leaves: list[bytes]):
+        self.algorithm = algorithm
+        self.leaves = leaves
+        self.result = merkle_root(algorithm, leaves)
+
+    def digest(self) -> bytes:
+        return self.result
+
+
+def hash_in_background(
+    data,
+    algorithm=DEFAULT_HASH_ALGORITHM,
+    chunk_size=DEFAULT_PAYLOAD_SIZE,
+    on_digest=None,
+) -> StreamingHash:
+    file_hash = StreamingHash(algorithm, chunk_size, on_digest)
+    file_hash.update_all(data)
+    return file_hash
@@ -0,0 +1,324 @@
+from lib.constants import (
+    HASH_BLOCK_PACKETS,
+    INVALID_FILE_BLOCKS,
+    INVALID_FILE_HASHING,
+    MAX_LENGTH,
+    MAX_REPAIR_ROUNDS,
+)
+from lib.file_hashing import digest_size, hash_blocks, merkle_root
+from lib.compression import CompressedFile, create_compression
+from lib.preallocated_file import PreallocatedFile
+from lib.message import Message, MessageType
+from lib.mapped_file import MappedFile
+from math import ceil
+import logging
+import struct
+
+"""
+Transferencia de un archivo
+El emisor envia los paquetes del archivo seguidos de las hojas de su arbol
+de hashes (ver file_hashing) y luego un FIN cuyo payload es la raiz del
+arbol. El receptor compara cada hoja con la de su copia: si todas coinciden
+responde con ACK, y si no pide los bloques que fallaron con un ERROR de
+codigo INVALID_FILE_BLOCKS seguido de los numeros de bloque (4 bytes cada
+uno). El emisor vuelve a enviar solo esos bloques, con numeros de paquete a
+partir del FIN anterior, y otro FIN. Si despues de MAX_REPAIR_ROUNDS rondas
+sigue habiendo bloques invalidos, o si las hojas recibidas no corresponden a
+la raiz, el receptor responde con un ERROR de codigo INVALID_FILE_HASHING.
+
+Al reanudar una transferencia interrumpida, el emisor envia solo los
+paquetes de los bloques que el receptor no tiene (numerados desde 0) y
+despues todas las hojas, por lo que se verifican tambien los bloques que
+ya estaban escritos.
+
+En una transferencia en partes (ver assembly), cada sesion envia de la
+misma forma solo los paquetes de su rango de bloques y todas las hojas,
+y el receptor verifica solo los bloques de ese rango.
+
+En un lote de archivos, apenas recibe la respuesta final al FIN de un
+archivo el emisor empieza a enviar el siguiente, con numeros de paquete a
+partir de ese FIN, sin un nuevo handshake. El receptor no espera a que
+terminen los FIN repetidos: pasa al siguiente archivo y vuelve a enviar su
+respuesta cada vez que le llega el FIN anterior. Solo despues del ultimo
+archivo espera a que el emisor deje de repetirlo.
+"""
+
+BLOCK_NUMBER_FORMAT = struct.Struct("!I")
+MAX_REQUESTED_BLOCKS = (MAX_LENGTH - 1) // BLOCK_NUMBER_FORMAT.size
+
+
+def encode_block_request(blocks) -> bytes:
+    return INVALID_FILE_BLOCKS.to_bytes(1, "big") + b"".join(
+        BLOCK_NUMBER_FORMAT.pack(block) for block in blocks
+    )
+
+
+def decode_block_request(payload) -> list[int]:
+    return [block for (block,) in BLOCK_NUMBER_FORMAT.iter_unpack(payload[1:])]
+
+
+def is_block_request(message: Message):
+    return (
+        message.type == MessageType.ERROR
+        and len(message.payload) > 0
+        and message.payload[0] == INVALID_FILE_BLOCKS
+    )
+
+
+def is_invalid_checksum(message: Message):
+    return (
+        message.type == MessageType.ERROR
+        and len(message.payload) > 0
+        and (message.payload[0] in (INVALID_FILE_HASHING, INVALID_FILE_BLOCKS))
+    )
+
+
+def block_packets(blocks, packets) -> list[int]:
+    return [
+        index
+        for block in blocks
+        for index in range(
+            block * HASH_BLOCK_PACKETS,
+            min((block + 1) * HASH_BLOCK_PACKETS, packets),
+        )
+    ]
+
+
+def range_packets(block_range, packets) -> range:
+    first, end = block_range
+    return range(
+        min(first * HASH_BLOCK_PACKETS, packets), min(end * HASH_BLOCK_PACKETS, packets)
+    )
+
+
+def missing_blocks(file, held_blocks) -> list[int]:
+    held_blocks = set(held_blocks)
+    return [
+        block
+        for block in range(hash_blocks(file.size, file.chunk_size))
+        if block not in held_blocks
+    ]
+
+
+class BlockSelection:
+    """
+    Paquetes de algunos bloques de un archivo, numerados desde 0, para
+    volver a enviarlos (sobre un MappedFile) o recibirlos (sobre un
+    PreallocatedFile).
+    """
+
+    def __init__(self, file, blocks):
+        self.file = file
+        self.chunk_size = file.chunk_size
+        self.indexes = block_packets(blocks, file.packets)
+        self.packets = len(self.indexes)
+
+    def packet(self, index) -> memoryview:
+        return self.file.packet(self.indexes[index])
+
+    def data_length(self, index):
+        return 0
+
+    def write(self, index, payload) -> int:
+        self.file.write(self.indexes[index], payload)
+        return 0
+
+
+class ResumedFile:
+    """
+    Destino de una transferencia reanudada: los paquetes de los bloques que
+    faltan, numerados desde 0, seguidos de las hojas del emisor.
+    """
+
+    def __init__(self, file: PreallocatedFile):
+        self.file = file
+        self.indexes = (
+            range_packets(file.block_range, file.packets)
+            if file.block_range
+            else block_packets(missing_blocks(file, file.held_blocks), file.packets)
+        )
+
+    def write(self, index, payload) -> int:
+        if index < len(self.indexes):
+            return self.file.write(self.indexes[index], payload)
+        return self.file.write(self.file.packets + index - len(self.indexes), payload)
+
+
+class TransferSource:
+    """
+    Paquetes a enviar: los del archivo (o solo los de los bloques que no
+    estan en held_blocks, al reanudar, o los de block_range, en una
+    transferencia en partes) seguidos de las hojas de todo su arbol de
+    hashes. Las hojas se calculan en segundo plano mientras se envian los
+    datos y se esperan recien al armar el primer paquete que las lleva. Con
+    compression, los paquetes del archivo se envian comprimidos (ver
+    compression).
+    """
+
+    def __init__(
+        self,
+        file: MappedFile,
+        file_hash,
+        held_blocks=(),
+        compression=None,
+        block_range=None,
+    ):
+        if compression:
+            file = CompressedFile(file, create_compression(compression))
+        self.file = file
+        self.file_hash = file_hash
+        self.chunk_size = file.chunk_size
+        if block_range:
+            self.indexes = range_packets(block_range, file.packets)
+        elif held_blocks:
+            self.indexes = block_packets(
+                missing_blocks(file, held_blocks), file.packets
+            )
+        else:
+            self.indexes = range(file.packets)
+        self.data_packets = len(self.indexes)
+        self.resumed_length = file.size - sum(map(file.packet_length, self.indexes))
+        trailer_size = hash_blocks(file.size, file.chunk_size) * digest_size(
+            file_hash.algorithm
+        )
+        self.packets = self.data_packets + ceil(trailer_size / self.chunk_size)
+        self.trailer = None
+
+    def packet(self, index) -> memoryview:
+        if index < self.data_packets:
+            return self.file.packet(self.indexes[index])
+        if self.trailer is None:
+            self.file_hash.digest()
+            self.trailer = memoryview(b"".join(self.file_hash.leaves))
+        offset = (index - self.data_packets) * self.chunk_size
+        return self.trailer[offset : offset + self.chunk_size]
+
+    def data_length(self, index):
+        if index < self.data_packets:
+            return self.file.packet_length(self.indexes[index])
+        return 0
+
+    def digest(self) -> bytes:
+        return self.file_hash.digest()
+
+    def select(self, blocks) -> BlockSelection:
+        return BlockSelection(self.file, blocks)
+
+
+async def send_file(sender, source: TransferSource, last_packet_number) -> Message:
+    """
+    Envia el archivo, sus hojas y el FIN, repitiendo los bloques que pida el
+    receptor. Devuelve la respuesta final del receptor al FIN.
+    """
+    if sender.progress_bar and source.resumed_length:
+        sender.progress_bar.update(source.resumed_length)
+    last_packet_number = await sender.send(source, last_packet_number)
+    while True:
+        # Puede esperar al hash y guardar las hojas en la cache de digests
+        digest = await sender.transport.offload(source.digest)
+        fin = Message(MessageType.FIN, pos=last_packet_number + 1, payload=digest)
+        reply = await sender.finish(fin)
+        if not is_block_request(reply):
+            if isinstance(source.file, CompressedFile):
+                logging.info(f"🗜️ {sender.peer()} {source.file}")
+            return reply
+
+        blocks = decode_block_request(reply.payload)
+        logging.warn(f"🔁 {sender.peer()} Resending {len(blocks)} corrupted blocks")
+        last_packet_number = await sender.send(source.select(blocks), fin.pos)
+
+
+def mismatched_blocks(file: PreallocatedFile, root) -> list[int] | None:
+    """
+    Bloques cuya hoja no coincide con la del emisor, o None si las hojas
+    recibidas no corresponden a la raiz del FIN. De una parte solo se
+    comparan los bloques de su rango.
+    """
+    remote_leaves = file.remote_leaves()
+    local_leaves = file.local_leaves()
+    if merkle_root(file.algorithm, remote_leaves) != root:
+        return None
+    if len(local_leaves) != len(remote_leaves):
+        return None
+    return [
+        block
+        for block, (local, remote) in enumerate(zip(local_leaves, remote_leaves))
+        if local != remote and file.in_range(block)
+    ]
+
+
+async def receive_file(
+    receiver,
+    file: PreallocatedFile,
+    rtt,
+    first_message=None,
+    previous_reply=None,
+    linger=True,
+) -> Message:
+    """
+    Recibe el archivo y verifica sus bloques, pidiendo de nuevo los que no
+    coinciden. Si es valido lo mueve a su ruta de destino (o lo entrega al
+    armado, si es una parte), y si no se descartan los bloques invalidos
+    del estado para reanudar. Devuelve la
+    respuesta final al FIN, que se repite mientras el emisor siga
+    reenviando su FIN. Sin linger la respuesta no se envia: en un lote se
+    envia al recibir el archivo siguiente, como su previous_reply, y en una
+    subida delta despues de armar el archivo (ver send_reply).
+    """
+    target = file
+    if file.held_blocks:
+        target = ResumedFile(file)
+        if receiver.progress_bar:
+            receiver.progress_bar.update(file.resumed_length)
+    fin = await receiver.receive(target, first_message, request=previous_reply)
+    rounds = 0
+    while True:
+        # Espera a que termine el hash sin bloquear el motor asyncio
+        await receiver.transport.offload(file.local_leaves)
+        blocks = mismatched_blocks(file, bytes(fin.payload))
+        if blocks == [] and await receiver.transport.offload(
+            file.commit, bytes(fin.payload)
+        ):
+            reply = Message(MessageType.ACK, pos=fin.pos)
+            break
+        if blocks == []:
+            # La verificacion final del armado fallo
+            blocks = None
+        if blocks is None or rounds == MAX_REPAIR_ROUNDS:
+            file.invalid_blocks = None if blocks is None else set(blocks)
+            error_code = INVALID_FILE_HASHING
+            reply = Message(
+                MessageType.ERROR,
+                pos=fin.pos,
+                payload=error_code.to_bytes(1, "big"),
+            )
+            break
+
+        rounds += 1
+        blocks = blocks[:MAX_REQUESTED_BLOCKS]
+        logging.warn(f"🔁 {len(blocks)} corrupted blocks, requesting them again")
+        request = Message(
+            MessageType.ERROR, pos=fin.pos, payload=encode_block_request(blocks)
+        )
+        receiver.restart(fin.pos)
+        fin = await receiver.receive(BlockSelection(file, blocks), request=request)
+        await receiver.transport.offload(file.rehash, blocks)
+
+    if linger:
+        await send_reply(receiver, reply, rtt)
+    return reply
+
+
+async def send_reply(receiver, reply, rtt):
+    """
+    Envia la respuesta final al FIN y la repite mientras el emisor siga
+    reenviando su FIN.
+    """
+    receiver.transport.settimeout(rtt.linger_timeout())
+    while True:
+        receiver.transport.send(reply, receiver.peer_address)
+        logging.info(f"Sent {reply}")
+        try:
+            _, receiver.peer_address = await receiver.transport.receive()
+        except TimeoutError:
+            break
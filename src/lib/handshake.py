@@ -0,0 +1,343 @@
+from lib.constants import (
+    BATCH_MAX_FILES,
+    BATCH_NAMES_SIZE,
+    DEFAULT_HASH_ALGORITHM,
+    DEFAULT_PAYLOAD_SIZE,
+    MAX_STREAMS,
+    PREFETCH_NAMES_SIZE,
+)
+from lib.fec import decode_fec, encode_fec
+from lib.delta import decode_delta_base, encode_delta_base
+from enum import IntEnum
+from math import ceil
+import struct
+
+"""
+Handshake
+El payload de las solicitudes lleva el nombre del archivo seguido de un byte
+nulo y una lista de opciones TLV: tipo (1 byte), largo (2 bytes) y valor.
+Las opciones que una de las partes no conoce se ignoran. Las respuestas
+del servidor (OK de la descarga y ACK de la subida) llevan en el payload
+solo las opciones acordadas para la transferencia.
+
+Una solicitud con la opcion PADDING es una prueba del MTU del camino (ver
+Client): el servidor completa su respuesta con PADDING hasta el mismo
+tamaño, para probar tambien el camino de vuelta.
+
+Una solicitud de un lote de archivos, que se transfieren uno detras de
+otro en la misma sesion (ver file_transfer), lleva el nombre vacio y
+los nombres en la opcion FILENAMES, separados por bytes nulos. En la
+subida el cliente manda ademas sus tamaños en FILE_SIZES (8 bytes cada
+uno), y en la descarga el servidor los responde en la misma opcion, con
+MISSING_FILE_SIZE para los archivos que no tiene.
+
+Una transferencia en partes (ver assembly) usa una sesion por parte. La
+solicitud de cada una lleva en STREAM su indice y la cantidad de partes
+(2 bytes cada uno), y la respuesta el rango de bloques que le toca en
+BLOCK_RANGE (el primero y el siguiente al ultimo, 4 bytes cada uno). En la
+subida, todas las partes de un archivo llevan el mismo numero de armado en
+ASSEMBLY, que el servidor usa para juntarlas.
+
+Una solicitud de descarga con la opcion SIGNATURE pide la firma de la
+copia del archivo en lugar del archivo, y una subida con la opcion DELTA
+envia un delta respecto de esa copia en lugar del archivo (ver delta).
+Con la opcion CHUNKS, una subida ofrece los ids de los chunks de su archivo
+y el servidor responde como bloques ya recibidos los que ya tiene (ver
+chunk_store).
+
+Una solicitud de descarga puede llevar en PREFETCH los nombres de los
+archivos que el cliente va a pedir despues, separados por bytes nulos,
+para que el servidor los vaya cargando en su cache (ver block_cache).
+"""
+
+OPTION_HEADER_FORMAT = struct.Struct("!BH")
+FILENAME_SEPARATOR = b"\0"
+FILE_SIZE_FORMAT = struct.Struct("!Q")
+MISSING_FILE_SIZE = 2**64 - 1
+STREAM_FORMAT = struct.Struct("!HH")
+BLOCK_RANGE_FORMAT = struct.Struct("!II")
+
+
+class HandshakeOption(IntEnum):
+    FILE_SIZE = 1
+    HASH_ALGORITHMS = 2
+    HASH_ALGORITHM = 3
+    RESUME_BLOCKS = 4
+    FEC = 5
+    PAYLOAD_SIZE = 6
+    PADDING = 7
+    COMPRESSIONS = 8
+    COMPRESSION = 9
+    FILENAMES = 10
+    FILE_SIZES = 11
+    STREAM = 12
+    BLOCK_RANGE = 13
+    ASSEMBLY = 14
+    SIGNATURE = 15
+    DELTA = 16
+    CHUNKS = 17
+    PREFETCH = 18
+
+
+def encode_int(value) -> bytes:
+    return value.to_bytes(length=max(1, ceil(value.bit_length() / 8)), byteorder="big")
+
+
+def decode_int(value) -> int:
+    return int.from_bytes(value, byteorder="big")
+
+
+def encode_options(options: dict) -> bytes:
+    payload = bytearray()
+    for option, value in options.items():
+        payload += OPTION_HEADER_FORMAT.pack(option, len(value))
+        payload += value
+    return bytes(payload)
+
+
+def decode_options(payload) -> dict:
+    options = {}
+    offset = 0
+    while offset + OPTION_HEADER_FORMAT.size <= len(payload):
+        option, length = OPTION_HEADER_FORMAT.unpack_from(payload, offset)
+        offset += OPTION_HEADER_FORMAT.size
+        options[option] = bytes(payload[offset : offset + length])
+        offset += length
+    return options
+
+
+def pad_options(payload, length) -> bytes:
+    # La opcion vacia ya ocupa su header
+    padding = length - len(payload) - OPTION_HEADER_FORMAT.size
+    if padding < 0:
+        return payload
+    return payload + encode_options({HandshakeOption.PADDING: bytes(padding)})
+
+
+def encode_request(filename, options: dict, length=0) -> bytes:
+    """
+    Con length, la solicitud se completa con PADDING hasta ese tamaño.
+    """
+    return pad_options(
+        filename.encode() + FILENAME_SEPARATOR + encode_options(options), length
+    )
+
+
+def decode_request(payload) -> tuple[str, dict]:
+    filename, _, options = bytes(payload).partition(FILENAME_SEPARATOR)
+    return filename.decode(), decode_options(options)
+
+
+def is_batch_request(payload) -> bool:
+    filename, options = decode_request(payload)
+    return not filename and HandshakeOption.FILENAMES in options
+
+
+def is_signature_request(payload) -> bool:
+    _, options = decode_request(payload)
+    return HandshakeOption.SIGNATURE in options
+
+
+def encode_names(names) -> bytes:
+    return ",".join(names).encode()
+
+
+def decode_names(value) -> list[str]:
+    return value.decode().split(",") if value else []
+
+
+def encode_filenames(names) -> bytes:
+    return FILENAME_SEPARATOR.join(name.encode() for name in names)
+
+
+def decode_filenames(value) -> list[str]:
+    return [name.decode() for name in value.split(FILENAME_SEPARATOR)] if value else []
+
+
+def encode_prefetch(names) -> bytes:
+    """
+    Los primeros nombres que entran en PREFETCH_NAMES_SIZE bytes.
+    """
+    size = 0
+    fitting = []
+    for name in names:
+        size += len(name.encode()) + len(FILENAME_SEPARATOR)
+        if size > PREFETCH_NAMES_SIZE:
+            break
+        fitting.append(name)
+    return encode_filenames(fitting)
+
+
+def encode_sizes(sizes) -> bytes:
+    return b"".join(
+        FILE_SIZE_FORMAT.pack(MISSING_FILE_SIZE if size is None else size)
+        for size in sizes
+    )
+
+
+def decode_sizes(value) -> list[int | None]:
+    return [
+        None if size == MISSING_FILE_SIZE else size
+        for (size,) in FILE_SIZE_FORMAT.iter_unpack(
+            value[: len(value) - len(value) % FILE_SIZE_FORMAT.size]
+        )
+    ]
+
+
+def encode_stream(stream) -> bytes:
+    return STREAM_FORMAT.pack(*stream)
+
+
+def decode_stream(value) -> tuple[int, int] | None:
+    if len(value) != STREAM_FORMAT.size:
+        return None
+    index, count = STREAM_FORMAT.unpack(value)
+    if not index < count <= MAX_STREAMS:
+        return None
+    return index, count
+
+
+def encode_block_range(block_range) -> bytes:
+    return BLOCK_RANGE_FORMAT.pack(*block_range)
+
+
+def decode_block_range(value) -> tuple[int, int] | None:
+    if len(value) != BLOCK_RANGE_FORMAT.size:
+        return None
+    return BLOCK_RANGE_FORMAT.unpack(value)
+
+
+def split_batch(names) -> list[list[str]]:
+    """
+    Separa los nombres de un lote en grupos que entran en la solicitud de
+    una sesion: hasta BATCH_MAX_FILES archivos y BATCH_NAMES_SIZE bytes de
+    nombres, para que la solicitud no se fragmente.
+    """
+    groups = [[]]
+    size = 0
+    for name in names:
+        length = len(name.encode()) + len(FILENAME_SEPARATOR)
+        if groups[-1] and (
+            len(groups[-1]) == BATCH_MAX_FILES or size + length > BATCH_NAMES_SIZE
+        ):
+            groups.append([])
+            size = 0
+        groups[-1].append(name)
+        size += length
+    return groups if groups[-1] else []
+
+
+def encode_bitmap(numbers) -> bytes:
+    bitmap = bytearray(ceil((max(numbers, default=-1) + 1) / 8))
+    for number in numbers:
+        bitmap[number // 8] |= 0x80 >> (number % 8)
+    return bytes(bitmap)
+
+
+def decode_bitmap(value) -> list[int]:
+    return [
+        i * 8 + bit
+        for i, byte in enumerate(value)
+        if byte
+        for bit in range(8)
+        if byte & (0x80 >> bit)
+    ]
+
+
+class TransferOptions:
+    """
+    Parametros de una transferencia acordados en el handshake. El cliente
+    ofrece en su solicitud los algoritmos de hash que acepta, en orden de
+    preferencia, y el servidor responde con las opciones elegidas.
+
+    resume_blocks son los bloques (ver file_hashing) que el receptor ya
+    tiene de una transferencia interrumpida y que no se vuelven a enviar.
+    fec son los paquetes de datos y de paridad por bloque (ver fec), si el
+    servidor acepto los que pidio el cliente. payload_size es el tamaño de
+    los paquetes de datos: el cliente ofrece el mayor que acepta y el
+    servidor elige uno que no lo supere. compression es el algoritmo con el
+    que se comprimen los paquetes de datos (ver compression), si el servidor
+    acepto alguno de los que ofrecio el cliente. file_sizes son los tamaños
+    de los archivos de un lote, en el orden en que se transfieren.
+    block_range es el rango de bloques de una parte de una transferencia en
+    varias sesiones, y assembly_id el numero de armado de una subida en
+    partes (ver assembly). delta_base es el tamaño y el mtime_ns de la
+    copia contra la que se armo el delta de una subida delta (ver delta).
+    """
+
+    def __init__(
+        self,
+        file_size=0,
+        hash_algorithm=DEFAULT_HASH_ALGORITHM,
+        resume_blocks=(),
+        fec=None,
+        payload_size=DEFAULT_PAYLOAD_SIZE,
+        compression=None,
+        file_sizes=None,
+        block_range=None,
+        assembly_id=None,
+        delta_base=None,
+    ):
+        self.file_size = file_size
+        self.hash_algorithm = hash_algorithm
+        self.resume_blocks = list(resume_blocks)
+        self.fec = fec
+        self.payload_size = payload_size
+        self.compression = compression
+        self.file_sizes = file_sizes
+        self.block_range = block_range
+        self.assembly_id = assembly_id
+        self.delta_base = delta_base
+
+    def encode(self, length=0) -> bytes:
+        options = {
+            HandshakeOption.FILE_SIZE: encode_int(self.file_size),
+            HandshakeOption.HASH_ALGORITHM: self.hash_algorithm.encode(),
+            HandshakeOption.PAYLOAD_SIZE: encode_int(self.payload_size),
+        }
+        if self.resume_blocks:
+            options[HandshakeOption.RESUME_BLOCKS] = encode_bitmap(self.resume_blocks)
+        if self.fec:
+            options[HandshakeOption.FEC] = encode_fec(self.fec)
+        if self.compression:
+            options[HandshakeOption.COMPRESSION] = self.compression.encode()
+        if self.file_sizes is not None:
+            options[HandshakeOption.FILE_SIZES] = encode_sizes(self.file_sizes)
+        if self.block_range is not None:
+            options[HandshakeOption.BLOCK_RANGE] = encode_block_range(self.block_range)
+        if self.assembly_id is not None:
+            options[HandshakeOption.ASSEMBLY] = encode_int(self.assembly_id)
+        if self.delta_base is not None:
+            options[HandshakeOption.DELTA] = encode_delta_base(self.delta_base)
+        return pad_options(encode_options(options), length)
+
+    @classmethod
+    def decode(cls, payload) -> "TransferOptions":
+        options = decode_options(payload)
+        return cls(
+            file_size=decode_int(options.get(HandshakeOption.FILE_SIZE, b"")),
+            hash_algorithm=options.get(
+                HandshakeOption.HASH_ALGORITHM, DEFAULT_HASH_ALGORITHM.encode()
+            ).decode(),
+            resume_blocks=decode_bitmap(
+                options.get(HandshakeOption.RESUME_BLOCKS, b"")
+            ),
+            fec=decode_fec(options.get(HandshakeOption.FEC, b"")),
+            payload_size=decode_int(options.get(HandshakeOption.PAYLOAD_SIZE, b""))
+            or DEFAULT_PAYLOAD_SIZE,
+            compression=options.get(HandshakeOption.COMPRESSION, b"").decode() or None,
+            file_sizes=(
+                decode_sizes(options[HandshakeOption.FILE_SIZES])
+                if HandshakeOption.FILE_SIZES in options
+                else None
+            ),
+            block_range=decode_block_range(
+                options.get(HandshakeOption.BLOCK_RANGE, b"")
+            ),
+            assembly_id=(
+                decode_int(options[HandshakeOption.ASSEMBLY])
+                if HandshakeOption.ASSEMBLY in options
+                else None
+            ),
+            delta_base=decode_delta_base(options.get(HandshakeOption.DELTA, b"")),
+        )
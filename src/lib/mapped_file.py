@@ -0,0 +1,64 @@
+from lib.constants import DEFAULT_PAYLOAD_SIZE, READ_BINARY_MODE
+from mmap import mmap, ACCESS_READ
+from math import ceil
+
+
+class MappedFile:
+    """
+    Archivo a enviar mapeado en memoria. Los paquetes se arman con vistas
+    sobre el mapeo, sin leer ni copiar el contenido, por lo que el emisor
+    solo necesita recordar el indice de cada paquete en vuelo para poder
+    retransmitirlo.
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_PAYLOAD_SIZE):
+        self.chunk_size = chunk_size
+        self.file = open(path, READ_BINARY_MODE)
+        self.size = self.file.seek(0, 2)
+        self.packets = ceil(self.size / chunk_size)
+        # No se puede mapear un archivo vacio
+        self.map = (
+            mmap(self.file.fileno(), 0, access=ACCESS_READ) if self.size else None
+        )
+        self.view = memoryview(self.map) if self.map else memoryview(b"")
+
+    def packet(self, index) -> memoryview:
+        offset = index * self.chunk_size
+        return self.view[offset : offset + self.chunk_size]
+
+    def packet_length(self, index):
+        return max(0, min(self.chunk_size, self.size - index * self.chunk_size))
+
+    def close(self):
+        self.view.release()
+        if self.map:
+            try:
+                self.map.close()
+            except BufferError:
+                # Todavia hay paquetes armados sobre el mapeo (por ejemplo en
+                # el traceback de una excepcion): se libera al recolectarlos
+                pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class BufferFile(MappedFile):
+    """
+    Contenido en memoria que se envia como un archivo, como la firma de una
+    subida delta (ver delta).
+    """
+
+    def __init__(self, data, chunk_size=DEFAULT_PAYLOAD_SIZE):
+        self.chunk_size = chunk_size
+        self.size = len(data)
+        self.packets = ceil(self.size / chunk_size)
+        self.map = None
+        self.view = memoryview(data)
+
+    def close(self):
+        self.view.release()
@@ -5,9 +5,11 @@ from lib.constants import (
     MAX_LENGTH,
     MIN_ACK,
     PAYLOAD_START,
-    TYPE_DEC_SHIFT,
     TYPE_ENC_SHIFT,
 )
+import struct
+
+HEADER_FORMAT = struct.Struct("!HI")
 
 
 class MessageType(Enum):
@@ -17,10 +19,12 @@ class MessageType(Enum):
     ERROR: int = 3
     FIN: int = 4
     ACK: int = 5
+    BUSY: int = 6
+    PARITY: int = 7
 
 
 class Message:
-    def __init__(self, type: MessageType, pos: int, payload: bytes = bytes()):
+    def __init__(self, type: MessageType, pos: int, payload=bytes()):
         if pos < MIN_ACK or MAX_ACK < pos:
             raise ValueError(
                 f"Message pos number ({pos}) is not within 0 to 4294967295 range"
@@ -37,24 +41,26 @@ class Message:
         self.payload = payload
 
     @classmethod
-    def decode(cls, message_bytes: bytes):
-        type = int.from_bytes(message_bytes[:1], "big") >> TYPE_DEC_SHIFT
-        length = int.from_bytes(message_bytes[:2], "big") & LENGTH_FILTER
-        pos = int.from_bytes(message_bytes[2:6], "big")
+    def decode(cls, message_bytes):
+        """
+        Si message_bytes es un memoryview, el payload es una vista sobre el
+        mismo buffer (sin copia): solo es valido mientras no se reutilice.
+        """
+        type_plus_length, pos = HEADER_FORMAT.unpack_from(message_bytes)
+        type = type_plus_length >> TYPE_ENC_SHIFT
+        length = type_plus_length & LENGTH_FILTER
 
         payload_end = PAYLOAD_START + length
         payload = message_bytes[PAYLOAD_START:payload_end]
 
         return cls(MessageType(type), pos, payload)
 
-    def encode(self) -> bytes:
+    def header(self) -> bytes:
         type_plus_length = (self.type.value << TYPE_ENC_SHIFT) | self.length
+        return HEADER_FORMAT.pack(type_plus_length, self.pos)
 
-        message_bytes = type_plus_length.to_bytes(2, "big")
-        message_bytes += self.pos.to_bytes(4, "big")
-        message_bytes += self.payload
-
-        return message_bytes
+    def encode(self) -> bytes:
+        return self.header() + self.payload
 
     def __gt__(self, other):
         return self.pos > other.pos
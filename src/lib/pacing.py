@@ -0,0 +1,103 @@
+from lib.constants import (
+    HEADER_SIZE,
+    PACING_AUTO,
+    PACING_BURST_PACKETS,
+    PACING_GAIN,
+    PACING_SLOW_START_GAIN,
+    DEFAULT_PAYLOAD_SIZE,
+)
+from lib.egress_scheduler import parse_rate
+from threading import Lock
+from time import monotonic
+
+
+def parse_pacing(value: str):
+    """
+    auto (derivada de la ventana y el RTT), off o una tasa (ver parse_rate).
+    """
+    if value == PACING_AUTO:
+        return PACING_AUTO
+    if value == "off":
+        return None
+    return parse_rate(value)
+
+
+class TokenBucket:
+    """
+    Cubeta de tokens en bytes: se llena a rate bytes por segundo y acumula
+    hasta burst. reserve toma los bytes de un envio y devuelve los segundos
+    que hay que esperar hasta que la cubeta los tenga, con la precision de
+    monotonic. El saldo puede quedar negativo: lo pagan los envios
+    siguientes, por lo que las esperas muy cortas se pueden saltear sin
+    superar la tasa. Se puede compartir entre threads.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill(monotonic())
+            self.rate = rate
+
+    def reserve(self, size) -> float:
+        with self.lock:
+            self.refill(monotonic())
+            self.tokens -= size
+            if self.tokens >= 0 or not self.rate:
+                return 0
+            return -self.tokens / self.rate
+
+    def __str__(self):
+        return f"{self.rate:.0f} B/s"
+
+
+class SessionPacer:
+    """
+    Espaciado de los envios de una sesion de Selective Repeat, para que la
+    ventana no salga en rafagas que desbordan los buffers del camino. Con
+    rate fija se envia a esa tasa; con PACING_AUTO la tasa se deriva de la
+    ventana de congestion y el RTT, como el pacing de TCP: cwnd paquetes por
+    srtt, por PACING_SLOW_START_GAIN en slow start (para que la ventana pueda
+    seguir creciendo) o PACING_GAIN despues. Hasta la primera muestra de RTT
+    no se espacia. Las rafagas son de hasta PACING_BURST_PACKETS paquetes de
+    packet_size bytes, que el emisor ajusta al payload negociado.
+    """
+
+    def __init__(self, congestion_control, rtt, rate=PACING_AUTO):
+        self.congestion_control = congestion_control
+        self.rtt = rtt
+        self.auto = rate == PACING_AUTO
+        self.bucket = TokenBucket(0 if self.auto else rate, 0)
+        self.set_packet_size(HEADER_SIZE + DEFAULT_PAYLOAD_SIZE)
+
+    def set_packet_size(self, packet_size):
+        self.packet_size = packet_size
+        self.bucket.burst = self.bucket.tokens = PACING_BURST_PACKETS * packet_size
+
+    def reserve(self, size) -> float:
+        if self.auto:
+            if not self.rtt.srtt:
+                return 0
+            self.bucket.set_rate(self.auto_rate())
+        return self.bucket.reserve(size)
+
+    def auto_rate(self) -> float:
+        cwnd = self.congestion_control.cwnd
+        gain = (
+            PACING_SLOW_START_GAIN
+            if cwnd < self.congestion_control.ssthresh
+            else PACING_GAIN
+        )
+        return gain * cwnd * self.packet_size / self.rtt.srtt
+
+    def __str__(self):
+        return f"{'auto ' if self.auto else ''}rate={self.bucket}"
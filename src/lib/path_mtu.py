@@ -0,0 +1,77 @@
+from lib.constants import (
+    HEADER_SIZE,
+    IP_MTU_DISCOVER,
+    IP_PMTUDISC_PROBE,
+    IP_PMTUDISC_WANT,
+    IP_UDP_HEADER_SIZE,
+    MAX_PAYLOAD_SIZE,
+    MIN_PAYLOAD_SIZE,
+    MTU_PROBE_ATTEMPTS,
+    MTU_PROBE_SIZES,
+)
+from socket import IPPROTO_IP
+import logging
+
+
+def parse_payload_size(value: str) -> int:
+    payload_size = int(value)
+    if not MIN_PAYLOAD_SIZE <= payload_size <= MAX_PAYLOAD_SIZE:
+        raise ValueError(f"Invalid payload size: {value}")
+    return payload_size
+
+
+def mtu_payload_size(mtu) -> int:
+    return mtu - IP_UDP_HEADER_SIZE - HEADER_SIZE
+
+
+def set_path_mtu_discovery(socket, mode) -> bool:
+    # Solo existe en Linux
+    try:
+        socket.setsockopt(IPPROTO_IP, IP_MTU_DISCOVER, mode)
+    except OSError:
+        return False
+    return True
+
+
+class MtuProbe:
+    """
+    Busqueda del MTU del camino al estilo de DPLPMTUD (RFC 8899), hecha en el
+    handshake porque el tamaño de los paquetes no puede cambiar durante la
+    transferencia. La solicitud se completa con PADDING hasta el tamaño de
+    un paquete de datos del MTU candidato, con el bit DF y sin fragmentar en
+    el host (IP_PMTUDISC_PROBE), y el servidor responde con el mismo tamaño.
+    Los candidatos son MTU_PROBE_SIZES, hasta max_payload_size: se baja al
+    siguiente si el kernel rechaza el datagrama por grande (EMSGSIZE) o
+    despues de MTU_PROBE_ATTEMPTS solicitudes sin respuesta. El ultimo
+    candidato se sigue usando aunque se pierda, como cualquier solicitud.
+    """
+
+    def __init__(self, socket, max_payload_size):
+        self.socket = socket
+        self.sizes = sorted(
+            {min(mtu_payload_size(mtu), max_payload_size) for mtu in MTU_PROBE_SIZES},
+            reverse=True,
+        )
+        self.attempts = 0
+        self.enabled = set_path_mtu_discovery(socket, IP_PMTUDISC_PROBE)
+
+    @property
+    def payload_size(self) -> int:
+        return self.sizes[0]
+
+    def on_timeout(self):
+        self.attempts += 1
+        if self.attempts >= MTU_PROBE_ATTEMPTS:
+            self.step_down()
+
+    def step_down(self) -> bool:
+        if len(self.sizes) == 1:
+            return False
+        logging.info(f"📏 {self.payload_size} byte packets do not fit the path")
+        self.sizes.pop(0)
+        self.attempts = 0
+        return True
+
+    def close(self):
+        if self.enabled:
+            set_path_mtu_discovery(self.socket, IP_PMTUDISC_WANT)
@@ -0,0 +1,282 @@
+from lib.constants import (
+    DEFAULT_HASH_ALGORITHM,
+    HASH_BLOCK_PACKETS,
+    DEFAULT_PAYLOAD_SIZE,
+)
+from lib.resume_state import ResumeState, partial_path, state_path
+from lib.compression import create_compression, decompress_packet
+from lib.file_hashing import (
+    StreamingHash,
+    digest_size,
+    hash_block_size,
+    hash_blocks,
+    hash_range,
+    split_leaves,
+)
+from math import ceil
+import errno
+import os
+
+COMPLETE_BLOCK_BITMAP = b"\xff" * (HASH_BLOCK_PACKETS // 8)
+
+
+def allocate(fd, size):
+    if not size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:
+        os.ftruncate(fd, size)
+    except OSError as e:
+        # Sistemas de archivos que no soportan reservar espacio
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        os.ftruncate(fd, size)
+
+
+class PreallocatedFile:
+    """
+    Archivo de destino reservado de antemano con el tamaño anunciado por el
+    emisor. Cada paquete se escribe directamente en su offset con pwrite,
+    llegue en orden o no, y solo se recuerda un bitmap con los paquetes ya
+    escritos. A medida que se completa el principio del archivo, las hojas
+    del arbol de hashes avanzan sobre el en otro thread, por lo que estan
+    listas apenas llega el ultimo paquete.
+
+    Despues de los paquetes del archivo el emisor envia las hojas de su
+    propio arbol, que se guardan aparte para verificar cada bloque.
+
+    Los datos se escriben en un archivo parcial (ver resume_state) que se
+    renombra a la ruta de destino con commit. Si se cierra sin commit, se
+    guarda el estado de los bloques completos para reanudar la
+    transferencia; held_blocks son los bloques que ya estaban escritos de
+    un intento anterior y que el emisor no va a enviar.
+
+    Con compression, los paquetes mas cortos que el largo que les
+    corresponde llegaron comprimidos y se descomprimen antes de escribirlos.
+
+    Con assembly, el archivo es la parte block_range de una transferencia
+    en varias sesiones (ver assembly): solo se reciben y verifican esos
+    bloques, sobre el archivo parcial que ya reservo el armado, y commit
+    le entrega sus hojas en lugar de mover el archivo.
+    """
+
+    def __init__(
+        self,
+        path,
+        size,
+        algorithm=DEFAULT_HASH_ALGORITHM,
+        chunk_size=DEFAULT_PAYLOAD_SIZE,
+        held_blocks=(),
+        compression=None,
+        assembly=None,
+        block_range=None,
+    ):
+        self.path = path
+        self.size = size
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.compression = create_compression(compression)
+        self.packets = ceil(size / chunk_size)
+        self.blocks = hash_blocks(size, chunk_size)
+        self.completed = bytearray(ceil(self.packets / 8))
+        self.trailer = bytearray(self.blocks * digest_size(algorithm))
+        self.assembly = assembly
+        self.block_range = block_range
+        self.held_blocks = (
+            [block for block in range(self.blocks) if not self.in_range(block)]
+            if assembly
+            else list(held_blocks)
+        )
+        self.known_leaves = {}
+        self.invalid_blocks = set()
+        self.committed = False
+        flags = os.O_RDWR | os.O_CREAT
+        if not self.held_blocks and not assembly:
+            flags |= os.O_TRUNC
+        self.fd = os.open(partial_path(path), flags, 0o644)
+        self.hashed = 0
+        self.hash = StreamingHash(algorithm, chunk_size)
+        try:
+            allocate(self.fd, size)
+        except OSError:
+            self.close()
+            raise
+        if self.held_blocks:
+            self.resume()
+
+    def resume(self):
+        state = None if self.assembly else ResumeState.load(self.path)
+        if self.assembly:
+            # Los bloques de las otras partes no se hashean en esta sesion
+            self.known_leaves = dict.fromkeys(self.held_blocks, b"")
+        elif state and state.algorithm == self.algorithm:
+            self.known_leaves = {
+                block: state.leaves[block]
+                for block in self.held_blocks
+                if block in state.leaves
+            }
+        for block in self.held_blocks:
+            self.mark_complete(block)
+        self.advance()
+
+    def mark_complete(self, block):
+        start, end = self.block_packets(block)
+        if start % 8 == 0 and end - start == HASH_BLOCK_PACKETS:
+            self.completed[start // 8 : end // 8] = COMPLETE_BLOCK_BITMAP
+            return
+        for index in range(start, end):
+            self.completed[index // 8] |= 0x80 >> (index % 8)
+
+    def block_packets(self, block):
+        start = block * HASH_BLOCK_PACKETS
+        return start, min(start + HASH_BLOCK_PACKETS, self.packets)
+
+    def in_range(self, block):
+        if self.block_range is None:
+            return True
+        return self.block_range[0] <= block < self.block_range[1]
+
+    @property
+    def resumed_length(self):
+        if self.assembly:
+            return 0
+        return sum(
+            min(end * self.chunk_size, self.size) - start * self.chunk_size
+            for start, end in map(self.block_packets, self.held_blocks)
+        )
+
+    def write(self, index, payload) -> int:
+        """
+        Escribe el paquete index y devuelve cuantos bytes del archivo trajo.
+        """
+        if index >= self.packets:
+            offset = (index - self.packets) * self.chunk_size
+            self.trailer[offset : offset + len(payload)] = payload
+            return 0
+        length = min(self.chunk_size, self.size - index * self.chunk_size)
+        if self.compression and len(payload) < length:
+            payload = decompress_packet(self.compression, payload, length)
+        os.pwrite(self.fd, payload, index * self.chunk_size)
+        self.completed[index // 8] |= 0x80 >> (index % 8)
+        if index == self.hashed:
+            self.advance()
+        return len(payload)
+
+    def advance(self):
+        """
+        Encola para el hash los paquetes completos desde el ultimo hasheado.
+        Los bloques retomados cuya hoja ya se conoce no se vuelven a leer.
+        """
+        start = self.hashed
+        while self.is_complete(self.hashed):
+            block, offset = divmod(self.hashed, HASH_BLOCK_PACKETS)
+            if offset == 0 and block in self.known_leaves:
+                self.enqueue_hash(start)
+                self.hash.add_leaf(self.known_leaves.pop(block))
+                self.hashed = self.block_packets(block)[1]
+                start = self.hashed
+            else:
+                self.hashed += 1
+        self.enqueue_hash(start)
+
+    def enqueue_hash(self, start):
+        if self.hashed > start:
+            offset = start * self.chunk_size
+            end = min(self.hashed * self.chunk_size, self.size)
+            self.hash.update_from(self.fd, offset, end - offset)
+
+    def is_complete(self, index):
+        if index < 0 or index >= self.packets:
+            return False
+        return bool(self.completed[index // 8] & (0x80 >> (index % 8)))
+
+    def digest(self) -> bytes:
+        return self.hash.digest()
+
+    def local_leaves(self) -> list[bytes]:
+        self.hash.digest()
+        return self.hash.leaves
+
+    def remote_leaves(self) -> list[bytes]:
+        return split_leaves(self.algorithm, self.trailer)
+
+    def rehash(self, blocks):
+        """
+        Recalcula las hojas de bloques que se volvieron a recibir.
+        """
+        leaves = self.local_leaves()
+        block_size = hash_block_size(self.chunk_size)
+        for block in blocks:
+            offset = block * block_size
+            length = min(block_size, self.size - offset)
+            leaves[block] = hash_range(self.fd, offset, length, self.algorithm)
+
+    def is_block_complete(self, block):
+        start, end = self.block_packets(block)
+        if start % 8 == 0 and end - start == HASH_BLOCK_PACKETS:
+            return self.completed[start // 8 : end // 8] == COMPLETE_BLOCK_BITMAP
+        return all(self.is_complete(index) for index in range(start, end))
+
+    def commit(self, root) -> bool:
+        """
+        Mueve el archivo ya verificado a la ruta de destino. Una parte le
+        entrega sus hojas al armado, que con la ultima hace la verificacion
+        final contra root; devuelve False si esa verificacion falla.
+        """
+        if self.assembly:
+            first, end = self.block_range
+            self.committed = self.assembly.add(
+                self.block_range, self.local_leaves()[first:end], root
+            )
+            return self.committed
+        os.replace(partial_path(self.path), self.path)
+        state_path(self.path).unlink(missing_ok=True)
+        self.committed = True
+        return True
+
+    def suspend(self):
+        """
+        Guarda el estado de los bloques completos y validos para reanudar, o
+        descarta el archivo parcial si no hay ninguno.
+        """
+        leaves = self.local_leaves()
+        if self.hashed < self.packets:
+            leaves = leaves[: self.hashed // HASH_BLOCK_PACKETS]
+        blocks = (
+            [
+                block
+                for block in range(self.blocks)
+                if block not in self.invalid_blocks and self.is_block_complete(block)
+            ]
+            if self.invalid_blocks is not None
+            else []
+        )
+        if not blocks:
+            ResumeState.discard(self.path)
+            return
+        ResumeState(
+            self.size,
+            self.chunk_size,
+            self.algorithm,
+            blocks,
+            {block: leaves[block] for block in blocks if block < len(leaves)},
+        ).save(self.path)
+
+    def close(self):
+        # El pool de hashing lee del descriptor
+        self.hash.digest()
+        if not self.committed:
+            # Una parte no se reanuda (ver assembly): si no se verifico se
+            # descarta todo el armado
+            if self.assembly:
+                self.assembly.discard()
+            else:
+                self.suspend()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,58 @@
+from lib.constants import MAX_SACK_BITMAP_SIZE, WINDOW_SIZE
+from lib.selective_ack import encode_sack_bitmap
+
+
+class ReceiveWindow:
+    """
+    Ventana de recepcion de Selective Repeat como arreglo circular de marcas,
+    indexado por pos modulo la capacidad: solo se pueden marcar los paquetes
+    entre window_seq + 1 y window_seq + capacity. Marcar un paquete, saber si
+    es un duplicado y avanzar sobre los paquetes contiguos cuesta O(1) por
+    paquete, sin importar cuantos haya fuera de orden.
+    """
+
+    def __init__(self, window_seq, capacity=WINDOW_SIZE):
+        self.window_seq = window_seq
+        self.capacity = capacity
+        self.slots = bytearray(capacity)
+        self.highest_seq = window_seq
+        self.out_of_order = 0
+
+    def fits(self, pos):
+        return self.window_seq < pos <= self.window_seq + self.capacity
+
+    def is_received(self, pos):
+        if pos <= self.window_seq:
+            return True
+        return self.fits(pos) and self.slots[pos % self.capacity] == 1
+
+    def mark(self, pos):
+        """
+        Marca un paquete nuevo dentro de la ventana y devuelve cuantos
+        paquetes se entregaron en orden (0 si quedo fuera de orden).
+        """
+        if pos != self.window_seq + 1:
+            self.slots[pos % self.capacity] = 1
+            self.out_of_order += 1
+            self.highest_seq = max(self.highest_seq, pos)
+            return 0
+
+        self.window_seq = pos
+        delivered = 1
+        while self.out_of_order and self.slots[(self.window_seq + 1) % self.capacity]:
+            self.window_seq += 1
+            self.slots[self.window_seq % self.capacity] = 0
+            self.out_of_order -= 1
+            delivered += 1
+        self.highest_seq = max(self.highest_seq, self.window_seq)
+        return delivered
+
+    def sack_bitmap(self) -> bytes:
+        if self.out_of_order == 0:
+            return bytes()
+        span = min(self.highest_seq - self.window_seq, MAX_SACK_BITMAP_SIZE * 8)
+        start = (self.window_seq + 1) % self.capacity
+        marks = self.slots[start : start + span]
+        if len(marks) < span:
+            marks += self.slots[: span - len(marks)]
+        return encode_sack_bitmap(marks)
@@ -0,0 +1,85 @@
+from lib.constants import MAX_RESUME_BLOCKS, PARTIAL_FILE_SUFFIX, RESUME_STATE_SUFFIX
+from pathlib import Path
+import logging
+import json
+import os
+
+
+def partial_path(path) -> Path:
+    return Path(str(path) + PARTIAL_FILE_SUFFIX)
+
+
+def state_path(path) -> Path:
+    return Path(str(path) + PARTIAL_FILE_SUFFIX + RESUME_STATE_SUFFIX)
+
+
+class ResumeState:
+    """
+    Estado de una transferencia interrumpida, guardado junto al archivo
+    parcial: el tamaño del archivo, los bloques ya escritos completos y las
+    hojas de los que ya se habian hasheado, para no volver a leerlos al
+    reanudar. Mientras la transferencia no termina, los datos se escriben en
+    la ruta de destino con el sufijo PARTIAL_FILE_SUFFIX.
+    """
+
+    def __init__(self, size, chunk_size, algorithm, blocks, leaves: dict):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.blocks = blocks
+        self.leaves = leaves
+
+    @classmethod
+    def load(cls, path) -> "ResumeState | None":
+        try:
+            with open(state_path(path)) as file:
+                state = json.load(file)
+            partial_size = partial_path(path).stat().st_size
+            state = cls(
+                state["size"],
+                state["chunk_size"],
+                state["algorithm"],
+                state["blocks"],
+                {
+                    int(block): bytes.fromhex(leaf)
+                    for block, leaf in state["leaves"].items()
+                },
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warn(f"Ignoring resume state of {path}: {e}")
+            return None
+        if partial_size != state.size:
+            return None
+        return state
+
+    def resumable_blocks(self, size, chunk_size) -> list[int]:
+        """
+        Bloques que se pueden saltear al transferir un archivo de ese tamaño.
+        """
+        if size != self.size or chunk_size != self.chunk_size:
+            return []
+        return [block for block in self.blocks if block < MAX_RESUME_BLOCKS]
+
+    def save(self, path):
+        state = {
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "algorithm": self.algorithm,
+            "blocks": self.blocks,
+            "leaves": {str(block): leaf.hex() for block, leaf in self.leaves.items()},
+        }
+        # Unico por proceso, por si hay varios workers (ver workers)
+        temporary_path = state_path(path).with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(temporary_path, "w") as file:
+                json.dump(state, file)
+            os.replace(temporary_path, state_path(path))
+        except OSError as e:
+            logging.warn(f"Could not save resume state of {path}: {e}")
+
+    @staticmethod
+    def discard(path):
+        partial_path(path).unlink(missing_ok=True)
+        state_path(path).unlink(missing_ok=True)
@@ -0,0 +1,47 @@
+from lib.constants import (
+    FIN_LINGER_FACTOR,
+    MAX_RTO,
+    MIN_RTO,
+    RTT_ALPHA,
+    RTT_BETA,
+    RTT_VAR_FACTOR,
+    SOCKET_TIME_OUT,
+)
+
+
+class RttEstimator:
+    """
+    Estimacion del RTT de una sesion segun RFC 6298. Solo se deben tomar
+    muestras de paquetes que no fueron retransmitidos (regla de Karn), y
+    cada reintento consecutivo de un mismo paquete duplica el timeout.
+    """
+
+    def __init__(self, initial_rto=SOCKET_TIME_OUT):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.samples = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(max(self.srtt + RTT_VAR_FACTOR * self.rttvar, MIN_RTO), MAX_RTO)
+        self.samples += 1
+
+    def timeout(self, retries=0):
+        return min(self.rto * 2**retries, MAX_RTO)
+
+    def linger_timeout(self):
+        return self.rto * FIN_LINGER_FACTOR
+
+    def __str__(self):
+        if self.srtt is None:
+            return f"srtt=? rto={self.rto * 1000:.1f}ms"
+        return (
+            f"srtt={self.srtt * 1000:.1f}ms rttvar={self.rttvar * 1000:.1f}ms "
+            f"rto={self.rto * 1000:.1f}ms ({self.samples} samples)"
+        )
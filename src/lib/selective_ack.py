@@ -0,0 +1,79 @@
+from lib.constants import DUP_ACK_THRESHOLD, MAX_SACK_BITMAP_SIZE
+
+"""
+Selective ACK
+El ACK lleva en POS el ultimo paquete entregado en orden (ACK acumulativo)
+y en el payload un bitmap de los paquetes recibidos fuera de orden: el bit i
+(de mas significativo a menos, byte a byte) indica si llego el paquete
+POS + 1 + i. Se cubren como maximo MAX_SACK_BITMAP_SIZE * 8 paquetes.
+"""
+
+
+MARKS_TO_BINARY_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def encode_sack_bitmap(marks) -> bytes:
+    """
+    Arma el bitmap a partir de una marca por paquete (0 o 1) desde POS + 1.
+    """
+    marks = bytes(marks[: MAX_SACK_BITMAP_SIZE * 8]).rstrip(b"\x00")
+    if not marks:
+        return bytes()
+    length = (len(marks) + 7) // 8
+    digits = marks.translate(MARKS_TO_BINARY_DIGITS).ljust(length * 8, b"0")
+    return int(digits, 2).to_bytes(length, byteorder="big")
+
+
+def decode_sack_bitmap(cumulative_ack, payload) -> list[int]:
+    positions = []
+    for byte_index, byte in enumerate(payload):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                positions.append(cumulative_ack + 1 + byte_index * 8 + bit)
+    return positions
+
+
+class SackScoreboard:
+    """
+    Estado del emisor a partir de los ACK selectivos recibidos. Un paquete
+    que el receptor reporta como faltante DUP_ACK_THRESHOLD veces (porque
+    llegaron paquetes posteriores) se considera perdido y se devuelve para
+    su retransmision rapida, sin esperar al timeout.
+    """
+
+    def __init__(self, cumulative_ack):
+        self.cumulative_ack = cumulative_ack
+        self.sacked: set[int] = set()
+        self.highest_sacked = cumulative_ack
+        self.missing_reports: dict[int, int] = {}
+
+    def is_acked(self, pos):
+        return pos <= self.cumulative_ack or pos in self.sacked
+
+    def update(self, cumulative_ack, sacked) -> list[int]:
+        if cumulative_ack > self.cumulative_ack:
+            self.cumulative_ack = cumulative_ack
+            self.sacked = {pos for pos in self.sacked if pos > cumulative_ack}
+            self.missing_reports = {
+                pos: count
+                for pos, count in self.missing_reports.items()
+                if pos > cumulative_ack
+            }
+        self.highest_sacked = max(self.highest_sacked, self.cumulative_ack)
+
+        for pos in sacked:
+            if pos > self.cumulative_ack:
+                self.sacked.add(pos)
+                self.highest_sacked = max(self.highest_sacked, pos)
+
+        lost = []
+        for pos in range(self.cumulative_ack + 1, self.highest_sacked):
+            if pos in self.sacked:
+                continue
+            reports = self.missing_reports.get(pos, 0) + 1
+            self.missing_reports[pos] = reports
+            if reports == DUP_ACK_THRESHOLD:
+                lost.append(pos)
+        return lost
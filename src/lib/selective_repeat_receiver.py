@@ -0,0 +1,155 @@
+from lib.constants import ACK_FREQUENCY, DELAYED_ACK_TIME_OUT
+from lib.receive_window import ReceiveWindow
+from lib.fec import FecDecoder
+from lib.message import Message, MessageType
+import logging
+
+
+class SelectiveRepeatReceiver:
+    """
+    Receptor de Selective Repeat compartido por la descarga del cliente y la
+    subida del servidor. Los ACK son acumulativos y llevan los rangos de
+    paquetes recibidos fuera de orden. Los paquetes en orden se confirman
+    de a ack_frequency (o al vencer DELAYED_ACK_TIME_OUT), mientras que los
+    duplicados y los que llegan fuera de orden se confirman en el momento
+    para que el emisor detecte los huecos cuanto antes.
+
+    Todo paquete se escribe apenas llega en su offset del archivo de destino,
+    por lo que no se guarda ningun payload en memoria: los huecos se siguen
+    con la ventana de recepcion.
+
+    Con FEC (ver fec), los paquetes perdidos se reconstruyen con la paridad
+    de su bloque. Mientras el primer hueco todavia se puede reconstruir, los
+    ACK se demoran hasta que llega la paridad (o vence DELAYED_ACK_TIME_OUT),
+    para que el emisor no lo retransmita.
+    """
+
+    def __init__(
+        self,
+        transport,
+        window_seq,
+        peer_address=None,
+        progress_bar=None,
+        ack_frequency=ACK_FREQUENCY,
+        fec=None,
+    ):
+        self.transport = transport
+        self.window = ReceiveWindow(window_seq)
+        self.first_seq = window_seq + 1
+        self.peer_address = peer_address
+        self.progress_bar = progress_bar
+        self.ack_frequency = ack_frequency
+        self.pending_acks = 0
+        self.idle_timeout = None
+        self.fec = FecDecoder(*fec, self.first_seq) if fec else None
+
+    def restart(self, window_seq):
+        if self.pending_acks:
+            # El FIN llego con ACKs demorados: vuelve el timeout sin actividad
+            self.transport.settimeout(self.idle_timeout)
+        self.window = ReceiveWindow(window_seq)
+        self.first_seq = window_seq + 1
+        self.pending_acks = 0
+        if self.fec is not None:
+            self.fec.restart(self.first_seq)
+
+    async def receive(self, file, first_message=None, request=None) -> Message:
+        """
+        Recibe paquetes hasta el FIN. Si se pasa un request (el pedido de
+        bloques de una nueva ronda), se envia al empezar y se repite cada vez
+        que llega el FIN de la ronda anterior.
+        """
+        self.idle_timeout = self.transport.gettimeout()
+        message = first_message
+        if request:
+            self.transport.send(request, self.peer_address)
+
+        while True:
+            if message is None:
+                try:
+                    message, self.peer_address = await self.transport.receive()
+                except TimeoutError:
+                    if not self.pending_acks:
+                        raise
+                    self.send_ack()
+                    continue
+
+            logging.info(f"Received packet with seq={message.pos}")
+
+            if message.type == MessageType.FIN:
+                if message.pos > self.window.window_seq:
+                    if self.fec is not None:
+                        logging.info(f"🧩 {self.fec}")
+                    return message
+                if request:
+                    self.transport.send(request, self.peer_address)
+
+            if message.type == MessageType.ERROR:
+                raise ConnectionAbortedError
+
+            if message.type == MessageType.OK:
+                self.handle_data(file, message)
+
+            if message.type == MessageType.PARITY:
+                self.handle_parity(file, message)
+            message = None
+
+    def handle_data(self, file, message: Message):
+        # Un mensaje repetido (se perdio nuestro ACK) o que no entra en la
+        # ventana: se confirma de nuevo lo recibido
+        if self.window.is_received(message.pos) or not self.window.fits(message.pos):
+            self.send_ack()
+            return
+
+        self.write(file, message)
+        gap = self.window.out_of_order > 0
+        self.window.mark(message.pos)
+        if self.fec is not None:
+            for seq, payload in self.fec.on_data(message.pos, message.payload):
+                self.handle_data(file, Message(MessageType.OK, seq, payload))
+        awaits_parity = self.awaits_parity()
+        if (message.pos != self.window.window_seq or gap) and not awaits_parity:
+            # Llego fuera de orden o lleno un hueco
+            self.send_ack()
+            return
+
+        self.pending_acks += 1
+        if self.pending_acks >= self.ack_frequency and not awaits_parity:
+            self.send_ack()
+        elif self.pending_acks == 1:
+            self.transport.settimeout(DELAYED_ACK_TIME_OUT)
+
+    def handle_parity(self, file, message: Message):
+        if self.fec is None:
+            return
+        for seq, payload in self.fec.on_parity(message, self.window.window_seq):
+            if self.window.fits(seq) and not self.window.is_received(seq):
+                self.handle_data(file, Message(MessageType.OK, seq, payload))
+        if self.pending_acks and not self.awaits_parity():
+            self.send_ack()
+
+    def awaits_parity(self):
+        return (
+            self.fec is not None
+            and self.window.out_of_order > 0
+            and self.fec.awaits_parity(self.window.window_seq + 1)
+        )
+
+    def write(self, file, message: Message):
+        written = file.write(message.pos - self.first_seq, message.payload)
+        if self.progress_bar and written:
+            self.progress_bar.update(written)
+            self.progress_bar.refresh()
+
+    def send_ack(self):
+        ack = Message(
+            MessageType.ACK,
+            pos=self.window.window_seq,
+            payload=self.window.sack_bitmap(),
+        )
+        self.transport.send(ack, self.peer_address)
+        logging.info(f"Sent ACK {ack.pos} with {self.window.out_of_order} out of order")
+
+        if self.pending_acks:
+            self.pending_acks = 0
+            self.transport.settimeout(self.idle_timeout)
@@ -0,0 +1,260 @@
+from lib.constants import (
+    DEFAULT_CONGESTION_CONTROL,
+    HEADER_SIZE,
+    PACING_AUTO,
+    PACING_BURST_PACKETS,
+    SEND_BATCH_SIZE,
+    SOCKET_TIME_OUT,
+    MAX_CONSECUTIVE_LOSTS,
+    WINDOW_SIZE,
+)
+from lib.congestion_control import create_congestion_controller
+from lib.selective_ack import SackScoreboard, decode_sack_bitmap
+from lib.message import Message, MessageType
+from lib.sender import Sender
+from lib.pacing import SessionPacer
+from lib.fec import FecEncoder
+from functools import partial
+from threading import Lock
+from time import monotonic
+import logging
+
+
+class SelectiveRepeatSender(Sender):
+    """
+    Emisor de Selective Repeat compartido por la descarga del servidor y la
+    subida del cliente. Cada paquete tiene su timer de retransmision, y ademas
+    se retransmite apenas los ACK selectivos del receptor reportan un hueco.
+    Los timers usan el RTO de la sesion, que se ajusta con cada ACK de un
+    paquete que no fue retransmitido, y viven en la timing wheel compartida
+    por todo el proceso bajo la clave (emisor, seq). Los paquetes nuevos se
+    envian en tandas de hasta SEND_BATCH_SIZE para que el transporte pueda
+    agruparlos en una sola llamada al sistema.
+
+    La cantidad de paquetes en vuelo la limita el control de congestion, que
+    reduce la ventana una sola vez por perdida: las perdidas de paquetes
+    enviados antes de la ultima reduccion no la vuelven a reducir.
+
+    Con pacing (ver pacing), las tandas son de hasta PACING_BURST_PACKETS
+    y se espacian segun la tasa de la sesion, en lugar de enviar la ventana
+    de una vez.
+
+    Con FEC (ver fec), despues del ultimo paquete de cada bloque se envian
+    sus paquetes de paridad en la misma tanda.
+    """
+
+    def __init__(
+        self,
+        transport,
+        peer_address,
+        progress_bar=None,
+        rtt=None,
+        timers=None,
+        congestion_control=None,
+        pacers=(),
+        pacing=PACING_AUTO,
+        fec=None,
+    ):
+        super().__init__(transport, peer_address, progress_bar, rtt, pacers)
+        self.timers = timers if timers is not None else transport.timers()
+        self.congestion_control = (
+            congestion_control
+            if congestion_control is not None
+            else create_congestion_controller(DEFAULT_CONGESTION_CONTROL)
+        )
+        self.lock = Lock()
+        self.recovery_point = 0
+        self.last_sent = 0
+        self.source = None
+        # seq -> indice en la fuente de cada paquete en vuelo
+        self.window: dict[int, int] = {}
+        self.sent_at: dict[int, float] = {}
+        self.retransmitted: set[int] = set()
+        self.scoreboard = None
+        self.aborted = False
+        self.fec = FecEncoder(*fec) if fec else None
+        self.session_pacer = (
+            SessionPacer(self.congestion_control, self.rtt, pacing)
+            if pacing is not None
+            else None
+        )
+
+    def pacers(self) -> list:
+        if self.session_pacer is None:
+            return super().pacers()
+        return super().pacers() + [self.session_pacer]
+
+    async def send(self, source, last_packet_number):
+        self.source = source
+        self.scoreboard = SackScoreboard(last_packet_number)
+        self.recovery_point = last_packet_number
+        if self.session_pacer is not None:
+            self.session_pacer.set_packet_size(HEADER_SIZE + source.chunk_size)
+        first_seq = last_packet_number + 1
+        index = 0
+        batch: list[Message] = []
+        batch_size = SEND_BATCH_SIZE
+        if self.pacers():
+            batch_size = min(SEND_BATCH_SIZE, PACING_BURST_PACKETS)
+        self.transport.settimeout(SOCKET_TIME_OUT * MAX_CONSECUTIVE_LOSTS)
+        try:
+            while True:
+                if self.aborted:
+                    raise ConnectionAbortedError
+
+                if (
+                    self.can_send()
+                    and len(batch) < batch_size
+                    and index < source.packets
+                ):
+                    last_packet_number += 1
+                    self.window[last_packet_number] = index
+                    batch.append(self.packet(last_packet_number, index))
+                    if self.fec is not None and self.fec.is_block_end(
+                        index, source.packets
+                    ):
+                        batch.extend(self.fec.parity(source, index, first_seq))
+                    index += 1
+                    continue
+
+                if batch:
+                    await self.pace(batch)
+                    self.send_batch(batch)
+                    batch = []
+                    continue
+
+                if len(self.window) == 0:
+                    break
+
+                recv_ack, self.peer_address = await self.transport.receive()
+
+                if self.is_abort(recv_ack):
+                    logging.warn(f"🛑 {self.peer()} closed the connection")
+                    raise ConnectionAbortedError
+
+                if recv_ack.type != MessageType.ACK:
+                    continue
+
+                logging.info(f"{self.peer()} Received ACK {recv_ack.pos}")
+                self.on_ack(recv_ack)
+
+                while len(self.window) > 0:
+                    pos = next(iter(self.window))
+                    if not self.scoreboard.is_acked(pos):
+                        break
+                    packet_index = self.window.pop(pos)
+                    self.timers.cancel((self, pos))
+                    self.sent_at.pop(pos, None)
+                    self.retransmitted.discard(pos)
+                    if self.progress_bar:
+                        self.progress_bar.update(source.data_length(packet_index))
+                        self.progress_bar.refresh()
+        finally:
+            for pos in self.window:
+                self.timers.cancel((self, pos))
+
+        logging.info(f"📶 {self.peer()} RTT: {self.rtt}")
+        logging.info(f"📈 {self.peer()} {self.congestion_control}")
+        if self.fec is not None:
+            logging.info(f"🧩 {self.peer()} {self.fec}")
+        if self.session_pacer is not None:
+            logging.info(
+                f"⏱️ {self.peer()} Pacing {self.session_pacer}, waited {self.paced_time * 1000:.1f}ms"
+            )
+        return last_packet_number
+
+    def packet(self, pos, index) -> Message:
+        # El payload es una vista sobre el mapeo del archivo: los paquetes se
+        # arman al enviarlos y no se guardan en la ventana
+        return Message(MessageType.OK, pos, self.source.packet(index))
+
+    def send_batch(self, batch: list[Message]):
+        self.transport.send_batch(batch, self.peer_address)
+        sent_at = monotonic()
+        for message in batch:
+            if message.type == MessageType.OK:
+                self.sent_at[message.pos] = sent_at
+                self.schedule(message.pos)
+                self.last_sent = message.pos
+
+    def can_send(self):
+        in_flight = len(self.window) - len(self.scoreboard.sacked)
+        return (
+            len(self.window) < WINDOW_SIZE
+            and in_flight < self.congestion_control.window()
+        )
+
+    def on_ack(self, recv_ack: Message):
+        in_order = len(self.scoreboard.sacked) == 0
+        cumulative_ack = self.scoreboard.cumulative_ack
+        highest_sacked = self.scoreboard.highest_sacked
+        acked_before = cumulative_ack + len(self.scoreboard.sacked)
+
+        lost = self.scoreboard.update(
+            recv_ack.pos, decode_sack_bitmap(recv_ack.pos, recv_ack.payload)
+        )
+        acked = (
+            self.scoreboard.cumulative_ack + len(self.scoreboard.sacked) - acked_before
+        )
+
+        # El ACK lo genera el paquete recien llegado: el ultimo en orden si no
+        # hay huecos, o el mayor confirmado selectivamente si los hay. Cuando
+        # un hueco se llena, el acumulativo salta a un paquete enviado antes y
+        # la muestra no seria valida.
+        sample_pos = None
+        if in_order and len(self.scoreboard.sacked) == 0:
+            if self.scoreboard.cumulative_ack > cumulative_ack:
+                sample_pos = self.scoreboard.cumulative_ack
+        elif self.scoreboard.highest_sacked > highest_sacked:
+            sample_pos = self.scoreboard.highest_sacked
+        if sample_pos is not None and sample_pos not in self.retransmitted:
+            sent_at = self.sent_at.get(sample_pos)
+            if sent_at is not None:
+                self.rtt.sample(monotonic() - sent_at)
+
+        with self.lock:
+            if acked > 0:
+                self.congestion_control.on_ack(acked)
+            if lost and max(lost) > self.recovery_point:
+                self.congestion_control.on_loss()
+                self.recovery_point = self.last_sent
+                logging.info(
+                    f"📉 {self.peer()} Loss detected, {self.congestion_control}"
+                )
+
+        retransmissions = []
+        for pos in lost:
+            index = self.window.get(pos)
+            if index is not None:
+                logging.info(f"{self.peer()} Fast retransmit of packet {pos}")
+                self.retransmitted.add(pos)
+                retransmissions.append(self.packet(pos, index))
+        if retransmissions:
+            self.transport.send_batch(retransmissions, self.peer_address)
+
+    def schedule(self, pos, i=0):
+        self.timers.arm(
+            (self, pos), self.rtt.timeout(i), partial(self.callback, pos, i)
+        )
+
+    def callback(self, pos, i=0):
+        if i >= MAX_CONSECUTIVE_LOSTS:
+            self.aborted = True
+            return
+        if self.scoreboard.is_acked(pos):
+            return
+        index = self.window.get(pos)
+        if index is None:
+            return
+        logging.info(f"{self.peer()} Packet {pos} lost, resending...")
+        with self.lock:
+            if pos > self.recovery_point:
+                self.congestion_control.on_timeout()
+                self.recovery_point = self.last_sent
+                logging.info(f"📉 {self.peer()} Timeout, {self.congestion_control}")
+        self.retransmitted.add(pos)
+        try:
+            self.transport.send(self.packet(pos, index), self.peer_address)
+            self.schedule(pos, i + 1)
+        except OSError:
+            logging.error("OSError")
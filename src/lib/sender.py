@@ -0,0 +1,75 @@
+from lib.constants import HEADER_SIZE, MAX_CONSECUTIVE_LOSTS, PACING_MIN_SLEEP
+from lib.file_transfer import is_invalid_checksum
+from lib.rtt_estimator import RttEstimator
+from lib.message import Message, MessageType
+from abc import ABC, abstractmethod
+import logging
+
+
+class Sender(ABC):
+    """
+    Emisor de un protocolo de transferencia. send envia los paquetes de una
+    fuente (ver file_transfer) a partir de un numero de paquete y devuelve el
+    ultimo; finish envia el FIN y espera la respuesta del receptor.
+
+    Los paquetes nuevos esperan antes de enviarse lo que pida el mas lento
+    de sus pacers: la parte de la sesion en la tasa de salida del servidor
+    (ver egress_scheduler) o una cubeta de tokens (ver pacing). Las esperas
+    de menos de PACING_MIN_SLEEP se saltean, y se pagan en el envio siguiente.
+    """
+
+    def __init__(self, transport, peer_address, progress_bar=None, rtt=None, pacers=()):
+        self.transport = transport
+        self.peer_address = peer_address
+        self.progress_bar = progress_bar
+        self.rtt = rtt if rtt is not None else RttEstimator()
+        self.external_pacers = list(pacers)
+        self.paced_time = 0.0
+
+    def peer(self):
+        return f"{self.peer_address[0]}:{self.peer_address[1]}"
+
+    @abstractmethod
+    async def send(self, source, last_packet_number) -> int:
+        raise NotImplementedError()
+
+    def pacers(self) -> list:
+        return self.external_pacers
+
+    async def pace(self, messages: list[Message]):
+        size = sum(HEADER_SIZE + message.length for message in messages)
+        delay = max((pacer.reserve(size) for pacer in self.pacers()), default=0)
+        if delay >= PACING_MIN_SLEEP:
+            self.paced_time += delay
+            await self.transport.sleep(delay)
+
+    def is_abort(self, message: Message):
+        # Una respuesta repetida a un FIN anterior (un pedido de bloques, o el
+        # checksum invalido del archivo anterior de un lote) no corta el envio
+        return message.type == MessageType.ERROR and not is_invalid_checksum(message)
+
+    async def finish(self, fin: Message) -> Message:
+        """
+        Envia el FIN y espera la respuesta del receptor (ACK del FIN o ERROR),
+        ignorando ACKs atrasados de los paquetes de datos.
+        """
+        self.transport.send(fin, self.peer_address)
+        consecutive_losts = 0
+
+        while True:
+            if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
+                raise ConnectionAbortedError
+            self.transport.settimeout(self.rtt.timeout(consecutive_losts))
+            try:
+                message, self.peer_address = await self.transport.receive()
+            except TimeoutError:
+                logging.info(f"FIN packet lost, resending it {fin.pos}")
+                consecutive_losts += 1
+                self.transport.send(fin, self.peer_address)
+                continue
+
+            if self.is_abort(message) or (
+                message.pos == fin.pos
+                and message.type in (MessageType.ACK, MessageType.ERROR)
+            ):
+                return message
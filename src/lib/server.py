@@ -1,90 +1,362 @@
-from lib.connection_registry import ConnectionRegistry
+from lib.egress_scheduler import EgressScheduler
+from lib.pacing import TokenBucket
+from lib.admission import AdmissionController
+from lib.digest_cache import DigestCache
+from lib.block_cache import BlockCache, CachedFile
 from lib.constants import (
+    BLOCK_CACHE_SIZE,
+    DEFAULT_HASH_ALGORITHM,
+    DEFAULT_PAYLOAD_SIZE,
+    FILE_NOT_FOUND_ERROR,
+    INVALID_FILE_HASHING,
     MAX_CONSECUTIVE_LOSTS,
     RECV_BUFFER_SIZE,
     MAX_CONNECTIONS,
+    MAX_RATE_BURST,
+    MAX_PAYLOAD_SIZE,
+    MAX_SESSIONS_PER_CLIENT,
+    MIN_PAYLOAD_SIZE,
     SOCKET_TIME_OUT,
 )
 from concurrent.futures import ThreadPoolExecutor
-from socket import socket, AF_INET, SOCK_DGRAM
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEPORT
 from lib.message import Message, MessageType
+from lib.handshake import (
+    HandshakeOption,
+    TransferOptions,
+    decode_bitmap,
+    decode_filenames,
+    decode_int,
+    decode_names,
+    decode_request,
+    decode_sizes,
+    decode_stream,
+    is_batch_request,
+    is_signature_request,
+)
+from lib.assembly import Assembly, split_blocks
+from lib.chunk_store import ChunkStore, decode_chunk_ids, index_path
+from lib.delta import apply_delta, compute_signature, decode_delta_base, delta_path
+from lib.file_hashing import choose_hash_algorithm, hash_blocks, hash_in_background
+from lib.compression import choose_compression
+from lib.resume_state import ResumeState
+from lib.transport import create_transport, run_blocking
+from lib.file_transfer import (
+    TransferSource,
+    is_invalid_checksum,
+    receive_file,
+    send_file,
+    send_reply,
+)
+from lib.preallocated_file import PreallocatedFile
+from lib.rtt_estimator import RttEstimator
+from lib.mapped_file import BufferFile, MappedFile
+from lib.sender import Sender
 from abc import ABC, abstractmethod
 from random import randint
+from time import monotonic
 from pathlib import Path
-from math import ceil
 import logging
+import os
 
 
 class Server(ABC):
-    def __init__(self, address, port, storage_path):
+    """
+    Las solicitudes que superan los limites de sesiones (ver admission) se
+    rechazan con un BUSY, y las descargas se reparten la tasa de salida
+    egress_rate (ver egress_scheduler), favoreciendo a las mas cortas. Con
+    max_rate, ademas, todos los envios del proceso pasan por una misma
+    cubeta de tokens (ver pacing) que limita la tasa total de salida.
+
+    El tamaño de los paquetes de datos se negocia en el handshake: el
+    cliente ofrece el mayor que acepta y el servidor usa ese, hasta
+    max_payload_size.
+
+    Una solicitud con STREAM es una parte de una transferencia en varias
+    sesiones (ver assembly): el servidor le asigna su rango de bloques y,
+    en la subida, arma el archivo con las partes del mismo ASSEMBLY.
+
+    Una descarga con SIGNATURE recibe la firma del archivo, y una subida con
+    DELTA un delta contra el archivo que se arma al terminar (ver delta).
+
+    Con dedup, los archivos subidos se guardan en el almacen de chunks (ver
+    chunk_store) y se leen de el, y las subidas que ofrecen CHUNKS no
+    reciben los bloques cuyos chunks el servidor ya tiene.
+
+    Las descargas leen los archivos a traves de una cache de bloques de
+    cache_size bytes compartida por todas las sesiones del proceso (ver
+    block_cache), que carga tambien los archivos que los clientes anuncian
+    en PREFETCH. Con cache_size 0 se leen directamente del mapeo.
+    """
+
+    def __init__(
+        self,
+        address,
+        port,
+        storage_path,
+        gso=False,
+        reuse_port=False,
+        max_sessions=MAX_CONNECTIONS,
+        max_sessions_per_client=MAX_SESSIONS_PER_CLIENT,
+        egress_rate=None,
+        max_rate=None,
+        max_payload_size=MAX_PAYLOAD_SIZE,
+        dedup=False,
+        cache_size=BLOCK_CACHE_SIZE,
+    ):
         self.address = address
         self.port = port
         self.storage_path = storage_path
+        self.gso = gso
         Path(storage_path).mkdir(parents=True, exist_ok=True)
         self.socket = socket(AF_INET, SOCK_DGRAM)
+        if reuse_port:
+            # Varios procesos escuchan en el mismo puerto (ver workers)
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind((address, port))
-        self.connections = ConnectionRegistry()
+        self.admission = AdmissionController(max_sessions, max_sessions_per_client)
+        self.egress = EgressScheduler(egress_rate)
+        self.max_rate = TokenBucket(max_rate, MAX_RATE_BURST) if max_rate else None
+        self.max_payload_size = max_payload_size
+        self.digests = DigestCache(storage_path)
+        self.chunks = ChunkStore(storage_path) if dedup else None
+        self.cache = BlockCache(cache_size) if cache_size else None
 
-    def start(self):
-        logging.warn(f"🚀 Server is listening on port {self.port}")
-        thread_pool = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
-        tasks = {
+    def handlers(self):
+        return {
             MessageType.DOWNLOAD: self.handle_download,
             MessageType.UPLOAD: self.handle_upload,
         }
 
+    def start(self):
+        """
+        Motor con un thread y un socket por conexion, hasta max_sessions a
+        la vez. Ver async_engine para el motor con asyncio.
+        """
+        logging.warn(f"🚀 Server is listening on port {self.port}")
+        thread_pool = ThreadPoolExecutor(max_workers=self.admission.max_sessions)
+        tasks = self.handlers()
+
         try:
             while True:
                 bytes, client_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-                if self.connections.is_open_for(client_address):
+                if self.admission.is_open_for(client_address):
                     print("Ya hay una conexion")
                     continue
 
-                self.connections.open(client_address)
                 handshake_req = Message.decode(bytes)
-                incoming_task = tasks[handshake_req.type]
-                thread_pool.submit(incoming_task, client_address, handshake_req)
+                incoming_task = tasks.get(handshake_req.type)
+                if incoming_task is None:
+                    continue
+                if not self.admission.admit(client_address):
+                    busy = self.reject(client_address)
+                    self.socket.sendto(busy.encode(), client_address)
+                    continue
+                thread_pool.submit(
+                    self.serve, incoming_task, client_address, handshake_req
+                )
         except KeyboardInterrupt:
             logging.warn("🛑 Shutting down server")
             thread_pool.shutdown()
-            self.socket.close()
+            self.close()
         except Exception as e:
             logging.error(e)
 
-    def handle_download_handshake(self, comm_socket, handshake_req, client_address):
-        filename = handshake_req.payload.decode()
-        download_file_path = Path(self.storage_path + "/" + filename)
+    def close(self):
+        self.socket.close()
+        # Cambios de la cache de digests que todavia no se guardaron
+        self.digests.close()
 
-        if not download_file_path.is_file():
-            raise FileNotFoundError
+    def serve(self, handler, client_address, handshake_req):
+        comm_socket = socket(AF_INET, SOCK_DGRAM)
+        transport = self.create_transport(comm_socket)
+        try:
+            run_blocking(handler(transport, client_address, handshake_req))
+        finally:
+            comm_socket.close()
+            self.admission.close(client_address)
 
-        file_size = download_file_path.stat().st_size
+    def reject(self, client_address) -> Message:
+        retry_after = self.admission.retry_after()
+        logging.info(
+            f"⏳ {client_address[0]}:{client_address[1]} rejected, retry after {retry_after} ms ({self.admission})"
+        )
+        return Message(MessageType.BUSY, pos=retry_after)
 
-        packet_number = randint(0, 10000)
-        min_bytes_to_encode = ceil(file_size.bit_length() / 8)
+    def create_transport(self, comm_socket):
+        return create_transport(comm_socket, self.gso)
 
-        handshake_res = Message(
-            MessageType.OK,
-            pos=packet_number,
-            payload=file_size.to_bytes(length=min_bytes_to_encode, byteorder="big"),
+    @abstractmethod
+    def create_sender(
+        self, transport, client_address, rtt, pacers=(), fec=None
+    ) -> Sender:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def create_receiver(self, transport, last_packet_number, client_address, fec=None):
+        raise NotImplementedError()
+
+    def payload_size(self, offered: dict, preferred=None) -> int:
+        """
+        Tamaño de payload de la transferencia: el que ofrece el cliente, hasta
+        max_payload_size. preferred, el de una subida a reanudar, se usa si
+        no lo supera.
+        """
+        payload_size = min(
+            max(
+                decode_int(offered.get(HandshakeOption.PAYLOAD_SIZE, b""))
+                or DEFAULT_PAYLOAD_SIZE,
+                MIN_PAYLOAD_SIZE,
+            ),
+            self.max_payload_size,
         )
+        if preferred is not None and preferred <= payload_size:
+            return preferred
+        return payload_size
 
-        consecutive_losts = 0
+    def negotiate(
+        self,
+        offered: dict,
+        file_size,
+        resume_blocks=(),
+        payload_size=DEFAULT_PAYLOAD_SIZE,
+    ) -> TransferOptions:
+        hash_algorithm = DEFAULT_HASH_ALGORITHM
+        if HandshakeOption.HASH_ALGORITHMS in offered:
+            hash_algorithm = choose_hash_algorithm(
+                decode_names(offered[HandshakeOption.HASH_ALGORITHMS])
+            )
+            if hash_algorithm is None:
+                raise ConnectionAbortedError
+        return TransferOptions(
+            file_size,
+            hash_algorithm,
+            resume_blocks,
+            payload_size=payload_size,
+            # Sin ninguno de los ofrecidos se transfiere sin comprimir
+            compression=choose_compression(
+                decode_names(offered.get(HandshakeOption.COMPRESSIONS, b""))
+            ),
+        )
 
-        while True:
-            comm_socket.sendto(handshake_res.encode(), client_address)
-            print("Enviando handshake download")
+    @staticmethod
+    def reply_length(handshake_req, offered: dict) -> int:
+        # Las respuestas a una prueba del MTU se completan hasta su tamaño
+        if HandshakeOption.PADDING in offered:
+            return len(handshake_req.payload)
+        return 0
+
+    @staticmethod
+    def block_range(stream, file_size, payload_size) -> tuple[int, int]:
+        index, count = stream
+        ranges = split_blocks(hash_blocks(file_size, payload_size), count)
+        if index >= len(ranges):
+            raise ConnectionAbortedError
+        return ranges[index]
+
+    def upload_path(self, filename) -> Path:
+        return Path(self.storage_path + "/" + filename)
+
+    def stored_stat(self, path) -> os.stat_result | None:
+        """
+        Estado del archivo guardado en path, o de su indice si esta en el
+        almacen de chunks. Identifica la version del archivo.
+        """
+        try:
+            return path.stat()
+        except FileNotFoundError:
+            pass
+        if self.chunks is not None:
             try:
-                recv_bytes, client_address = comm_socket.recvfrom(RECV_BUFFER_SIZE)
-            except TimeoutError:
-                print("Perdimos handshake download")
-                consecutive_losts += 1
-                if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
-                    raise ConnectionAbortedError
-            else:
-                break
+                return index_path(path).stat()
+            except FileNotFoundError:
+                pass
+        return None
+
+    def stored_size(self, path) -> int | None:
+        if path.is_file():
+            return path.stat().st_size
+        if self.chunks is not None and index_path(path).is_file():
+            index = self.chunks.load_index(path)
+            return index["size"] if index else None
+        return None
+
+    def open_stored(self, path, chunk_size=DEFAULT_PAYLOAD_SIZE) -> MappedFile:
+        try:
+            return MappedFile(path, chunk_size)
+        except FileNotFoundError:
+            # Puede haber pasado al almacen despues de buscarlo
+            if self.chunks is None:
+                raise
+        return self.chunks.open(path, chunk_size)
+
+    def cached(self, file) -> MappedFile:
+        return CachedFile(file, self.cache) if self.cache else file
+
+    def prefetch(self, paths):
+        """
+        Carga en la cache los archivos que un cliente va a pedir.
+        """
+        if self.cache is not None:
+            for path in paths:
+                self.cache.warm(self.open_stored, path)
+
+    async def store_upload(self, transport, path, algorithm, chunk_size, leaves):
+        """
+        Guarda las hojas de un archivo recien subido y, con el almacen de
+        chunks, lo pasa al almacen.
+        """
+        if self.chunks is not None:
+            try:
+                await transport.offload(self.chunks.ingest, path)
+            except OSError as e:
+                logging.error(f"❌ Could not store {path} as chunks: {e}")
+        stat = self.stored_stat(path)
+        if stat is not None:
+            self.digests.put(path, stat, algorithm, chunk_size, leaves)
+
+    async def handle_download_handshake(
+        self, transport, handshake_req, client_address, rtt
+    ):
+        filename, options = decode_request(handshake_req.payload)
+        download_file_path = self.upload_path(filename)
+
+        file_size = self.stored_size(download_file_path)
+        if file_size is None:
+            raise FileNotFoundError
+        payload_size = self.payload_size(options)
+        stream = decode_stream(options.get(HandshakeOption.STREAM, b""))
+        # El cliente reanuda una descarga si todavia coinciden el tamaño del
+        # archivo y el de los paquetes
+        resume_blocks = []
+        if (
+            stream is None
+            and decode_int(options.get(HandshakeOption.FILE_SIZE, b"")) == file_size
+            and payload_size
+            == decode_int(options.get(HandshakeOption.PAYLOAD_SIZE, b""))
+        ):
+            resume_blocks = decode_bitmap(
+                options.get(HandshakeOption.RESUME_BLOCKS, b"")
+            )
+        reply_length = self.reply_length(handshake_req, options)
+        self.prefetch(
+            self.upload_path(name)
+            for name in decode_filenames(options.get(HandshakeOption.PREFETCH, b""))
+        )
+        options = self.negotiate(options, file_size, resume_blocks, payload_size)
+        if stream:
+            options.block_range = self.block_range(stream, file_size, payload_size)
+
+        packet_number = randint(0, 10000)
+        handshake_res = Message(
+            MessageType.OK,
+            pos=packet_number,
+            payload=options.encode(reply_length),
+        )
+        handshake_end, client_address = await self.exchange_handshake(
+            transport, handshake_res, client_address, rtt, "download"
+        )
 
-        handshake_end = Message.decode(recv_bytes)
         print("Terminando handshake download")
         if handshake_end.type != MessageType.ACK or handshake_end.pos != packet_number:
             raise ConnectionAbortedError
@@ -93,42 +365,547 @@ class Server(ABC):
             f"📤 {client_address[0]}:{client_address[1]} started downloading {download_file_path}"
         )
 
-        return download_file_path, packet_number
+        return download_file_path, packet_number, options
 
-    def handle_upload_handshake(self, comm_socket, handshake_req, client_address):
+    async def handle_upload_handshake(
+        self, transport, handshake_req, client_address, rtt
+    ):
         last_packet_number = handshake_req.pos
-        filename = handshake_req.payload.decode()
+        filename, offered = decode_request(handshake_req.payload)
+        file_size = decode_int(offered.get(HandshakeOption.FILE_SIZE, b""))
+        stream = decode_stream(offered.get(HandshakeOption.STREAM, b""))
+        delta_base = decode_delta_base(offered.get(HandshakeOption.DELTA, b""))
+        if delta_base is not None:
+            # El delta solo sirve contra la copia de la que salio la firma
+            stat = self.stored_stat(self.upload_path(filename))
+            if stat is None or (stat.st_size, stat.st_mtime_ns) != delta_base:
+                raise ConnectionAbortedError
+        # Las partes y los deltas no se reanudan
+        state = (
+            None
+            if stream or delta_base
+            else ResumeState.load(self.upload_path(filename))
+        )
+        payload_size = self.payload_size(offered, state.chunk_size if state else None)
+        options = self.negotiate(
+            offered,
+            file_size,
+            state.resumable_blocks(file_size, payload_size) if state else [],
+            payload_size,
+        )
+        if stream:
+            options.block_range = self.block_range(stream, file_size, payload_size)
+            options.assembly_id = decode_int(offered.get(HandshakeOption.ASSEMBLY, b""))
+        options.delta_base = delta_base
+        chunk_ids = decode_chunk_ids(offered.get(HandshakeOption.CHUNKS, b""))
+        if self.chunks is not None and chunk_ids and file_size and not state:
+            if not stream and delta_base is None:
+                # Copiar los chunks que ya estan puede tardar
+                options.resume_blocks = await transport.offload(
+                    self.chunks.prefill,
+                    self.upload_path(filename),
+                    file_size,
+                    chunk_ids,
+                    payload_size,
+                )
 
         ack = Message(
             MessageType.ACK,
             pos=last_packet_number,
+            payload=options.encode(self.reply_length(handshake_req, offered)),
         )
         # Si cliente manda request y se pierde response, cliente se queda reenviando UPLOAD REQUEST al
         # socket principal, agregar timeout aca?
-        comm_socket.settimeout(SOCKET_TIME_OUT)
+        message, client_address = await self.exchange_handshake(
+            transport, ack, client_address, rtt, "upload"
+        )
+        transport.settimeout(SOCKET_TIME_OUT * MAX_CONSECUTIVE_LOSTS)
+        return filename, options, last_packet_number, message
+
+    async def exchange_handshake(
+        self, transport, response, client_address, rtt, direction
+    ) -> tuple[Message, tuple]:
+        """
+        Envia la respuesta a la solicitud hasta recibir el primer mensaje del
+        cliente en el socket de la sesion.
+        """
         consecutive_losts = 0
 
         while True:
-            comm_socket.sendto(ack.encode(), client_address)
-            print("Enviando handshake upload")
+            transport.settimeout(rtt.timeout(consecutive_losts))
+            sent_at = monotonic()
+            transport.send(response, client_address)
+            print(f"Enviando handshake {direction}")
             try:
-                recv_bytes, client_address = comm_socket.recvfrom(RECV_BUFFER_SIZE)
+                message, client_address = await transport.receive()
             except TimeoutError:
-                print("Perdimos handshake upload")
-
+                print(f"Perdimos handshake {direction}")
                 consecutive_losts += 1
                 if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
                     raise ConnectionAbortedError
             else:
-                break
-        message = Message.decode(recv_bytes)
-        comm_socket.settimeout(SOCKET_TIME_OUT * MAX_CONSECUTIVE_LOSTS)
-        return filename, last_packet_number, message
+                if consecutive_losts == 0:
+                    rtt.sample(monotonic() - sent_at)
+                return message, client_address
 
-    @abstractmethod
-    def handle_download(self, client_address, handshake_req):
-        raise NotImplementedError()
+    async def handle_download(self, transport, client_address, handshake_req):
+        if is_batch_request(handshake_req.payload):
+            return await self.handle_batch_download(
+                transport, client_address, handshake_req
+            )
+        if is_signature_request(handshake_req.payload):
+            return await self.handle_signature_download(
+                transport, client_address, handshake_req
+            )
+        rtt = RttEstimator()
 
-    @abstractmethod
-    def handle_upload(self, client_address, handshake_req):
-        raise NotImplementedError()
+        try:
+            (
+                download_file_path,
+                last_packet_number,
+                options,
+            ) = await self.handle_download_handshake(
+                transport, handshake_req, client_address, rtt
+            )
+        except FileNotFoundError:
+            error_code = FILE_NOT_FOUND_ERROR
+            error = Message(
+                MessageType.ERROR, pos=0, payload=error_code.to_bytes(1, "big")
+            )
+            transport.send(error, client_address)
+            return
+        except Exception:
+            error = Message(MessageType.ERROR, pos=0)
+            transport.send(error, client_address)
+            return
+
+        try:
+            with self.open_stored(download_file_path, options.payload_size) as file:
+                file_hash = self.digests.hash_file(
+                    download_file_path, file, options.hash_algorithm
+                )
+                source = TransferSource(
+                    self.cached(file),
+                    file_hash,
+                    options.resume_blocks,
+                    options.compression,
+                    options.block_range,
+                )
+                with self.egress.session(
+                    options.file_size - source.resumed_length
+                ) as share:
+                    pacers = (
+                        [share] if self.max_rate is None else [share, self.max_rate]
+                    )
+                    sender = self.create_sender(
+                        transport, client_address, rtt, pacers, options.fec
+                    )
+                    message = await send_file(sender, source, last_packet_number)
+        except ConnectionAbortedError:
+            return
+        client_address = sender.peer_address
+
+        if is_invalid_checksum(message):
+            logging.error(
+                f"❌ Downloaded {download_file_path} file has invalid checksum"
+            )
+        elif message.type == MessageType.ACK:
+            logging.warn(
+                f"✅ {client_address[0]}:{client_address[1]} finished downloading {download_file_path}"
+            )
+        else:
+            logging.warn(
+                f"🛑 {client_address[0]}:{client_address[1]} closed the connection"
+            )
+        logging.info(f"📶 {client_address[0]}:{client_address[1]} RTT: {rtt}")
+        logging.info(f"🗂️ Digest cache: {self.digests}")
+        logging.info(f"🧊 Block cache: {self.cache}")
+        logging.info(f"🚦 Egress: {self.egress}")
+
+    async def handle_upload(self, transport, client_address, handshake_req):
+        if is_batch_request(handshake_req.payload):
+            return await self.handle_batch_upload(
+                transport, client_address, handshake_req
+            )
+        rtt = RttEstimator()
+
+        try:
+            (
+                filename,
+                options,
+                last_packet_number,
+                first_message,
+            ) = await self.handle_upload_handshake(
+                transport, handshake_req, client_address, rtt
+            )
+        except Exception as e:
+            logging.error(f"Error {e}")
+            error = Message(MessageType.ERROR, pos=0)
+            transport.send(error, client_address)
+            return
+
+        Path(self.storage_path).mkdir(parents=True, exist_ok=True)
+        upload_file_path = self.upload_path(filename)
+
+        logging.warn(
+            f"📥 {client_address[0]}:{client_address[1]} started uploading {upload_file_path}"
+        )
+        # if upload_file_path.is_open() al nombre agregarle "(1)"
+        delta = options.delta_base is not None
+        # Un delta se recibe al lado del archivo y se aplica al terminar
+        received_path = delta_path(upload_file_path) if delta else upload_file_path
+        receiver = self.create_receiver(
+            transport, last_packet_number, client_address, options.fec
+        )
+        assembly = None
+        if options.block_range:
+            assembly = Assembly(
+                upload_file_path,
+                options.assembly_id,
+                options.file_size,
+                options.hash_algorithm,
+                options.payload_size,
+            )
+
+        try:
+            # Reservar y cerrar el archivo (que espera al hash) puede tardar
+            if assembly:
+                await transport.offload(assembly.prepare)
+            file = await transport.offload(
+                PreallocatedFile,
+                received_path,
+                options.file_size,
+                options.hash_algorithm,
+                chunk_size=options.payload_size,
+                held_blocks=options.resume_blocks,
+                compression=options.compression,
+                assembly=assembly,
+                block_range=options.block_range,
+            )
+            try:
+                message = await receive_file(
+                    receiver, file, rtt, first_message, linger=not delta
+                )
+                leaves = file.local_leaves()
+            finally:
+                await transport.offload(file.close)
+                if delta:
+                    ResumeState.discard(received_path)
+            if delta:
+                message, options, leaves = await self.rebuild(
+                    transport, upload_file_path, message, options
+                )
+                await send_reply(receiver, message, rtt)
+        except ConnectionAbortedError:
+            logging.warn(
+                f"🛑 {client_address[0]}:{client_address[1]} closed the connection"
+            )
+            return
+        except OSError as e:
+            # Sin espacio para reservar el archivo, o el cliente dejo de responder
+            logging.error(
+                f"❌ {client_address[0]}:{client_address[1]} upload of {upload_file_path} failed: {e}"
+            )
+            error = Message(MessageType.ERROR, pos=0)
+            transport.send(error, client_address)
+            return
+        client_address = receiver.peer_address
+
+        logging.info(f"📶 {client_address[0]}:{client_address[1]} RTT: {rtt}")
+        if message.type == MessageType.ACK:
+            if assembly:
+                # Las hojas de todo el archivo las tiene la sesion de la ultima parte
+                leaves = assembly.leaves
+            if leaves is not None:
+                await self.store_upload(
+                    transport,
+                    upload_file_path,
+                    options.hash_algorithm,
+                    options.payload_size,
+                    leaves,
+                )
+            logging.warn(
+                f"✅ {client_address[0]}:{client_address[1]} finished uploading {upload_file_path}"
+            )
+        elif message.type == MessageType.ERROR:
+            logging.error(f"❌ Uploaded {upload_file_path} file has invalid checksum")
+
+    async def rebuild(self, transport, path, reply, options):
+        """
+        Arma el archivo de una subida delta ya recibida. Devuelve la respuesta
+        final al FIN, y las opciones y las hojas con las que se guarda su
+        digest: el algoritmo y el tamaño de paquete de las hojas son los del
+        encabezado del delta.
+        """
+        if reply.type != MessageType.ACK:
+            delta_path(path).unlink(missing_ok=True)
+            return reply, options, None
+        try:
+            with self.open_stored(path) as base:
+                rebuilt = await transport.offload(apply_delta, path, base)
+        except OSError as e:
+            logging.warn(f"Could not open the copy of {path}: {e}")
+            delta_path(path).unlink(missing_ok=True)
+            rebuilt = None
+        if rebuilt is None:
+            error_code = INVALID_FILE_HASHING
+            reply = Message(
+                MessageType.ERROR, pos=reply.pos, payload=error_code.to_bytes(1, "big")
+            )
+            return reply, options, None
+        header, leaves = rebuilt
+        options.hash_algorithm = header.algorithm
+        options.payload_size = header.chunk_size
+        return reply, options, leaves
+
+    async def handle_signature_download(self, transport, client_address, handshake_req):
+        """
+        Envia la firma del archivo pedido (ver delta) como si fuera el
+        archivo, para que el cliente suba un delta contra el.
+        """
+        rtt = RttEstimator()
+        filename, offered = decode_request(handshake_req.payload)
+        path = self.upload_path(filename)
+        if self.stored_size(path) is None:
+            error_code = FILE_NOT_FOUND_ERROR
+            error = Message(
+                MessageType.ERROR, pos=0, payload=error_code.to_bytes(1, "big")
+            )
+            transport.send(error, client_address)
+            return
+        try:
+            options = self.negotiate(
+                offered, 0, payload_size=self.payload_size(offered)
+            )
+            # Leer y hashear el archivo entero puede tardar
+            with self.open_stored(path) as source:
+                signature = await transport.offload(
+                    compute_signature, source, options.hash_algorithm
+                )
+        except (ConnectionAbortedError, OSError):
+            transport.send(Message(MessageType.ERROR, pos=0), client_address)
+            return
+        options.file_size = len(signature)
+        packet_number = randint(0, 10000)
+        handshake_res = Message(
+            MessageType.OK,
+            pos=packet_number,
+            payload=options.encode(self.reply_length(handshake_req, offered)),
+        )
+        try:
+            handshake_end, client_address = await self.exchange_handshake(
+                transport, handshake_res, client_address, rtt, "download"
+            )
+            if (
+                handshake_end.type != MessageType.ACK
+                or handshake_end.pos != packet_number
+            ):
+                return
+            with BufferFile(signature, options.payload_size) as file:
+                file_hash = hash_in_background(
+                    file.view, options.hash_algorithm, options.payload_size
+                )
+                source = TransferSource(
+                    file, file_hash, compression=options.compression
+                )
+                with self.egress.session(options.file_size) as share:
+                    pacers = (
+                        [share] if self.max_rate is None else [share, self.max_rate]
+                    )
+                    sender = self.create_sender(
+                        transport, client_address, rtt, pacers, options.fec
+                    )
+                    message = await send_file(sender, source, packet_number)
+        except ConnectionAbortedError:
+            return
+        client_address = sender.peer_address
+        if message.type == MessageType.ACK:
+            logging.warn(
+                f"🧬 {client_address[0]}:{client_address[1]} downloaded the signature of {path}"
+            )
+
+    async def handle_batch_download(self, transport, client_address, handshake_req):
+        """
+        Descarga de un lote de archivos en una sola sesion: el OK lleva los
+        tamaños de todos y se envian uno detras de otro (ver file_transfer).
+        Los archivos que no existen se saltean.
+        """
+        rtt = RttEstimator()
+        _, offered = decode_request(handshake_req.payload)
+        paths = [
+            self.upload_path(name)
+            for name in decode_filenames(offered[HandshakeOption.FILENAMES])
+        ]
+        try:
+            options = self.negotiate(
+                offered, 0, payload_size=self.payload_size(offered)
+            )
+        except ConnectionAbortedError:
+            transport.send(Message(MessageType.ERROR, pos=0), client_address)
+            return
+        options.file_sizes = [self.stored_size(path) for path in paths]
+        packet_number = randint(0, 10000)
+        handshake_res = Message(
+            MessageType.OK,
+            pos=packet_number,
+            payload=options.encode(self.reply_length(handshake_req, offered)),
+        )
+        try:
+            handshake_end, client_address = await self.exchange_handshake(
+                transport, handshake_res, client_address, rtt, "download"
+            )
+        except ConnectionAbortedError:
+            return
+        if handshake_end.type != MessageType.ACK or handshake_end.pos != packet_number:
+            return
+
+        files = [
+            (path, size)
+            for path, size in zip(paths, options.file_sizes)
+            if size is not None
+        ]
+        self.prefetch(
+            self.upload_path(name)
+            for name in decode_filenames(offered.get(HandshakeOption.PREFETCH, b""))
+        )
+        logging.warn(
+            f"📤 {client_address[0]}:{client_address[1]} started downloading {len(files)} files"
+        )
+        downloaded = 0
+        try:
+            with self.egress.session(sum(size for _, size in files)) as share:
+                pacers = [share] if self.max_rate is None else [share, self.max_rate]
+                sender = self.create_sender(
+                    transport, client_address, rtt, pacers, options.fec
+                )
+                for i, (path, _) in enumerate(files):
+                    # El siguiente archivo se carga mientras se envia este
+                    self.prefetch(path for path, _ in files[i + 1 : i + 2])
+                    with self.open_stored(path, options.payload_size) as file:
+                        file_hash = self.digests.hash_file(
+                            path, file, options.hash_algorithm
+                        )
+                        source = TransferSource(
+                            self.cached(file),
+                            file_hash,
+                            compression=options.compression,
+                        )
+                        message = await send_file(sender, source, packet_number)
+                    packet_number = message.pos
+                    if is_invalid_checksum(message):
+                        logging.error(f"❌ Downloaded {path} file has invalid checksum")
+                    elif message.type == MessageType.ACK:
+                        downloaded += 1
+                        logging.info(f"✅ {path} downloaded")
+                    else:
+                        break
+        except ConnectionAbortedError:
+            return
+        client_address = sender.peer_address
+
+        logging.warn(
+            f"✅ {client_address[0]}:{client_address[1]} downloaded {downloaded} of {len(files)} files"
+        )
+        logging.info(f"📶 {client_address[0]}:{client_address[1]} RTT: {rtt}")
+        logging.info(f"🗂️ Digest cache: {self.digests}")
+        logging.info(f"🧊 Block cache: {self.cache}")
+
+    async def handle_batch_upload(self, transport, client_address, handshake_req):
+        """
+        Subida de un lote de archivos en una sola sesion, con los nombres y
+        tamaños en la solicitud. Cada archivo se verifica y se mueve a su
+        ruta de destino apenas termina.
+        """
+        rtt = RttEstimator()
+        last_packet_number = handshake_req.pos
+        _, offered = decode_request(handshake_req.payload)
+        names = decode_filenames(offered[HandshakeOption.FILENAMES])
+        sizes = decode_sizes(offered.get(HandshakeOption.FILE_SIZES, b""))
+        try:
+            if len(sizes) != len(names) or None in sizes:
+                raise ConnectionAbortedError
+            options = self.negotiate(
+                offered, 0, payload_size=self.payload_size(offered)
+            )
+            ack = Message(
+                MessageType.ACK,
+                pos=last_packet_number,
+                payload=options.encode(self.reply_length(handshake_req, offered)),
+            )
+            message, client_address = await self.exchange_handshake(
+                transport, ack, client_address, rtt, "upload"
+            )
+        except ConnectionAbortedError:
+            transport.send(Message(MessageType.ERROR, pos=0), client_address)
+            return
+        transport.settimeout(SOCKET_TIME_OUT * MAX_CONSECUTIVE_LOSTS)
+
+        logging.warn(
+            f"📥 {client_address[0]}:{client_address[1]} started uploading {len(names)} files"
+        )
+        receiver = self.create_receiver(
+            transport, last_packet_number, client_address, options.fec
+        )
+        # Los archivos subidos pasan al almacen al terminar la sesion, para
+        # no demorar la recepcion de los siguientes
+        uploaded = []
+        reply = None
+        try:
+            for i, (name, size) in enumerate(zip(names, sizes)):
+                upload_file_path = self.upload_path(name)
+                try:
+                    file = await transport.offload(
+                        PreallocatedFile,
+                        upload_file_path,
+                        size,
+                        options.hash_algorithm,
+                        chunk_size=options.payload_size,
+                        compression=options.compression,
+                    )
+                    try:
+                        reply = await receive_file(
+                            receiver,
+                            file,
+                            rtt,
+                            message,
+                            previous_reply=reply,
+                            linger=i == len(names) - 1,
+                        )
+                        leaves = file.local_leaves()
+                    finally:
+                        await transport.offload(file.close)
+                except ConnectionAbortedError:
+                    logging.warn(
+                        f"🛑 {client_address[0]}:{client_address[1]} closed the connection"
+                    )
+                    return
+                except OSError as e:
+                    logging.error(
+                        f"❌ {client_address[0]}:{client_address[1]} upload of {upload_file_path} failed: {e}"
+                    )
+                    transport.send(Message(MessageType.ERROR, pos=0), client_address)
+                    return
+                message = None
+                receiver.restart(reply.pos)
+                if reply.type == MessageType.ACK:
+                    uploaded.append((upload_file_path, leaves))
+                    logging.info(f"✅ {upload_file_path} uploaded")
+                else:
+                    logging.error(
+                        f"❌ Uploaded {upload_file_path} file has invalid checksum"
+                    )
+        finally:
+            for path, leaves in uploaded:
+                await self.store_upload(
+                    transport,
+                    path,
+                    options.hash_algorithm,
+                    options.payload_size,
+                    leaves,
+                )
+        client_address = receiver.peer_address
+
+        logging.warn(
+            f"✅ {client_address[0]}:{client_address[1]} uploaded {len(uploaded)} of {len(names)} files"
+        )
+        logging.info(f"📶 {client_address[0]}:{client_address[1]} RTT: {rtt}")
@@ -1,153 +1,71 @@
-from pathlib import Path
-from lib.message import Message, MessageType
-from lib.file_hashing import hashing
-from lib.client import Client
-from lib.constants import (
-    INVALID_FILE_HASHING,
-    PAYLOAD_SIZE,
-    MAX_CONSECUTIVE_LOSTS,
-    SOCKET_TIME_OUT,
-    WRITE_BINARY_MODE,
-    READ_BINARY_MODE,
-    RECV_BUFFER_SIZE,
+from lib.file_transfer import (
+    TransferSource,
+    is_invalid_checksum,
+    receive_file,
+    send_file,
 )
-import logging
+from lib.stop_and_wait_receiver import StopAndWaitReceiver
+from lib.stop_and_wait_sender import StopAndWaitSender
+from lib.preallocated_file import PreallocatedFile
+from lib.file_hashing import hash_in_background
+from lib.message import MessageType
+from lib.mapped_file import MappedFile
+from lib.transport import run_blocking
+from lib.client import Client
+from lib.constants import MAX_CONSECUTIVE_LOSTS, SOCKET_TIME_OUT
 
 
 class StopAndWaitClient(Client):
-    def download_loop(self, last_packet_number, full_path_to_file, progress_bar):
-        remote_file_hash = None
-        handshake_res_pos = last_packet_number
-        consecutive_hr_losts = 0
-
+    def create_receiver(self, last_packet_number, progress_bar, options):
         self.socket.settimeout(SOCKET_TIME_OUT * MAX_CONSECUTIVE_LOSTS)
+        return StopAndWaitReceiver(
+            self.transport, last_packet_number, progress_bar=progress_bar
+        )
 
-        with open(full_path_to_file, WRITE_BINARY_MODE) as file:
-            while True:
-                recv_bytes, real_server_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-                message = Message.decode(recv_bytes)
-
-                logging.info(f"Received packet with seq={message.pos}")
-
-                if message.type == MessageType.FIN:
-                    remote_file_hash = message.payload
-                    break
-
-                if message.pos <= last_packet_number:
-                    ack = Message(MessageType.ACK, pos=message.pos)
-                    self.socket.sendto(ack.encode(), real_server_address)
-
-                    if message.pos == handshake_res_pos:
-                        consecutive_hr_losts += 1
-
-                    if consecutive_hr_losts >= MAX_CONSECUTIVE_LOSTS:
-                        raise ConnectionAbortedError
-                    continue
-
-                last_packet_number = message.pos
-                ack = Message(MessageType.ACK, pos=last_packet_number)
-                self.socket.sendto(ack.encode(), real_server_address)
-
-                file.write(message.payload)
-                progress_bar.update(len(message.payload))
-                progress_bar.refresh()
-
-        local_file_hash = hashing(full_path_to_file)
-
-        error_code = INVALID_FILE_HASHING
-        message = (
-            Message(
-                MessageType.ERROR,
-                pos=message.pos,
-                payload=error_code.to_bytes(1, "big"),
-            )
-            if remote_file_hash and (local_file_hash != remote_file_hash)
-            else Message(MessageType.ACK, pos=message.pos)
+    def create_sender(self, real_server_address, progress_bar, options):
+        return StopAndWaitSender(
+            self.transport, real_server_address, progress_bar, self.rtt
         )
 
-        self.socket.settimeout(SOCKET_TIME_OUT * 7)
-        while True:
-            self.socket.sendto(message.encode(), real_server_address)
-            try:
-                _, real_server_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-            except TimeoutError:
-                break
+    def download_loop(
+        self, last_packet_number, full_path_to_file, options, progress_bar
+    ):
+        receiver = self.create_receiver(last_packet_number, progress_bar, options)
+        with PreallocatedFile(
+            full_path_to_file,
+            options.file_size,
+            options.hash_algorithm,
+            chunk_size=options.payload_size,
+            held_blocks=options.resume_blocks,
+            compression=options.compression,
+        ) as file:
+            message = run_blocking(receive_file(receiver, file, self.rtt))
 
         if message.type == MessageType.ERROR:
             raise EOFError
 
     def upload_loop(
-        self, upload_file_path, packet_number, real_server_address, progress_bar
+        self,
+        upload_file_path,
+        packet_number,
+        real_server_address,
+        options,
+        progress_bar,
     ):
-        consecutive_losts = 0
-        file_hash = hashing(upload_file_path)
-
-        with open(upload_file_path, READ_BINARY_MODE) as file:
-            payload = file.read(PAYLOAD_SIZE)
-            packet_number += 1
-
-            while True:
-                if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
-                    raise ConnectionAbortedError
-
-                if not payload:
-                    break
-
-                message = Message(MessageType.OK, packet_number, payload)
-                self.socket.sendto(message.encode(), real_server_address)
-
-                logging.info(f"Sent {message}")
-
-                try:
-                    recv_bytes, real_server_address = self.socket.recvfrom(
-                        RECV_BUFFER_SIZE
-                    )
-                except TimeoutError:
-                    logging.info(
-                        f"Packet lost, resending packet with seq={message.pos}"
-                    )
-                    consecutive_losts += 1
-                    continue
-
-                ack = Message.decode(recv_bytes)
-
-                if ack.type == MessageType.ERROR:
-                    raise ConnectionAbortedError
-
-                if ack.pos != packet_number:
-                    logging.info(
-                        f"Packet lost, resending packet with seq={message.pos}"
-                    )
-                    consecutive_losts += 1
-                    continue
-
-                logging.info(f"Received packet with ack={message.pos}")
-
-                progress_bar.update(len(message.payload))
-                progress_bar.refresh()
-                payload = file.read(PAYLOAD_SIZE)
-                packet_number += 1
-                consecutive_losts = 0
-
-        self.socket.settimeout(SOCKET_TIME_OUT)
-        message = Message(MessageType.FIN, packet_number, file_hash)
-        self.socket.sendto(message.encode(), real_server_address)
-
-        consecutive_losts = 0
-        while True:
-            if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
-                raise ConnectionAbortedError
-            try:
-                recv_bytes, real_server_address = self.socket.recvfrom(RECV_BUFFER_SIZE)
-            except TimeoutError:
-                logging.info(f"FIN packet lost, resending it {message.pos}")
-                consecutive_losts += 1
-                self.socket.sendto(message.encode(), real_server_address)
-            else:
-                break
-
-        message = Message.decode(recv_bytes)
-        payload = int.from_bytes(message.payload, byteorder="big")
+        sender = self.create_sender(real_server_address, progress_bar, options)
+        with MappedFile(upload_file_path, options.payload_size) as file:
+            file_hash = hash_in_background(
+                file.view, options.hash_algorithm, file.chunk_size
+            )
+            message = run_blocking(
+                send_file(
+                    sender,
+                    TransferSource(
+                        file, file_hash, options.resume_blocks, options.compression
+                    ),
+                    packet_number,
+                )
+            )
 
-        if message.type == MessageType.ERROR and payload == INVALID_FILE_HASHING:
+        if is_invalid_checksum(message):
             raise EOFError
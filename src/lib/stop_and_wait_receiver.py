@@ -0,0 +1,76 @@
+from lib.constants import MAX_CONSECUTIVE_LOSTS
+from lib.message import Message, MessageType
+import logging
+
+
+class StopAndWaitReceiver:
+    """
+    Receptor de Stop & Wait compartido por la descarga del cliente y la
+    subida del servidor. Cada paquete se confirma con un ACK de su numero.
+    Los repetidos (se perdio nuestro ACK, o la respuesta del handshake) se
+    vuelven a confirmar, y si se repiten MAX_CONSECUTIVE_LOSTS veces seguidas
+    se da por perdida la conexion.
+    """
+
+    def __init__(self, transport, window_seq, peer_address=None, progress_bar=None):
+        self.transport = transport
+        self.window_seq = window_seq
+        self.first_seq = window_seq + 1
+        self.peer_address = peer_address
+        self.progress_bar = progress_bar
+
+    def restart(self, window_seq):
+        self.window_seq = window_seq
+        self.first_seq = window_seq + 1
+
+    async def receive(self, file, first_message=None, request=None) -> Message:
+        """
+        Recibe paquetes hasta el FIN. Si se pasa un request (el pedido de
+        bloques de una nueva ronda), se envia al empezar y se repite cada vez
+        que llega el FIN de la ronda anterior.
+        """
+        consecutive_duplicates = 0
+        message = first_message
+        if request:
+            self.transport.send(request, self.peer_address)
+
+        while True:
+            if message is None:
+                message, self.peer_address = await self.transport.receive()
+
+            logging.info(f"Received packet with seq={message.pos}")
+
+            if message.type == MessageType.FIN:
+                if message.pos > self.window_seq:
+                    return message
+                if request:
+                    self.transport.send(request, self.peer_address)
+                message = None
+                continue
+
+            if message.type == MessageType.ERROR:
+                raise ConnectionAbortedError
+
+            if message.pos <= self.window_seq:
+                self.send_ack(message.pos)
+                consecutive_duplicates += 1
+                if consecutive_duplicates >= MAX_CONSECUTIVE_LOSTS:
+                    raise ConnectionAbortedError
+            elif message.type == MessageType.OK and message.pos == self.window_seq + 1:
+                self.send_ack(message.pos)
+                self.write(file, message)
+                consecutive_duplicates = 0
+            message = None
+
+    def write(self, file, message: Message):
+        index = message.pos - self.first_seq
+        written = file.write(index, message.payload)
+        self.window_seq = message.pos
+        if self.progress_bar and written:
+            self.progress_bar.update(written)
+            self.progress_bar.refresh()
+
+    def send_ack(self, pos):
+        ack = Message(MessageType.ACK, pos=pos)
+        self.transport.send(ack, self.peer_address)
+        logging.info(f"Sent {ack}")
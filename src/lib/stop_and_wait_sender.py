@@ -0,0 +1,57 @@
+from lib.constants import MAX_CONSECUTIVE_LOSTS
+from lib.message import Message, MessageType
+from lib.sender import Sender
+from time import monotonic
+import logging
+
+
+class StopAndWaitSender(Sender):
+    """
+    Emisor de Stop & Wait compartido por la descarga del servidor y la
+    subida del cliente: cada paquete se reenvia hasta recibir el ACK de su
+    numero, con el timeout de retransmision de la sesion.
+    """
+
+    async def send(self, source, last_packet_number):
+        for index in range(source.packets):
+            packet_number = last_packet_number + 1 + index
+            message = Message(MessageType.OK, packet_number, source.packet(index))
+            await self.pace([message])
+            await self.send_packet(message)
+            if self.progress_bar:
+                self.progress_bar.update(source.data_length(index))
+                self.progress_bar.refresh()
+        return last_packet_number + source.packets
+
+    async def send_packet(self, message: Message):
+        consecutive_losts = 0
+        while True:
+            if consecutive_losts >= MAX_CONSECUTIVE_LOSTS:
+                logging.info(f"{self.peer()} Too many lost packets, closing connection")
+                raise ConnectionAbortedError
+
+            self.transport.settimeout(self.rtt.timeout(consecutive_losts))
+            sent_at = monotonic()
+            self.transport.send(message, self.peer_address)
+            logging.info(f"Sent {message}")
+
+            try:
+                ack, self.peer_address = await self.transport.receive()
+            except TimeoutError:
+                logging.info(f"{self.peer()} Packet {message.pos} lost, resending...")
+                consecutive_losts += 1
+                continue
+
+            if self.is_abort(ack):
+                logging.warn(f"🛑 {self.peer()} closed the connection")
+                raise ConnectionAbortedError
+
+            if ack.type != MessageType.ACK or ack.pos != message.pos:
+                logging.info(f"{self.peer()} Packet {message.pos} lost, resending...")
+                consecutive_losts += 1
+                continue
+
+            logging.info(f"{self.peer()} Received ACK packet {ack.pos}")
+            if consecutive_losts == 0:
+                self.rtt.sample(monotonic() - sent_at)
+            return
@@ -0,0 +1,91 @@
+from lib.constants import TIMER_WHEEL_SLOTS, TIMER_WHEEL_TICK
+from threading import Condition, Thread, Lock
+from time import monotonic
+from math import ceil
+import logging
+
+
+class TimerWheel:
+    """
+    Timing wheel con un unico thread para todos los timers de retransmision
+    del proceso. Cada timer se identifica con una clave (por ejemplo
+    (sesion, seq)) y se arma o cancela en O(1). Los timers que vencen mas
+    alla de una vuelta de la rueda guardan la cantidad de vueltas restantes.
+    Los callbacks corren en el thread de la rueda, por lo que deben ser
+    cortos.
+    """
+
+    def __init__(self, tick=TIMER_WHEEL_TICK, slots=TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots: list[dict] = [{} for _ in range(slots)]
+        self.timers: dict = {}
+        self.current = 0
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, name="timer-wheel", daemon=True)
+        self.thread.start()
+
+    def arm(self, key, delay, callback):
+        ticks = max(1, ceil(delay / self.tick))
+        with self.condition:
+            self._remove(key)
+            slot = (self.current + ticks) % len(self.slots)
+            self.slots[slot][key] = [(ticks - 1) // len(self.slots), callback]
+            self.timers[key] = slot
+            if len(self.timers) == 1:
+                self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self._remove(key)
+
+    def _remove(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def __len__(self):
+        return len(self.timers)
+
+    def run(self):
+        next_tick = monotonic() + self.tick
+        while True:
+            expired = []
+            with self.condition:
+                while not self.timers:
+                    self.condition.wait()
+                    next_tick = monotonic() + self.tick
+
+                now = monotonic()
+                if now < next_tick:
+                    self.condition.wait(next_tick - now)
+                    continue
+
+                while next_tick <= now:
+                    next_tick += self.tick
+                    self.current = (self.current + 1) % len(self.slots)
+                    slot = self.slots[self.current]
+                    for key, timer in list(slot.items()):
+                        if timer[0] > 0:
+                            timer[0] -= 1
+                            continue
+                        del slot[key]
+                        del self.timers[key]
+                        expired.append(timer[1])
+
+            for callback in expired:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Timer callback failed: {e}")
+
+
+timer_wheel_lock = Lock()
+timer_wheel = None
+
+
+def shared_timer_wheel() -> TimerWheel:
+    global timer_wheel
+    with timer_wheel_lock:
+        if timer_wheel is None:
+            timer_wheel = TimerWheel()
+        return timer_wheel
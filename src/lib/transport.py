@@ -0,0 +1,201 @@
+from lib.constants import (
+    GRO_BUFFER_SIZE,
+    GRO_BUFFER_SLOTS,
+    GSO_MAX_SEGMENTS,
+    GSO_MAX_SIZE,
+    HEADER_SIZE,
+    RECV_BUFFER_SIZE,
+    RECV_BUFFER_SLOTS,
+    UDP_GRO,
+    UDP_SEGMENT,
+)
+from socket import CMSG_SPACE, SOL_UDP
+from lib.timer_wheel import shared_timer_wheel
+from lib.message import Message
+from collections import deque
+import logging
+import struct
+import time
+import errno
+
+GSO_UNSUPPORTED_ERRORS = (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+
+class BufferRing:
+    """
+    Buffers de recepcion preasignados que se reutilizan en orden circular.
+    Un mensaje recibido en uno de ellos es valido hasta que se reciban
+    otros RECV_BUFFER_SLOTS mensajes: quien necesite conservar el payload
+    por mas tiempo debe copiarlo.
+    """
+
+    def __init__(self, slots=RECV_BUFFER_SLOTS, size=RECV_BUFFER_SIZE):
+        self.buffers = [memoryview(bytearray(size)) for _ in range(slots)]
+        self.next = 0
+
+    def next_buffer(self) -> memoryview:
+        buffer = self.buffers[self.next]
+        self.next = (self.next + 1) % len(self.buffers)
+        return buffer
+
+
+def run_blocking(coroutine):
+    """
+    Ejecuta hasta el final una corrutina de protocolo (ver file_transfer)
+    sobre un transporte bloqueante. Como receive nunca se suspende, la
+    corrutina termina en el primer paso sin necesitar un event loop.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return result.value
+    coroutine.close()
+    raise RuntimeError("blocking transport coroutine suspended")
+
+
+class Transport:
+    """
+    Envio y recepcion de mensajes sobre un socket UDP sin copias por paquete:
+    se recibe con recvfrom_into sobre un BufferRing y se envia con sendmsg,
+    pasando el header y el payload como buffers separados.
+
+    Los protocolos reciben con receive, offload, sleep y timers, que tambien
+    implementa el transporte de las sesiones del motor asyncio (ver
+    async_engine): aca reciben bloqueando, ejecutan la operacion en el
+    momento y usan la timing wheel compartida.
+    """
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffers = BufferRing()
+
+    def send(self, message: Message, address):
+        self.socket.sendmsg([message.header(), message.payload], [], 0, address)
+
+    def send_batch(self, messages: list[Message], address):
+        for message in messages:
+            self.send(message, address)
+
+    def recv(self) -> tuple[Message, tuple]:
+        buffer = self.buffers.next_buffer()
+        size, address = self.socket.recvfrom_into(buffer)
+        return Message.decode(buffer[:size]), address
+
+    async def receive(self) -> tuple[Message, tuple]:
+        return self.recv()
+
+    async def offload(self, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    async def sleep(self, delay):
+        time.sleep(delay)
+
+    def timers(self):
+        return shared_timer_wheel()
+
+    def settimeout(self, timeout):
+        self.socket.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.socket.gettimeout()
+
+    def close(self):
+        self.socket.close()
+
+
+class GsoTransport(Transport):
+    """
+    Modo opcional para Linux que delega la segmentacion al kernel. Al enviar
+    una tanda de paquetes del mismo tamaño se hace una sola llamada a sendmsg
+    con UDP_SEGMENT (GSO), y al recibir con UDP_GRO el kernel puede entregar
+    varios datagramas juntos, que se separan usando el tamaño de segmento que
+    informa. Si el kernel no soporta alguna de las dos opciones se vuelve
+    automaticamente a un datagrama por llamada.
+    """
+
+    def __init__(self, socket):
+        super().__init__(socket)
+        self.pending = deque()
+        self.gso = self.enable(UDP_SEGMENT, 0)
+        self.gro = self.enable(UDP_GRO, 1)
+        if self.gro:
+            self.buffers = BufferRing(GRO_BUFFER_SLOTS, GRO_BUFFER_SIZE)
+        if not (self.gso and self.gro):
+            logging.warn(
+                f"UDP GSO {'on' if self.gso else 'off'}, "
+                f"GRO {'on' if self.gro else 'off'}: not supported by the kernel"
+            )
+
+    def enable(self, option, value):
+        try:
+            self.socket.setsockopt(SOL_UDP, option, value)
+        except OSError:
+            return False
+        return True
+
+    def send_batch(self, messages: list[Message], address):
+        if not self.gso:
+            return super().send_batch(messages, address)
+
+        # Todos los segmentos de un envio deben medir lo mismo, salvo el ultimo
+        # que puede ser mas corto
+        start = 0
+        while start < len(messages):
+            segment_size = HEADER_SIZE + messages[start].length
+            end = start + 1
+            while (
+                end < len(messages)
+                and end - start < GSO_MAX_SEGMENTS
+                and (end - start + 1) * segment_size <= GSO_MAX_SIZE
+            ):
+                size = HEADER_SIZE + messages[end].length
+                if size > segment_size:
+                    break
+                end += 1
+                if size < segment_size:
+                    break
+            self.send_segments(messages[start:end], segment_size, address)
+            start = end
+
+    def send_segments(self, messages: list[Message], segment_size, address):
+        if len(messages) == 1 or not self.gso:
+            return super().send_batch(messages, address)
+
+        buffers = []
+        for message in messages:
+            buffers.append(message.header())
+            buffers.append(message.payload)
+        segment = [(SOL_UDP, UDP_SEGMENT, struct.pack("H", segment_size))]
+        try:
+            self.socket.sendmsg(buffers, segment, 0, address)
+        except OSError as e:
+            if e.errno not in GSO_UNSUPPORTED_ERRORS:
+                raise
+            logging.warn(f"UDP GSO send failed ({e}), falling back to sendmsg")
+            self.gso = False
+            super().send_batch(messages, address)
+
+    def recv(self) -> tuple[Message, tuple]:
+        if self.pending:
+            return self.pending.popleft()
+        if not self.gro:
+            return super().recv()
+
+        buffer = self.buffers.next_buffer()
+        size, ancdata, _, address = self.socket.recvmsg_into(
+            [buffer], CMSG_SPACE(struct.calcsize("i"))
+        )
+        segment_size = size
+        for level, type, data in ancdata:
+            if level == SOL_UDP and type == UDP_GRO:
+                (segment_size,) = struct.unpack("i", data[: struct.calcsize("i")])
+        segment_size = segment_size or size
+
+        for offset in range(segment_size, size, segment_size):
+            segment = buffer[offset : min(offset + segment_size, size)]
+            self.pending.append((Message.decode(segment), address))
+        return Message.decode(buffer[: min(segment_size, size)]), address
+
+
+def create_transport(socket, gso=False) -> Transport:
+    return GsoTransport(socket) if gso else Transport(socket)
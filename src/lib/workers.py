@@ -0,0 +1,72 @@
+from logging.handlers import QueueHandler, QueueListener
+from lib.constants import WORKER_SHUTDOWN_TIME_OUT
+import multiprocessing
+import logging
+import signal
+
+
+def interrupt(*_):
+    raise KeyboardInterrupt
+
+
+class WorkerPool:
+    """
+    Varios procesos de servidor que comparten el puerto con SO_REUSEPORT.
+    El kernel reparte los datagramas entre los sockets segun la direccion
+    del cliente, por lo que cada cliente queda siempre en el mismo proceso,
+    que atiende sus sesiones con sus propios sockets. Los logs de todos los
+    procesos se escriben desde el proceso principal.
+
+    Ctrl-C o SIGTERM en el proceso principal detienen a cada proceso con
+    SIGTERM, que termina como un servidor solo con Ctrl-C (esperando las
+    transferencias en curso) hasta WORKER_SHUTDOWN_TIME_OUT segundos.
+    """
+
+    def __init__(self, create_server, run_server, workers):
+        self.create_server = create_server
+        self.run_server = run_server
+        self.workers = workers
+
+    def run(self):
+        # Cada proceso crea su servidor (y su socket) despues del fork
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        listener = QueueListener(
+            queue, *logging.getLogger().handlers, respect_handler_level=True
+        )
+        listener.start()
+        signal.signal(signal.SIGTERM, interrupt)
+
+        processes = [
+            context.Process(target=self.work, args=(queue,), name=f"worker-{i + 1}")
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            logging.warn(f"🛑 Shutting down {self.workers} workers")
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join(WORKER_SHUTDOWN_TIME_OUT)
+                if process.is_alive():
+                    logging.error(f"❌ {process.name} did not stop, killing it")
+                    process.kill()
+                    process.join()
+            listener.stop()
+
+    def work(self, queue):
+        # El Ctrl-C de la terminal lo atiende el proceso principal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, interrupt)
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(QueueHandler(queue))
+        self.run_server(self.create_server())